@@ -0,0 +1,1087 @@
+#!python
+'''
+A stand-in for the web services of a CIM server, serving a synthetic
+dataset, so coverity.ws and cov_doemail.py can be exercised and timed
+without a real server.  LocalClient serves the same dataset in-process.
+
+It serves the defect, configuration and administration WSDLs for any API
+version at the usual /ws/v<N>/<service>service?wsdl URLs, and implements
+the calls this package makes: getMergedDefectsForStreams,
+getStreamDefects, getMergedDefectHistory, getFileContents,
+getTrendRecordsForProject, getComponentMetricsForProject,
+getCheckerProperties, getComponentMaps, getComponent, getStreams,
+getProjects, getUsers, getAssignableUsers, getSnapshotsForStream,
+getSnapshotInformation and notify.  Credentials aren't checked.
+
+The dataset is generated from a seed, so runs with the same options see
+the same defects.  "--latency" delays every response, to approximate a
+server on the other side of a network, and "--method-latency" delays the
+responses to one method, e.g. "getFileContents=0.5".  For example::
+
+    python benchmarks/fakecim.py --port 8123 --defects 20000 --latency 0.02 &
+    time python bin/cov_doemail.py --host localhost --port 8123 \\
+        --user admin --password x --project project0 --dest owners --test
+
+The number of calls and notifications is printed on exit.  The server can
+also be run in-process with FakeCIM(...).start().
+'''
+import re
+import sys
+import time
+import zlib
+import base64
+import random
+import signal
+import hashlib
+import datetime
+import optparse
+import urllib
+import threading
+import BaseHTTPServer
+import SocketServer
+from xml.sax.saxutils import escape
+from xml.etree import cElementTree as ElementTree
+
+from suds.sax.text import Text
+from suds.sudsobject import Factory
+
+# The XML schema of the data objects.  Field types are a data object name,
+# or one of the codes in _xsd_types.  A trailing "*" marks a list.
+_xsd_types = {'s': 'xs:string', 'i': 'xs:int', 'l': 'xs:long',
+              'b': 'xs:boolean', 'd': 'xs:dateTime'}
+
+TYPES = {
+    'pageSpecDataObj': [('pageSize', 'i'), ('sortAscending', 'b'),
+        ('sortField', 's'), ('startIndex', 'i')],
+    'streamIdDataObj': [('name', 's')],
+    'projectIdDataObj': [('name', 's')],
+    'snapshotIdDataObj': [('id', 'l')],
+    'componentIdDataObj': [('name', 's')],
+    'componentMapIdDataObj': [('name', 's')],
+    'checkerSubcategoryIdDataObj': [('checkerName', 's'), ('domain', 's'),
+        ('subcategory', 's')],
+    'fileIdDataObj': [('contentsMD5', 's'), ('filePathname', 's')],
+    'fieldChangeDataObj': [('fieldName', 's'), ('newValue', 's'),
+        ('oldValue', 's')],
+
+    # Configuration
+    'userDataObj': [('email', 's'), ('familyName', 's'), ('givenName', 's'),
+        ('disabled', 'b'), ('locked', 'b'), ('username', 's')],
+    'usersPageDataObj': [('totalNumberOfRecords', 'i'),
+        ('users', 'userDataObj*')],
+    'userFilterSpecDataObj': [('assignable', 'b'), ('disabled', 'b'),
+        ('locked', 'b'), ('namePattern', 's')],
+    'streamDataObj': [('componentMapId', 'componentMapIdDataObj'),
+        ('description', 's'), ('id', 'streamIdDataObj'), ('language', 's'),
+        ('primaryProjectId', 'projectIdDataObj')],
+    'streamFilterSpecDataObj': [('descriptionPattern', 's'),
+        ('languageList', 's*'), ('namePattern', 's')],
+    'projectDataObj': [('dateCreated', 'd'), ('description', 's'),
+        ('id', 'projectIdDataObj'), ('projectKey', 'l'),
+        ('streams', 'streamDataObj*')],
+    'projectFilterSpecDataObj': [('descriptionPattern', 's'),
+        ('includeStreams', 'b'), ('namePattern', 's')],
+    'snapshotFilterSpecDataObj': [('descriptionPattern', 's'),
+        ('endDate', 'd'), ('startDate', 'd'), ('versionPattern', 's')],
+    'snapshotInfoDataObj': [('analysisTime', 'l'), ('buildTime', 'l'),
+        ('dateCreated', 'd'), ('description', 's'),
+        ('snapshotId', 'snapshotIdDataObj'), ('target', 's'),
+        ('version', 's')],
+    'componentDataObj': [('componentId', 'componentIdDataObj'),
+        ('subscribers', 's*')],
+    'componentPathRuleDataObj': [('componentId', 'componentIdDataObj'),
+        ('pathPattern', 's')],
+    'componentDefectRuleDataObj': [('componentId', 'componentIdDataObj'),
+        ('owner', 's')],
+    'componentMapDataObj': [('componentMapId', 'componentMapIdDataObj'),
+        ('componentPathRules', 'componentPathRuleDataObj*'),
+        ('components', 'componentDataObj*'),
+        ('defectRules', 'componentDefectRuleDataObj*'),
+        ('description', 's')],
+    'componentMapFilterSpecDataObj': [('namePattern', 's')],
+    'checkerPropertyDataObj': [('category', 's'),
+        ('categoryDescription', 's'),
+        ('checkerSubcategoryId', 'checkerSubcategoryIdDataObj'),
+        ('cweCategory', 's'), ('impact', 's'), ('impactDescription', 's'),
+        ('subcategoryLocalEffect', 's'), ('subcategoryLongDescription', 's'),
+        ('subcategoryShortDescription', 's')],
+    'checkerPropertyFilterSpecDataObj': [('categoryList', 's*'),
+        ('checkerNameList', 's*'), ('domainList', 's*'),
+        ('impactList', 's*'), ('subcategoryList', 's*')],
+
+    # Defects
+    'streamSnapshotFilterSpecDataObj': [
+        ('snapshotIdExcludeList', 'snapshotIdDataObj*'),
+        ('snapshotIdIncludeList', 'snapshotIdDataObj*'),
+        ('streamId', 'streamIdDataObj*')],
+    'mergedDefectFilterSpecDataObj': [('actionNameList', 's*'),
+        ('cidList', 'l*'), ('classificationNameList', 's*'),
+        ('componentIdExclude', 'b'),
+        ('componentIdList', 'componentIdDataObj*'),
+        ('firstDetectedEndDate', 'd'), ('firstDetectedStartDate', 'd'),
+        ('ownerNameList', 's*'), ('severityNameList', 's*'),
+        ('statusNameList', 's*'),
+        ('streamSnapshotFilterSpecExcludeList', 'streamSnapshotFilterSpecDataObj*'),
+        ('streamSnapshotFilterSpecIncludeList', 'streamSnapshotFilterSpecDataObj*')],
+    'mergedDefectDataObj': [('action', 's'), ('checkerName', 's'),
+        ('checkerSubcategory', 's'), ('cid', 'l'), ('classification', 's'),
+        ('componentName', 's'), ('domain', 's'), ('filePathname', 's'),
+        ('firstDetected', 'd'), ('functionDisplayName', 's'),
+        ('functionName', 's'), ('lastDetected', 'd'), ('lastTriaged', 'd'),
+        ('occurrenceCount', 'i'), ('owner', 's'), ('severity', 's'),
+        ('status', 's')],
+    'mergedDefectsPageDataObj': [('mergedDefects', 'mergedDefectDataObj*'),
+        ('totalNumberOfRecords', 'i')],
+    'streamDefectIdDataObj': [('defectTriageId', 'l'), ('id', 'l'),
+        ('verNum', 'l')],
+    'streamDefectFilterSpecDataObj': [('includeDefectInstances', 'b'),
+        ('includeHistory', 'b'), ('scopePattern', 's'),
+        ('streamIdList', 'streamIdDataObj*')],
+    'functionInfoDataObj': [('fileId', 'fileIdDataObj'),
+        ('functionDisplayName', 's'), ('functionMangledName', 's'),
+        ('functionName', 's')],
+    'eventDataObj': [('eventDescription', 's'), ('eventKind', 's'),
+        ('eventNumber', 'i'), ('eventSet', 'i'), ('eventTag', 's'),
+        ('fileId', 'fileIdDataObj'), ('lineNumber', 'i'), ('main', 'b')],
+    'defectInstanceIdDataObj': [('id', 'l')],
+    'defectInstanceDataObj': [('checkerName', 's'), ('domain', 's'),
+        ('events', 'eventDataObj*'), ('function', 'functionInfoDataObj'),
+        ('id', 'defectInstanceIdDataObj'), ('impact', 's')],
+    'defectStateDataObj': [('action', 's'), ('classification', 's'),
+        ('comment', 's'), ('dateCreated', 'd'), ('owner', 's'),
+        ('severity', 's'), ('status', 's'), ('userCreated', 's')],
+    'streamDefectDataObj': [('action', 's'),
+        ('checkerSubcategoryId', 'checkerSubcategoryIdDataObj'), ('cid', 'l'),
+        ('classification', 's'),
+        ('defectInstances', 'defectInstanceDataObj*'),
+        ('history', 'defectStateDataObj*'), ('id', 'streamDefectIdDataObj'),
+        ('owner', 's'), ('severity', 's'), ('status', 's'),
+        ('streamId', 'streamIdDataObj')],
+    'defectChangeDataObj': [('actionChange', 'fieldChangeDataObj'),
+        ('affectedStreams', 'streamIdDataObj*'),
+        ('classificationChange', 'fieldChangeDataObj'), ('comments', 's'),
+        ('dateModified', 'd'), ('ownerChange', 'fieldChangeDataObj'),
+        ('severityChange', 'fieldChangeDataObj'),
+        ('statusChange', 'fieldChangeDataObj'), ('userModified', 's')],
+    'fileContentsDataObj': [('contents', 's'), ('fileId', 'fileIdDataObj')],
+    'projectTrendRecordFilterSpecDataObj': [('endDate', 'd'),
+        ('startDate', 'd')],
+    'projectTrendRecordDataObj': [('dismissedCount', 'i'),
+        ('fixedCount', 'i'), ('inspectedCount', 'i'), ('metricsDate', 'd'),
+        ('newCount', 'i'), ('outstandingCount', 'i'),
+        ('projectId', 'projectIdDataObj'), ('resolvedCount', 'i'),
+        ('totalCount', 'i'), ('triagedCount', 'i')],
+    'componentMetricsDataObj': [('componentId', 'componentIdDataObj'),
+        ('dismissedCount', 'i'), ('fixedCount', 'i'),
+        ('inspectedCount', 'i'), ('metricsDate', 'd'), ('newCount', 'i'),
+        ('outstandingCount', 'i'), ('resolvedCount', 'i'),
+        ('totalCount', 'i'), ('triagedCount', 'i')],
+    }
+
+_notify = ([('usernames', 's*'), ('subject', 's'), ('message', 's')], None)
+_users = ([('filterSpec', 'userFilterSpecDataObj'),
+           ('pageSpec', 'pageSpecDataObj')], 'usersPageDataObj')
+
+# The operations of each service: name -> (parameters, return type)
+OPERATIONS = {
+    'defect': {
+        'getMergedDefectsForStreams': ([('streamIds', 'streamIdDataObj*'),
+            ('filterSpec', 'mergedDefectFilterSpecDataObj'),
+            ('pageSpec', 'pageSpecDataObj')], 'mergedDefectsPageDataObj'),
+        'getStreamDefects': ([('cids', 'l*'),
+            ('filterSpec', 'streamDefectFilterSpecDataObj')],
+            'streamDefectDataObj*'),
+        'getMergedDefectHistory': ([('cid', 'l'), ('scopePattern', 's')],
+            'defectChangeDataObj*'),
+        'getFileContents': ([('streamId', 'streamIdDataObj'),
+            ('fileId', 'fileIdDataObj')], 'fileContentsDataObj'),
+        'getTrendRecordsForProject': ([('projectId', 'projectIdDataObj'),
+            ('filterSpec', 'projectTrendRecordFilterSpecDataObj')],
+            'projectTrendRecordDataObj*'),
+        'getComponentMetricsForProject': ([('projectId', 'projectIdDataObj'),
+            ('componentIds', 'componentIdDataObj*')],
+            'componentMetricsDataObj*'),
+        },
+    'configuration': {
+        'getStreams': ([('filterSpec', 'streamFilterSpecDataObj')],
+            'streamDataObj*'),
+        'getProjects': ([('filterSpec', 'projectFilterSpecDataObj')],
+            'projectDataObj*'),
+        'getUsers': _users,
+        'getSnapshotsForStream': ([('streamId', 'streamIdDataObj'),
+            ('filterSpec', 'snapshotFilterSpecDataObj')],
+            'snapshotIdDataObj*'),
+        'getSnapshotInformation': ([('snapshotIds', 'snapshotIdDataObj*')],
+            'snapshotInfoDataObj*'),
+        'getComponent': ([('componentId', 'componentIdDataObj')],
+            'componentDataObj'),
+        'getComponentMaps': ([('filterSpec', 'componentMapFilterSpecDataObj')],
+            'componentMapDataObj*'),
+        'getCheckerProperties': ([('filterSpec',
+            'checkerPropertyFilterSpecDataObj')], 'checkerPropertyDataObj*'),
+        'notify': _notify,
+        },
+    'administration': {
+        'getAssignableUsers': ([('pageSpec', 'pageSpecDataObj')],
+            'usersPageDataObj'),
+        'getUsers': _users,
+        'notify': _notify,
+        },
+    }
+
+def _many(t):
+    return t.endswith('*'), t.rstrip('*')
+
+def _element(name, t):
+    many, t = _many(t)
+    return '<xs:element name="%s" type="%s" minOccurs="0"%s/>' % (
+        name, _xsd_types.get(t, 'tns:' + t),
+        many and ' maxOccurs="unbounded"' or '')
+
+def wsdl(service, version, location):
+    '''
+    Returns the document/literal WSDL for a service.  Every service's schema
+    has all of the data objects, so any of them can be created with getDO().
+    '''
+    ns = 'http://ws.coverity.com/v%d' % (version,)
+    port = service[0].upper() + service[1:] + 'Service'
+    ops = sorted(OPERATIONS[service].items())
+    s = ['<?xml version="1.0" encoding="UTF-8"?>',
+         '<definitions name="%s" targetNamespace="%s" xmlns:tns="%s"'
+         ' xmlns:xs="http://www.w3.org/2001/XMLSchema"'
+         ' xmlns:soap="http://schemas.xmlsoap.org/wsdl/soap/"'
+         ' xmlns="http://schemas.xmlsoap.org/wsdl/">' % (port, ns, ns),
+         '<types><xs:schema targetNamespace="%s" version="1.0">' % (ns,)]
+    for name, fields in sorted(TYPES.items()):
+        s.append('<xs:complexType name="%s"><xs:sequence>' % (name,))
+        s.extend([_element(f, t) for f, t in fields])
+        s.append('</xs:sequence></xs:complexType>')
+    for op, (params, ret) in ops:
+        s.append('<xs:element name="%s" type="tns:%s"/>' % (op, op))
+        s.append('<xs:element name="%sResponse" type="tns:%sResponse"/>' % (op, op))
+        s.append('<xs:complexType name="%s"><xs:sequence>' % (op,))
+        s.extend([_element(p, t) for p, t in params])
+        s.append('</xs:sequence></xs:complexType>')
+        s.append('<xs:complexType name="%sResponse"><xs:sequence>' % (op,))
+        if ret:
+            s.append(_element('return', ret))
+        s.append('</xs:sequence></xs:complexType>')
+    s.append('</xs:schema></types>')
+    for op, _ in ops:
+        for msg in (op, op + 'Response'):
+            s.append('<message name="%s"><part name="parameters" element="tns:%s"/></message>'
+                     % (msg, msg))
+    s.append('<portType name="%s">' % (port,))
+    for op, _ in ops:
+        s.append('<operation name="%s"><input message="tns:%s"/>'
+                 '<output message="tns:%sResponse"/></operation>' % (op, op, op))
+    s.append('</portType>')
+    s.append('<binding name="%sBinding" type="tns:%s">'
+             '<soap:binding transport="http://schemas.xmlsoap.org/soap/http"'
+             ' style="document"/>' % (port, port))
+    for op, _ in ops:
+        s.append('<operation name="%s"><soap:operation soapAction=""/>'
+                 '<input><soap:body use="literal"/></input>'
+                 '<output><soap:body use="literal"/></output></operation>' % (op,))
+    s.append('</binding>')
+    s.append('<service name="%s"><port name="%sPort" binding="tns:%sBinding">'
+             '<soap:address location="%s"/></port></service>' % (port, port, port, location))
+    s.append('</definitions>')
+    return '\n'.join(s)
+
+def _localname(tag):
+    return tag.rsplit('}', 1)[-1]
+
+def _parse_date(text):
+    # suds sends e.g. 2012-03-04T05:06:07.123456-08:00; the fraction and
+    # timezone are ignored
+    return datetime.datetime.strptime(text[:19], '%Y-%m-%dT%H:%M:%S')
+
+_parsers = {'s': unicode, 'i': int, 'l': long, 'd': _parse_date,
+            'b': lambda x: x.strip() in ('true', '1')}
+
+def parse(elem, t):
+    '''
+    Convert an element of type t into Python values.  Data objects become
+    dicts.
+    '''
+    if t in TYPES:
+        fields = dict(TYPES[t])
+        value = {}
+        for child in elem:
+            name = _localname(child.tag)
+            if name not in fields:
+                continue
+            many, ft = _many(fields[name])
+            v = parse(child, ft)
+            if many:
+                value.setdefault(name, []).append(v)
+            else:
+                value[name] = v
+        return value
+    return _parsers[t](elem.text or '')
+
+def _format(value, t):
+    if t == 'b':
+        return value and 'true' or 'false'
+    if t == 'd':
+        return value.strftime('%Y-%m-%dT%H:%M:%S')
+    return escape(unicode(value))
+
+def emit(out, name, value, t):
+    '''
+    Append the XML for value, of type t, to the list out.
+    '''
+    many, t = _many(t)
+    if value is None:
+        return
+    if not many:
+        value = [value]
+    for v in value:
+        if t in TYPES:
+            out.append(u'<%s>' % (name,))
+            for f, ft in TYPES[t]:
+                emit(out, f, v.get(f), ft)
+            out.append(u'</%s>' % (name,))
+        else:
+            out.append(u'<%s>%s</%s>' % (name, _format(v, t), name))
+
+class Fault(Exception): pass
+
+def _pattern(p):
+    '''
+    CIM name patterns use "*" as a wildcard.
+    '''
+    return re.compile('^' + '.*'.join([re.escape(x) for x in (p or '*').split('*')]) + '$')
+
+class Dataset(object):
+    '''
+    A synthetic CIM database: projects of streams, each stream with a
+    series of daily snapshots, and defects which appear in one snapshot and
+    may be fixed in a later one.  Stream defects, source files and histories
+    are generated when they're asked for.
+    '''
+    checkers = [
+        ('NULL_RETURNS', 'STATIC_C', 'none', 'High', 'Null pointer dereferences'),
+        ('FORWARD_NULL', 'STATIC_C', 'none', 'High', 'Null pointer dereferences'),
+        ('RESOURCE_LEAK', 'STATIC_C', 'none', 'High', 'Resource leaks'),
+        ('UNINIT', 'STATIC_C', 'none', 'High', 'Uninitialized variables'),
+        ('OVERRUN', 'STATIC_C', 'none', 'High', 'Memory - illegal accesses'),
+        ('CHECKED_RETURN', 'STATIC_C', 'none', 'Medium', 'Error handling issues'),
+        ('DEADCODE', 'STATIC_C', 'none', 'Medium', 'Control flow issues'),
+        ('MISSING_BREAK', 'STATIC_C', 'none', 'Medium', 'Control flow issues'),
+        ('USE_AFTER_FREE', 'STATIC_C', 'none', 'High', 'Memory - illegal accesses'),
+        ('NEGATIVE_RETURNS', 'STATIC_C', 'none', 'Medium', 'Integer handling issues'),
+        ('NULL_RETURNS', 'STATIC_JAVA', 'none', 'Medium', 'Null pointer dereferences'),
+        ('RESOURCE_LEAK', 'STATIC_JAVA', 'none', 'High', 'Resource leaks'),
+        ]
+    statuses = ['New'] * 6 + ['Triaged'] * 3 + ['Dismissed']
+    severities = ['Unspecified', 'Major', 'Moderate', 'Minor']
+    classifications = ['Unclassified', 'Pending', 'Bug', 'Intentional', 'False Positive']
+    actions = ['Undecided', 'Fix Required', 'Fix Submitted', 'Ignore']
+    lines_per_file = 400
+
+    def __init__(self, defects=1000, projects=2, streams=4, users=50,
+                 components=8, files=None, snapshots=10, seed=0):
+        rnd = random.Random(seed)
+        self.seed = seed
+        self.users = ['user%d' % (i,) for i in range(users)]
+        self.components = ['Default.Other'] + ['Default.comp%d' % (i,)
+                                               for i in range(components)]
+        self.files = ['%s/src/file%d.c' % (self.components[i % len(self.components)].split('.')[1], i)
+                      for i in range(files or max(10, defects / 20))]
+        self._file_cache = {}
+
+        now = datetime.datetime.now().replace(microsecond=0)
+        self.projects = []
+        self.streams = {}
+        self.snapshots = {}
+        snapshot_id = 10000
+        for p in range(projects):
+            self.projects.append({'name': 'project%d' % (p,), 'key': p + 1,
+                                  'created': now - datetime.timedelta(days=365),
+                                  'streams': []})
+        for s in range(streams):
+            project = self.projects[s % projects]
+            name = '%s-stream%d' % (project['name'], s)
+            ids = []
+            for i in range(snapshots):
+                snapshot_id += 1
+                ids.append(snapshot_id)
+                self.snapshots[snapshot_id] = {
+                    'stream': name,
+                    'created': now - datetime.timedelta(days=snapshots - i)}
+            self.streams[name] = {'name': name, 'project': project['name'],
+                                  'snapshots': ids}
+            project['streams'].append(name)
+
+        stream_names = sorted(self.streams)
+        self.defects = []
+        for i in range(defects):
+            stream = self.streams[stream_names[i % len(stream_names)]]
+            checker = self.checkers[rnd.randrange(len(self.checkers))]
+            f = rnd.randrange(len(self.files))
+            first = rnd.randrange(snapshots)
+            # About a fifth of the defects are fixed in a later snapshot
+            fixed = snapshots
+            if first < snapshots - 1 and rnd.random() < 0.2:
+                fixed = rnd.randrange(first + 1, snapshots)
+            status = fixed < snapshots and 'Fixed' or rnd.choice(self.statuses)
+            function = 'function%d' % (rnd.randrange(50),)
+            owner = 'Unassigned'
+            if status != 'New' or rnd.random() < 0.5:
+                owner = rnd.choice(self.users)
+            created = self.snapshots[stream['snapshots'][first]]['created']
+            self.defects.append({
+                'cid': 10001 + i,
+                'stream': stream['name'],
+                'snapshots': stream['snapshots'][first:fixed],
+                'checkerName': checker[0],
+                'domain': checker[1],
+                'checkerSubcategory': checker[2],
+                'componentName': self._component(self.files[f]),
+                'file': f,
+                'filePathname': '/' + self.files[f],
+                'functionDisplayName': function + '()',
+                'functionName': function,
+                'firstDetected': created,
+                'lastDetected': self.snapshots[stream['snapshots'][fixed - 1]]['created'],
+                'lastTriaged': status in ('Triaged', 'Dismissed') and created or None,
+                'occurrenceCount': 1 + int(rnd.random() < 0.1),
+                'owner': owner,
+                'status': status,
+                'classification': (status == 'Dismissed' and 'False Positive'
+                                   or status == 'Triaged' and 'Bug'
+                                   or 'Unclassified'),
+                'severity': rnd.choice(self.severities),
+                'action': rnd.choice(self.actions),
+                })
+        self._by_cid = dict([(d['cid'], d) for d in self.defects])
+
+    def _component(self, path):
+        return 'Default.' + path.split('/')[0]
+
+    def defect(self, cid):
+        try:
+            return self._by_cid[cid]
+        except KeyError:
+            raise Fault('No defect with CID %s' % (cid,))
+
+    def file_contents(self, f):
+        '''
+        Returns (text, MD5) for file number f.
+        '''
+        try:
+            return self._file_cache[f]
+        except KeyError:
+            pass
+        rnd = random.Random('%s/%s' % (self.seed, f))
+        lines = []
+        for n in range(self.lines_per_file):
+            indent = '    ' * rnd.randrange(4)
+            lines.append('%sint v%d = compute(%d, p->field%d); /* line %d */'
+                         % (indent, n, rnd.randrange(1000), rnd.randrange(20), n + 1))
+        text = '\n'.join(lines) + '\n'
+        result = self._file_cache[f] = (text, hashlib.md5(text).hexdigest())
+        return result
+
+    def file_id(self, f):
+        return {'filePathname': '/' + self.files[f],
+                'contentsMD5': self.file_contents(f)[1]}
+
+    def matches(self, d, spec):
+        '''
+        Returns True if defect d passes the mergedDefectFilterSpecDataObj.
+        '''
+        for name, field in (('statusNameList', 'status'),
+                            ('severityNameList', 'severity'),
+                            ('classificationNameList', 'classification'),
+                            ('actionNameList', 'action'),
+                            ('ownerNameList', 'owner'),
+                            ('cidList', 'cid')):
+            if name in spec and d[field] not in spec[name]:
+                return False
+        if 'componentIdList' in spec:
+            listed = d['componentName'] in [c.get('name') for c in spec['componentIdList']]
+            if listed == bool(spec.get('componentIdExclude')):
+                return False
+        if 'firstDetectedStartDate' in spec and d['firstDetected'] < spec['firstDetectedStartDate']:
+            return False
+        if 'firstDetectedEndDate' in spec and d['firstDetected'] > spec['firstDetectedEndDate']:
+            return False
+        include = spec.get('streamSnapshotFilterSpecIncludeList')
+        if include and not [f for f in include if self._in_snapshots(d, f)]:
+            return False
+        exclude = spec.get('streamSnapshotFilterSpecExcludeList')
+        if exclude and [f for f in exclude if self._in_snapshots(d, f)]:
+            return False
+        return True
+
+    def _in_snapshots(self, d, f):
+        streams = [s.get('name') for s in f.get('streamId', [])]
+        if streams and d['stream'] not in streams:
+            return False
+        ids = [s.get('id') for s in f.get('snapshotIdIncludeList', [])]
+        if ids and not [i for i in ids if i in d['snapshots']]:
+            return False
+        ids = [s.get('id') for s in f.get('snapshotIdExcludeList', [])]
+        if [i for i in ids if i in d['snapshots']]:
+            return False
+        return True
+
+    def stream_defect(self, d, instances, history):
+        '''
+        Returns the streamDefectDataObj for defect d.
+        '''
+        rnd = random.Random(d['cid'])
+        sd = {
+            'id': {'defectTriageId': d['cid'], 'id': d['cid'], 'verNum': 1},
+            'cid': d['cid'],
+            'checkerSubcategoryId': {'checkerName': d['checkerName'],
+                'domain': d['domain'], 'subcategory': d['checkerSubcategory']},
+            'streamId': {'name': d['stream']},
+            }
+        for f in ('status', 'classification', 'action', 'severity', 'owner'):
+            sd[f] = d[f]
+        if instances and d['status'] != 'Fixed':
+            sd['defectInstances'] = []
+            for i in range(1 + int(rnd.random() < 0.1)):
+                fileId = self.file_id(d['file'])
+                line = rnd.randrange(1, self.lines_per_file - 10)
+                events = []
+                n = rnd.randrange(1, 6)
+                for e in range(n):
+                    main = e == n - 1
+                    # The details formats only show the events numbered 0,
+                    # so they render the source and checker of each event
+                    events.append({
+                        'eventNumber': 0, 'eventSet': 0,
+                        'eventKind': main and 'error' or 'path',
+                        'eventTag': main and d['checkerName'].lower() or 'cond_true',
+                        'eventDescription': main and 'Defect found in "%s".' % (d['functionName'],)
+                                            or 'Condition "v%d", taking true branch.' % (line,),
+                        'fileId': fileId, 'lineNumber': line, 'main': main})
+                    line += rnd.randrange(1, 3)
+                sd['defectInstances'].append({
+                    'id': {'id': d['cid'] * 10 + i},
+                    'checkerName': d['checkerName'], 'domain': d['domain'],
+                    'impact': 'Medium', 'events': events,
+                    'function': {'fileId': fileId,
+                        'functionDisplayName': d['functionDisplayName'],
+                        'functionMangledName': d['functionName'],
+                        'functionName': d['functionName']}})
+        if history:
+            sd['history'] = [dict(c, dateCreated=c['dateModified'], userCreated=c['userModified'])
+                             for c in self._history_states(d)]
+        return sd
+
+    def _history_states(self, d):
+        state = {'status': 'New', 'classification': 'Unclassified',
+                 'action': 'Undecided', 'severity': 'Unspecified',
+                 'owner': 'Unassigned', 'dateModified': d['firstDetected'],
+                 'userModified': 'admin', 'comment': None}
+        states = [dict(state)]
+        if d['owner'] != 'Unassigned' or d['status'] != 'New':
+            state.update(dict([(f, d[f]) for f in ('status', 'classification',
+                'action', 'severity', 'owner')]))
+            state['dateModified'] = d['firstDetected'] + datetime.timedelta(hours=1)
+            state['comment'] = 'Triaged'
+            states.append(dict(state))
+        return states
+
+    def history(self, d):
+        '''
+        Returns the defectChangeDataObj list for defect d.
+        '''
+        changes = []
+        prev = {}
+        for state in self._history_states(d):
+            change = {'dateModified': state['dateModified'],
+                      'userModified': state['userModified'],
+                      'comments': state['comment'],
+                      'affectedStreams': [{'name': d['stream']}]}
+            for f in ('status', 'classification', 'action', 'severity', 'owner'):
+                if prev.get(f) != state[f]:
+                    change[f + 'Change'] = {'fieldName': f, 'oldValue': prev.get(f),
+                                            'newValue': state[f]}
+            changes.append(change)
+            prev = state
+        return changes
+
+    def trend(self, project, start=None, end=None, days=30):
+        '''
+        Returns the daily projectTrendRecordDataObjs of a project.
+        '''
+        streams = self.projects_by_name()[project]['streams']
+        defects = [d for d in self.defects if d['stream'] in streams]
+        today = datetime.datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        records = []
+        for n in range(days, 0, -1):
+            date = today - datetime.timedelta(days=n)
+            if (start and date < start) or (end and date > end):
+                continue
+            r = self.counts([d for d in defects if d['firstDetected'] <= date])
+            r['metricsDate'] = date
+            r['projectId'] = {'name': project}
+            records.append(r)
+        return records
+
+    def counts(self, defects):
+        r = {'totalCount': len(defects)}
+        for name, statuses in (('newCount', ('New',)),
+                               ('outstandingCount', ('New', 'Triaged')),
+                               ('triagedCount', ('Triaged',)),
+                               ('dismissedCount', ('Dismissed',)),
+                               ('fixedCount', ('Fixed',)),
+                               ('resolvedCount', ('Dismissed', 'Fixed')),
+                               ('inspectedCount', ('Triaged', 'Dismissed'))):
+            r[name] = len([d for d in defects if d['status'] in statuses])
+        return r
+
+    def projects_by_name(self):
+        return dict([(p['name'], p) for p in self.projects])
+
+class Handlers(object):
+    '''
+    The implementations of the web service operations.  Each is called with
+    the parsed parameters as keyword arguments.
+    '''
+    def __init__(self, data):
+        self.data = data
+        self.notifications = []
+        self._lock = threading.Lock()
+
+    def _stream(self, name):
+        s = self.data.streams[name]
+        return {'id': {'name': name}, 'description': 'Stream ' + name,
+                'language': 'C/C++', 'primaryProjectId': {'name': s['project']},
+                'componentMapId': {'name': 'Default'}}
+
+    def _users_page(self, users, pageSpec):
+        start = pageSpec.get('startIndex', 0)
+        size = pageSpec.get('pageSize', 1000)
+        return {'totalNumberOfRecords': len(users),
+                'users': [{'username': u, 'email': u + '@example.com',
+                           'givenName': 'User', 'familyName': u,
+                           'disabled': False, 'locked': False}
+                          for u in users[start:start + size]]}
+
+    def getMergedDefectsForStreams(self, streamIds=(), filterSpec=None, pageSpec=None):
+        streams = set([s.get('name') for s in streamIds])
+        spec = filterSpec or {}
+        defects = [d for d in self.data.defects
+                   if d['stream'] in streams and self.data.matches(d, spec)]
+        page = pageSpec or {}
+        start = page.get('startIndex', 0)
+        size = page.get('pageSize', 1000)
+        if not page.get('sortAscending', False):
+            defects.reverse()
+        return {'totalNumberOfRecords': len(defects),
+                'mergedDefects': defects[start:start + size]}
+
+    def getStreamDefects(self, cids=(), filterSpec=None):
+        spec = filterSpec or {}
+        return [self.data.stream_defect(self.data.defect(cid),
+                                        spec.get('includeDefectInstances'),
+                                        spec.get('includeHistory'))
+                for cid in cids]
+
+    def getMergedDefectHistory(self, cid=None, scopePattern=None):
+        return self.data.history(self.data.defect(cid))
+
+    def getFileContents(self, streamId=None, fileId=None):
+        path = (fileId or {}).get('filePathname', '').lstrip('/')
+        try:
+            f = self.data.files.index(path)
+        except ValueError:
+            raise Fault('No file %s' % (path,))
+        text, md5 = self.data.file_contents(f)
+        return {'fileId': self.data.file_id(f),
+                'contents': base64.standard_b64encode(zlib.compress(text))}
+
+    def getTrendRecordsForProject(self, projectId=None, filterSpec=None):
+        name = (projectId or {}).get('name')
+        if name not in self.data.projects_by_name():
+            raise Fault('No project %s' % (name,))
+        spec = filterSpec or {}
+        return self.data.trend(name, spec.get('startDate'), spec.get('endDate'))
+
+    def getComponentMetricsForProject(self, projectId=None, componentIds=None):
+        name = (projectId or {}).get('name')
+        project = self.data.projects_by_name().get(name)
+        if project is None:
+            raise Fault('No project %s' % (name,))
+        components = self.data.components
+        if componentIds:
+            components = [c.get('name') for c in componentIds]
+        today = datetime.datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        records = []
+        for c in components:
+            r = self.data.counts([d for d in self.data.defects
+                                  if d['componentName'] == c and d['stream'] in project['streams']])
+            r['componentId'] = {'name': c}
+            r['metricsDate'] = today
+            records.append(r)
+        return records
+
+    def getStreams(self, filterSpec=None):
+        p = _pattern((filterSpec or {}).get('namePattern'))
+        return [self._stream(s) for s in sorted(self.data.streams) if p.match(s)]
+
+    def getProjects(self, filterSpec=None):
+        p = _pattern((filterSpec or {}).get('namePattern'))
+        return [{'id': {'name': x['name']}, 'projectKey': x['key'],
+                 'dateCreated': x['created'], 'description': 'Project ' + x['name'],
+                 'streams': [self._stream(s) for s in x['streams']]}
+                for x in self.data.projects if p.match(x['name'])]
+
+    def getUsers(self, filterSpec=None, pageSpec=None):
+        p = _pattern((filterSpec or {}).get('namePattern'))
+        return self._users_page([u for u in self.data.users if p.match(u)], pageSpec or {})
+
+    def getAssignableUsers(self, pageSpec=None):
+        return self._users_page(self.data.users, pageSpec or {})
+
+    def getSnapshotsForStream(self, streamId=None, filterSpec=None):
+        name = (streamId or {}).get('name')
+        if name not in self.data.streams:
+            raise Fault('No stream %s' % (name,))
+        spec = filterSpec or {}
+        ids = []
+        for i in self.data.streams[name]['snapshots']:
+            created = self.data.snapshots[i]['created']
+            if 'startDate' in spec and created < spec['startDate']:
+                continue
+            if 'endDate' in spec and created > spec['endDate']:
+                continue
+            ids.append({'id': i})
+        return ids
+
+    def getSnapshotInformation(self, snapshotIds=()):
+        info = []
+        for s in snapshotIds:
+            snapshot = self.data.snapshots.get(s.get('id'))
+            if snapshot is None:
+                raise Fault('No snapshot %s' % (s.get('id'),))
+            info.append({'snapshotId': {'id': s['id']}, 'dateCreated': snapshot['created'],
+                         'description': '', 'target': 'x86_64', 'version': '1.0',
+                         'buildTime': 60, 'analysisTime': 300})
+        return info
+
+    def _component(self, name):
+        rnd = random.Random(name)
+        return {'componentId': {'name': name},
+                'subscribers': rnd.sample(self.data.users, min(2, len(self.data.users)))}
+
+    def getComponent(self, componentId=None):
+        name = (componentId or {}).get('name')
+        if name not in self.data.components:
+            raise Fault('No component %s' % (name,))
+        return self._component(name)
+
+    def getComponentMaps(self, filterSpec=None):
+        p = _pattern((filterSpec or {}).get('namePattern'))
+        if not p.match('Default'):
+            return []
+        components = [self._component(c) for c in self.data.components]
+        return [{'componentMapId': {'name': 'Default'}, 'description': 'Default map',
+                 'components': components,
+                 'componentPathRules': [{'componentId': {'name': c}, 'pathPattern': c.split('.')[1] + '/.*'}
+                                        for c in self.data.components],
+                 'defectRules': [{'componentId': c['componentId'], 'owner': c['subscribers'][0]}
+                                 for c in components if c['subscribers']]}]
+
+    def getCheckerProperties(self, filterSpec=None):
+        spec = filterSpec or {}
+        result = []
+        for name, domain, subcategory, impact, category in self.data.checkers:
+            if (name not in spec.get('checkerNameList', [name])
+                or domain not in spec.get('domainList', [domain])
+                or subcategory not in spec.get('subcategoryList', [subcategory])):
+                continue
+            result.append({
+                'checkerSubcategoryId': {'checkerName': name, 'domain': domain,
+                                         'subcategory': subcategory},
+                'category': category, 'categoryDescription': category,
+                'impact': impact, 'impactDescription': impact,
+                'cweCategory': '476',
+                'subcategoryLocalEffect': 'The program may crash.',
+                'subcategoryShortDescription': '%s defect' % (name.replace('_', ' ').lower(),),
+                'subcategoryLongDescription': ('%s finds %s.  ' % (name, category.lower())) * 5})
+        return result
+
+    def notify(self, usernames=(), subject=None, message=None):
+        with self._lock:
+            for u in usernames:
+                self.notifications.append((u, subject, len(message or '')))
+
+def to_suds(value, t):
+    '''
+    Convert a handler's result of type t into suds objects, like suds
+    unmarshalling a response.  Missing fields are left unset.
+    '''
+    many, t = _many(t)
+    if value is None:
+        return None
+    if many:
+        return [to_suds(v, t) for v in value]
+    if t not in TYPES:
+        return t == 's' and Text(value) or value
+    obj = Factory.object(t)
+    for f, ft in TYPES[t]:
+        v = value.get(f)
+        if v is not None:
+            setattr(obj, f, to_suds(v, ft))
+    return obj
+
+def to_plain(value, t):
+    '''
+    Convert a parameter of type t from suds objects into what the handlers
+    expect, like marshalling a request: unset fields and empty lists are
+    left out, and single values given for lists are wrapped in a list.
+    '''
+    many, t = _many(t)
+    if value is None:
+        return None
+    if many:
+        if not isinstance(value, (list, tuple)):
+            value = [value]
+        return [to_plain(v, t) for v in value]
+    if t not in TYPES:
+        return value
+    d = {}
+    for f, ft in TYPES[t]:
+        v = to_plain(getattr(value, f, None), ft)
+        if v is not None and v != []:
+            d[f] = v
+    return d
+
+class LocalService(object):
+    '''
+    One service of a LocalClient.  Like a CoverityWebServiceClient, service
+    methods are called as attributes, and data objects are made with
+    getDO().
+    '''
+    def __init__(self, handlers, service, url):
+        self._handlers = handlers
+        self._service = service
+        self.url = url
+        self.pageSpecDO = self.getDO('pageSpecDataObj', pageSize=1000,
+                                     sortAscending=False, startIndex=0)
+
+    def __getattr__(self, name):
+        try:
+            params, ret = OPERATIONS[self._service][name]
+        except KeyError:
+            raise AttributeError(name)
+        method = getattr(self._handlers, name)
+        def call(*args):
+            kw = {}
+            for (p, t), a in zip(params, args):
+                a = to_plain(a, t)
+                if a is not None:
+                    kw[p] = a
+            result = method(**kw)
+            if ret:
+                return to_suds(result, ret)
+        return call
+
+    def getDO(self, DO_type, **kw):
+        obj = Factory.object(DO_type)
+        for f, t in TYPES[DO_type]:
+            setattr(obj, f, t.endswith('*') and [] or None)
+        for k, v in kw.items():
+            setattr(obj, k, v)
+        return obj
+
+    def create_url(self, cid, project_id, streamId=None, defectInstance=None,
+                   fileInstance=None):
+        return self.url + '/sourcebrowser.htm?' + urllib.urlencode(
+            [('projectId', str(project_id)), ('mergedDefectId', str(cid))])
+
+class LocalClient(object):
+    '''
+    A client for a Dataset which calls the handlers in-process, with the
+    interface of coverity.ws.CoverityServiceClient for API version 4.  It
+    lets coverity.ws be used on the dataset without HTTP or SOAP, for
+    benchmarking the code which processes the results.
+    '''
+    def __init__(self, data, url='http://fakecim:8080'):
+        self.url = url
+        self.name = url.split('//', 1)[1]
+        self.handlers = Handlers(data)
+        self.defect = LocalService(self.handlers, 'defect', url)
+        self.config = LocalService(self.handlers, 'configuration', url)
+
+class FakeCIM(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''
+    The HTTP server.  "latency" is the delay in seconds before every
+    response, and method_latency maps method names to additional delays.
+    '''
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, data, host='localhost', port=0, latency=0.0,
+                 method_latency=None, log=False):
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), _RequestHandler)
+        self.handlers = Handlers(data)
+        self.latency = latency
+        self.method_latency = method_latency or {}
+        self.log = log
+        self.calls = {}
+        self._lock = threading.Lock()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        '''
+        Serve requests on a background thread.
+        '''
+        t = threading.Thread(target=self.serve_forever, name='fakecim')
+        t.daemon = True
+        t.start()
+        return self
+
+    def call(self, service, op, body):
+        '''
+        Run a SOAP operation, and return the response body XML.
+        '''
+        try:
+            params, ret = OPERATIONS[service][op]
+        except KeyError:
+            raise Fault('Unknown operation %s in %s service' % (op, service))
+        with self._lock:
+            self.calls[op] = self.calls.get(op, 0) + 1
+        types = dict(params)
+        kw = {}
+        for child in body:
+            name = _localname(child.tag)
+            if name in types:
+                many, t = _many(types[name])
+                v = parse(child, t)
+                if many:
+                    kw.setdefault(name, []).append(v)
+                else:
+                    kw[name] = v
+        result = getattr(self.handlers, op)(**kw)
+        delay = self.latency + self.method_latency.get(op, 0.0)
+        if delay:
+            time.sleep(delay)
+        out = []
+        if ret:
+            emit(out, 'return', result, ret)
+        return u''.join(out)
+
+    def summary(self):
+        s = ['%-32s %8d' % x for x in sorted(self.calls.items())]
+        s.append('%d notifications sent' % (len(self.handlers.notifications),))
+        return '\n'.join(s)
+
+_envelope = (u'<?xml version="1.0" encoding="UTF-8"?>'
+    u'<S:Envelope xmlns:S="http://schemas.xmlsoap.org/soap/envelope/"><S:Body>%s'
+    u'</S:Body></S:Envelope>')
+
+class _RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    _path = re.compile(r'^/ws/v(\d+)/(defect|configuration|administration)service')
+
+    def _reply(self, code, body, content_type='text/xml; charset=utf-8'):
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        m = self._path.match(self.path)
+        if not m or not self.path.endswith('?wsdl'):
+            self._reply(404, 'Not found', 'text/plain')
+            return
+        location = 'http://%s%s' % (self.headers.get('Host'), self.path.split('?')[0])
+        self._reply(200, wsdl(m.group(2), int(m.group(1)), location))
+
+    def do_POST(self):
+        m = self._path.match(self.path)
+        if not m:
+            self._reply(404, 'Not found', 'text/plain')
+            return
+        request = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            envelope = ElementTree.fromstring(request)
+            body = [e for e in envelope if _localname(e.tag) == 'Body'][0][0]
+            op = _localname(body.tag)
+            result = self.server.call(m.group(2), op, body)
+        except Fault, e:
+            self._reply(500, _envelope % (u'<S:Fault><faultcode>S:Server</faultcode>'
+                        u'<faultstring>%s</faultstring></S:Fault>' % (escape(unicode(e)),)))
+            return
+        self._reply(200, _envelope % (u'<ns2:%sResponse xmlns:ns2="http://ws.coverity.com/v%s">%s</ns2:%sResponse>'
+                                      % (op, m.group(1), result, op)))
+
+    def log_message(self, format, *args):
+        if self.server.log:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+def main():
+    p = optparse.OptionParser(usage='%prog [options]')
+    p.add_option("--host", dest="host", default="localhost",
+        help="Address to listen on (default localhost)")
+    p.add_option("--port", dest="port", type=int, default=8080,
+        help="Port to listen on (default 8080)")
+    p.add_option("--defects", dest="defects", type=int, default=1000,
+        help="Number of defects (default 1000)")
+    p.add_option("--projects", dest="projects", type=int, default=2,
+        help="Number of projects (default 2)")
+    p.add_option("--streams", dest="streams", type=int, default=4,
+        help="Number of streams, shared among the projects (default 4)")
+    p.add_option("--users", dest="users", type=int, default=50,
+        help="Number of users (default 50)")
+    p.add_option("--snapshots", dest="snapshots", type=int, default=10,
+        help="Number of snapshots in each stream (default 10)")
+    p.add_option("--seed", dest="seed", type=int, default=0,
+        help="Seed for generating the dataset (default 0)")
+    p.add_option("--latency", dest="latency", type=float, default=0.0,
+        help="Seconds to wait before every response (default 0)")
+    p.add_option("--method-latency", dest="method_latency", action="append",
+        default=[], help="Additional delay for one method, as METHOD=SECONDS."
+        "  May be given more than once.")
+    p.add_option("--log", dest="log", action="store_true", default=False,
+        help="Log each request")
+    options, args = p.parse_args()
+
+    method_latency = {}
+    for x in options.method_latency:
+        try:
+            name, delay = x.split('=', 1)
+            method_latency[name] = float(delay)
+        except ValueError:
+            p.error('Invalid --method-latency "%s"' % (x,))
+
+    start = time.time()
+    data = Dataset(defects=options.defects, projects=options.projects,
+                   streams=options.streams, users=options.users,
+                   snapshots=options.snapshots, seed=options.seed)
+    server = FakeCIM(data, options.host, options.port, options.latency,
+                     method_latency, options.log)
+    print 'Generated %d defects in %.1fs; serving on http://%s:%d/' % (
+        len(data.defects), time.time() - start, options.host, server.port)
+    sys.stdout.flush()
+
+    # Print the summary when stopped with kill, too.  Background jobs
+    # started from a script ignore SIGINT, so set that up as well.
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print server.summary()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,324 @@
+#!python
+'''
+Time the parts of a report run which don't wait for the server, over
+synthetic defects: rendering with each of templates.available_formats,
+defect_counts(), CSVTemplate field resolution, SourceFile.snippet(),
+grouping the defects by recipient as run_report() does, and the
+ROICalculator.
+
+The defects come from the dataset of benchmarks/fakecim.py, through its
+in-process LocalClient, as the same suds objects and ws.DefectHandlers a
+real run uses.  The caches of source files, checker descriptions and
+components are filled before timing, so only the processing is measured.
+To keep memory in check with large sizes, the defects share a pool of
+stream defects (instances and events); even so, allow roughly 10KB per
+defect.
+
+Each size runs in a separate process.  Every benchmark is run "--repeat"
+times, and the best time gives the throughput.  Peak memory is the
+highest resident size seen while the benchmark ran, sampled every 10ms,
+and is given with the resident size before it started.  For example::
+
+    python benchmarks/hotpaths.py --sizes 1000,100000 --output results.json
+    python benchmarks/hotpaths.py --benchmarks template:details,snippet
+
+The results are written as JSON, and summarized on stderr.
+'''
+import os
+import sys
+import json
+import time
+import random
+import datetime
+import optparse
+import platform
+import threading
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fakecim
+
+from coverity import ws
+from coverity import email
+from coverity import templates
+from coverity import memprofile
+from coverity.roi import ROICalculator, numstr
+
+class PeakSampler(object):
+    '''
+    Samples the resident memory size on a background thread, to find the
+    peak while something runs.
+    '''
+    interval = 0.01
+
+    def __init__(self):
+        self.start_rss = memprofile._rss()[0]
+        self.peak_rss = self.start_rss
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._sample, name='sampler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _sample(self):
+        while not self._done.is_set():
+            rss = memprofile._rss()[0]
+            if rss is not None and rss > self.peak_rss:
+                self.peak_rss = rss
+            self._done.wait(self.interval)
+
+    def stop(self):
+        self._done.set()
+        self._thread.join()
+        self._sample()
+        return self.start_rss, self.peak_rss
+
+class Fixture(object):
+    '''
+    The synthetic defects for one size, and what the benchmarks need to
+    process them.
+    '''
+    # Number of distinct stream defects shared by the defects
+    pool = 1000
+
+    def __init__(self, size, seed=0):
+        data = fakecim.Dataset(defects=size, files=min(max(10, size / 20), 1000),
+                               seed=seed)
+        self.client = fakecim.LocalClient(data)
+        self.size = size
+
+        with ws.using(self.client):
+            f = self.client.defect.getDO('streamDefectFilterSpecDataObj',
+                includeDefectInstances=True, includeHistory=True)
+            pool = self.client.defect.getStreamDefects(
+                [d['cid'] for d in data.defects[:self.pool]], f)
+            for sd in pool:
+                # Fixed defects have no instances
+                if not hasattr(sd, 'defectInstances'):
+                    sd.defectInstances = []
+
+            # Convert the defects in place, so the dicts can be freed as
+            # we go
+            for i, d in enumerate(data.defects):
+                data.defects[i] = fakecim.to_suds(d, 'mergedDefectDataObj')
+            self.records = data.defects
+            data.defects = data._by_cid = None
+
+            self.defects = [ws.DefectHandler(md, projectId=1, streamDefectDO=pool[i % len(pool)])
+                            for i, md in enumerate(self.records)]
+
+            # Fill the caches of things fetched while rendering
+            for sd in pool:
+                ws.CheckerDescription(sd.checkerSubcategoryId)
+                for inst in sd.defectInstances:
+                    ws.SourceFile(sd.streamId, inst.function.fileId)
+            for c in data.components:
+                ws.Component(c)
+
+        self.components = data.components
+        self.seed = seed
+        self._metrics = {}
+        self.options = optparse.Values({'raw': False, 'title': None,
+            'field': 'checkerName', 'stack_field': 'classification'})
+
+    def metrics(self, kind):
+        '''
+        Returns "size" metrics records of kind 'projectTrendRecordDataObj' or
+        'componentMetricsDataObj', creating them on first use.
+        '''
+        try:
+            return self._metrics[kind]
+        except KeyError:
+            pass
+        now = datetime.datetime.now().replace(second=0, microsecond=0)
+        rnd = random.Random(self.seed)
+        records = []
+        for i in range(self.size):
+            r = dict([(f, rnd.randrange(1000)) for f in ('totalCount', 'newCount',
+                'outstandingCount', 'resolvedCount', 'dismissedCount', 'fixedCount',
+                'inspectedCount', 'triagedCount')])
+            if kind == 'componentMetricsDataObj':
+                r['componentId'] = {'name': self.components[i % len(self.components)]}
+                r['metricsDate'] = now
+            else:
+                r['projectId'] = {'name': 'project0'}
+                r['metricsDate'] = now - datetime.timedelta(minutes=i)
+            records.append(fakecim.to_suds(r, kind))
+        self._metrics[kind] = records
+        return records
+
+def template_benchmark(name):
+    render = templates.available_formats[name]
+    def prepare(fx):
+        if 'compmetrics' in name:
+            return fx.metrics('componentMetricsDataObj')
+        elif 'metrics' in name:
+            return fx.metrics('projectTrendRecordDataObj')
+        return fx.defects
+    def run(fx):
+        records = prepare(fx)
+        # Render from scratch each time
+        ws._cache.get('fragments', {}).clear()
+        render(options=fx.options, defects=records, intro='Benchmark')
+        return len(records)
+    run.prepare = prepare
+    return run
+
+def bench_defect_counts(fx):
+    templates.defect_counts(fx.defects, 'componentName', 'classification')
+    templates.defect_counts(fx.defects, 'checkerName', 'status')
+    return len(fx.defects)
+
+def bench_csv_resolve(fx):
+    csv = templates.available_formats['csv']
+    resolve = csv._resolve
+    fields = csv._fields
+    for d in fx.defects:
+        for field in fields:
+            resolve(d, field)
+    return len(fx.defects)
+
+def bench_snippet(fx):
+    n = 0
+    for d in fx.defects:
+        for inst in d.defectInstances:
+            src = ws.SourceFile(d.streamId, inst.function.fileId)
+            for event in inst.events:
+                src.snippet(event.lineNumber, caption=event.eventDescription)
+                n += 1
+    return n
+
+def group_benchmark(reporter_class):
+    def run(fx):
+        reporter = reporter_class(fx.client)
+        email.group_recipients(fx.records, reporter, unassigned_to='admin')
+        return len(fx.records)
+    return run
+
+def bench_roi(fx):
+    calc = ROICalculator()
+    for i in xrange(fx.size):
+        numstr(calc.value(i)[1])
+    return fx.size
+
+benchmarks = [('template:' + name, template_benchmark(name))
+              for name in sorted(templates.available_formats)]
+benchmarks += [
+    ('defect_counts', bench_defect_counts),
+    ('csv_resolve', bench_csv_resolve),
+    ('snippet', bench_snippet),
+    ('group:subscribers', group_benchmark(email.SubscriberReporter)),
+    ('group:console', group_benchmark(email.ConsoleReporter)),
+    ('roi', bench_roi),
+    ]
+
+def selected(names):
+    '''
+    Returns the benchmarks named in the comma-separated list names.  A name
+    ending in ":" selects all the benchmarks with that prefix.
+    '''
+    if not names:
+        return benchmarks
+    wanted = names.split(',')
+    return [(name, func) for name, func in benchmarks
+            if name in wanted or [w for w in wanted if w.endswith(':') and name.startswith(w)]]
+
+def run_size(size, names, repeat, seed):
+    '''
+    Run the benchmarks for one size in this process, and return the results.
+    '''
+    sampler = PeakSampler()
+    start = time.time()
+    fx = Fixture(size, seed)
+    setup = time.time() - start
+    start_rss, peak_rss = sampler.stop()
+    results = [{'benchmark': 'setup', 'size': size, 'items': size,
+                'seconds': setup, 'start_rss': start_rss, 'peak_rss': peak_rss}]
+
+    with ws.using(fx.client):
+        for name, func in selected(names):
+            # Anything the benchmark needs which isn't shared is set up
+            # before timing
+            if hasattr(func, 'prepare'):
+                func.prepare(fx)
+            times = []
+            sampler = PeakSampler()
+            try:
+                for i in range(repeat):
+                    start = time.time()
+                    items = func(fx)
+                    times.append(time.time() - start)
+            finally:
+                start_rss, peak_rss = sampler.stop()
+            best = min(times)
+            results.append({'benchmark': name, 'size': size, 'items': items,
+                            'seconds': best, 'mean_seconds': sum(times) / len(times),
+                            'throughput': best and items / best or None,
+                            'start_rss': start_rss, 'peak_rss': peak_rss})
+    return results
+
+def main():
+    p = optparse.OptionParser(usage='%prog [options]')
+    p.add_option("--sizes", dest="sizes", default="1000,10000,100000",
+        help="Comma-separated numbers of defects (default 1000,10000,100000)")
+    p.add_option("--benchmarks", dest="benchmarks", default=None,
+        help="Comma-separated benchmarks to run (default all).  A name "
+        "ending in \":\" selects those starting with it, like \"template:\"")
+    p.add_option("--repeat", dest="repeat", type=int, default=3,
+        help="Times to run each benchmark (default 3)")
+    p.add_option("--seed", dest="seed", type=int, default=0,
+        help="Seed for generating the defects (default 0)")
+    p.add_option("--output", dest="output", default=None,
+        help="Write the JSON results to this file rather than stdout")
+    p.add_option("--list", dest="list", action="store_true", default=False,
+        help="List the benchmarks and exit")
+    p.add_option("--child", dest="child", type=int, default=None,
+        help=optparse.SUPPRESS_HELP)
+    options, args = p.parse_args()
+
+    if options.list:
+        for name, func in benchmarks:
+            print name
+        return
+
+    if options.child is not None:
+        json.dump(run_size(options.child, options.benchmarks, options.repeat,
+                           options.seed), sys.stdout)
+        return
+
+    if not selected(options.benchmarks):
+        p.error('No benchmarks match "%s"' % (options.benchmarks,))
+
+    results = []
+    sys.stderr.write('%-28s %9s %10s %14s %10s %10s\n' % (
+        'benchmark', 'size', 'seconds', 'items/s', 'rss', 'peak'))
+    for size in [int(x) for x in options.sizes.split(',')]:
+        cmd = [sys.executable, os.path.abspath(__file__), '--child', str(size),
+               '--repeat', str(options.repeat), '--seed', str(options.seed)]
+        if options.benchmarks:
+            cmd += ['--benchmarks', options.benchmarks]
+        child = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        out = child.communicate()[0]
+        if child.returncode:
+            sys.exit('Benchmarks for size %d failed' % (size,))
+        for r in json.loads(out):
+            sys.stderr.write('%-28s %9d %10.3f %14s %10s %10s\n' % (
+                r['benchmark'], r['size'], r['seconds'],
+                r.get('throughput') and '%.0f' % (r['throughput'],) or '',
+                memprofile._human(r['start_rss']), memprofile._human(r['peak_rss'])))
+            results.append(r)
+
+    report = {'python': platform.python_version(), 'platform': platform.platform(),
+              'time': datetime.datetime.now().isoformat(), 'repeat': options.repeat,
+              'seed': options.seed, 'results': results}
+    if options.output:
+        f = open(options.output, 'w')
+        try:
+            json.dump(report, f, indent=1)
+        finally:
+            f.close()
+    else:
+        json.dump(report, sys.stdout, indent=1)
+        print
+
+if __name__ == '__main__':
+    main()
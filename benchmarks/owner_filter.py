@@ -0,0 +1,78 @@
+#!python
+'''
+Compare the owner filtering strategies of ws.OptionsProcessor against a CIM
+server: sending the owner list with every page request ("server"), or
+fetching the defects for any owner and filtering them locally ("local").
+
+For each strategy this reports the size of the request envelopes, the
+number of requests and records fetched, and the time taken.  It accepts
+the usual connection and filter options, plus "--repeat".  For example::
+
+    python benchmarks/owner_filter.py --host cim --port 8080 --user admin \\
+        --project MyProject --repeat 3
+'''
+import sys
+import time
+import copy
+
+from suds.plugin import MessagePlugin
+
+from coverity import ws
+
+class EnvelopeSizes(MessagePlugin):
+    '''
+    Records the size of each request envelope sent.
+    '''
+    def __init__(self):
+        self.sizes = []
+
+    def sending(self, context):
+        self.sizes.append(len(context.envelope))
+
+def run(options, strategy, sizes):
+    o = copy.copy(options)
+    o.owner_filter = strategy
+    start = time.time()
+    scope = ws.OptionsProcessor(o, ws.client)
+    del sizes.sizes[:]
+    page = ws.DefectReporter(ws.client).defects(scope)
+    elapsed = time.time() - start
+    return {
+        'requests': len(sizes.sizes),
+        'bytes': sum(sizes.sizes),
+        'largest': max(sizes.sizes or [0]),
+        'records': page.totalNumberOfRecords,
+        'seconds': elapsed,
+        }
+
+def main():
+    p = ws.WSOpts().get_common_opts()
+    p.add_option("--repeat", dest="repeat", type=int, default=3,
+        help="Times to run each strategy (default 3)")
+    try:
+        options, args = p.parse_args()
+    except ws.WSOpts.ValidationError, e:
+        sys.stderr.write(str(e)+'\n\n')
+        p.print_help()
+        sys.exit(-1)
+
+    ws.client.connect(api_version=4, options=options)
+    sizes = EnvelopeSizes()
+    ws.client.defect.client.set_options(
+        plugins=ws.client.defect.client.options.plugins + [sizes])
+
+    # Fetch the users once up front, so both strategies start with them
+    # cached
+    users = ws.OptionsProcessor(options, ws.client).assignable_users(ws.client)
+    print '%d assignable users' % (len(users),)
+
+    print '%-8s %8s %12s %12s %8s %8s' % (
+        'strategy', 'requests', 'bytes', 'largest', 'records', 'seconds')
+    for strategy in ('server', 'local'):
+        for i in range(options.repeat):
+            r = run(options, strategy, sizes)
+            print '%-8s %8d %12d %12d %8d %8.2f' % (strategy, r['requests'],
+                r['bytes'], r['largest'], r['records'], r['seconds'])
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,32 @@
+import os
 import sys
+import copy
+import threading
+import datetime
+import traceback
+from cStringIO import StringIO
+from multiprocessing.pool import ThreadPool
 import re
+import itertools
+import multiprocessing
+import cPickle as pickle
+from array import array
 
 # Pull in the standard Coverity WS module
 from coverity import ws
+from coverity.ws import cassette
+from coverity import tracing
+from coverity import memprofile
 
 # The templates to be used for the email
 from coverity import templates
 from coverity.templates import render_subject, render_intro
 
+# Delivery helpers
+from coverity.email import delivery
+from coverity.email import daemon
+from coverity.email import estimate
+
 ###########################################################
 # Some helper classes
 
@@ -124,6 +143,169 @@ class OwnerReporter(ws.DefectReporter):
                 except:
                     pass
 
+class DefectTable(object):
+    '''
+    The defect records found for a report, shared by every recipient.
+    Recipients refer to defects by their row in the table, so grouping only
+    stores a compact array of integers per recipient.  The objects used by
+    the templates (ws.DefectHandler for defect reports) are only created when
+    a report is rendered, and only once per defect.
+    '''
+    def __init__(self, records, make_defect):
+        self._records = records
+        self._make_defect = make_defect
+        self._defects = {}
+
+    def __len__(self):
+        return len(self._records)
+
+    def record(self, row):
+        return self._records[row]
+
+    def records(self, rows):
+        return [self._records[row] for row in rows]
+
+    def defects(self, rows):
+        '''
+        Returns the template objects for rows, creating them if necessary.
+        '''
+        ret = []
+        for row in rows:
+            try:
+                defect = self._defects[row]
+            except KeyError:
+                defect = self._make_defect(self._records[row])
+                self._defects[row] = defect
+            ret.append(defect)
+        return ret
+
+class ReportState(object):
+    '''
+    Persisted fingerprints of the reports sent to each recipient, so that a
+    scheduled run can skip recipients whose report hasn't changed.  The
+    state file holds the reports for several scopes (see scope_key()), so
+    different report configurations can share it.  It's loaded once per
+    run, the reports running at the same time each use the ScopeState of
+    their scope, and it's saved once they've finished.
+    '''
+    def __init__(self, filename):
+        self._filename = filename
+        self._lock = threading.Lock()
+        try:
+            f = open(filename, 'rb')
+            try:
+                self._scopes = pickle.load(f)
+            finally:
+                f.close()
+        except (IOError, EOFError, pickle.UnpicklingError):
+            self._scopes = {}
+
+    def scope(self, key):
+        '''
+        Returns the ScopeState for the scope "key".
+        '''
+        with self._lock:
+            return ScopeState(self._scopes.setdefault(key, {}), self._lock)
+
+    # Options which select the defects in a report, besides its scope
+    filter_options = ('snapshot_op', 'base_snapshot', 'status', 'severity',
+                      'classification', 'days', 'component', 'componentExclude',
+                      'unassigned', 'unassigned_to')
+
+    @classmethod
+    def scope_key(cls, options):
+        '''
+        Returns the key identifying the report configuration in "options".
+        Reports with different filters are recorded separately.
+        '''
+        key = '/'.join([str(x) for x in (options.host, options.port,
+            options.reporter, options.format, options.project,
+            options.stream, options.snapshot)])
+        if options.instances:
+            key += '/' + options.instances
+        key += '?' + '&'.join(['%s=%s' % (o, getattr(options, o, None))
+                               for o in cls.filter_options])
+        return key
+
+    def save(self):
+        with self._lock:
+            tmp = self._filename + '.tmp'
+            f = open(tmp, 'wb')
+            try:
+                pickle.dump(self._scopes, f, pickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+            try:
+                os.rename(tmp, self._filename)
+            except OSError:
+                # Windows won't rename over an existing file
+                os.remove(self._filename)
+                os.rename(tmp, self._filename)
+
+class ScopeState(object):
+    '''
+    The reports recorded in a ReportState for one scope.  Each report is
+    recorded as a mapping of CID to the defect fields that matter to the
+    recipient.
+    '''
+    # Defect fields that make a report "changed" when they change
+    fields = ('status', 'owner', 'classification', 'action', 'severity')
+
+    def __init__(self, reports, lock):
+        self._reports = reports
+        self._lock = lock
+
+    @staticmethod
+    def defect_key(defect):
+        '''
+        Returns the key for defect in a recorded report.  That's the CID, or
+        with "--instances", the CID qualified by the defect's instance.
+        '''
+        try:
+            return '%s/%s' % (defect.instance, defect.cid)
+        except AttributeError:
+            return defect.cid
+
+    def fingerprint(self, defect):
+        return u'|'.join([unicode(getattr(defect, f, '')) for f in self.fields])
+
+    def delta(self, user, defects):
+        '''
+        Returns the defects that are new or changed since the last report
+        recorded for user.
+        '''
+        prev = self._reports.get(user, {})
+        return [d for d in defects if prev.get(self.defect_key(d)) != self.fingerprint(d)]
+
+    def changed(self, user, defects):
+        '''
+        Returns True if the report for user differs from the one recorded.
+        '''
+        prev = self._reports.get(user)
+        if prev is None or len(prev) != len(defects):
+            return True
+        return bool(self.delta(user, defects))
+
+    def retain(self, users):
+        '''
+        Forget any recipients not in users, since they no longer have any
+        defects to report.
+        '''
+        users = set(users)
+        with self._lock:
+            for user in self._reports.keys():
+                if user not in users:
+                    del self._reports[user]
+
+    def record_all(self, reports):
+        '''
+        Record the reports in "reports", a mapping of recipient to defects.
+        '''
+        reports = dict([(user, dict([(self.defect_key(d), self.fingerprint(d)) for d in defects]))
+                        for user, defects in reports.items()])
+        with self._lock:
+            self._reports.update(reports)
+
 class MyOptionParser(object):
     '''
     Class to manage this script's command-line options.  We start with the
@@ -147,6 +329,35 @@ class MyOptionParser(object):
         self._p.add_option("--title", dest="title", default=None, help="Title for chart")
         self._p.add_option("--raw", action='store_true', dest="raw", help="Exclude headers in CSV output")
         self._p.add_option("--quiet", action='store_true', dest="quiet", help="Exclude unnecessary script output.")
+        self._p.add_option("--send-workers", dest="send_workers", type=int, default=1, help="Maximum number of notifications to send at once (default 1)")
+        self._p.add_option("--send-retries", dest="send_retries", type=int, default=2, help="Retries for notifications that fail with a transient error (default 2)")
+        self._p.add_option("--send-backoff", dest="send_backoff", type=float, default=1.0, help="Seconds to wait before the first retry; doubled for each later retry (default 1)")
+        self._p.add_option("--delivery", dest="delivery", default='cim', help="How to deliver reports (cim,smtp)")
+        self._p.add_option("--smtp-host", dest="smtp_host", default='localhost', help="SMTP server for --delivery smtp")
+        self._p.add_option("--smtp-port", dest="smtp_port", type=int, default=25, help="SMTP server port")
+        self._p.add_option("--smtp-from", dest="smtp_from", default=None, help="Sender address for --delivery smtp")
+        self._p.add_option("--smtp-domain", dest="smtp_domain", default=None, help="Domain appended to CIM usernames to form email addresses; required with \"--delivery smtp\"")
+        self._p.add_option("--smtp-user", dest="smtp_user", default=None, help="SMTP login user")
+        self._p.add_option("--smtp-password", dest="smtp_password", default=None, help="SMTP login password")
+        self._p.add_option("--smtp-starttls", action='store_true', dest="smtp_starttls", default=False, help="Use STARTTLS with the SMTP server")
+        self._p.add_option("--state-file", dest="state_file", default=None, help="Remember the reports sent in this file, and skip recipients whose report hasn't changed")
+        self._p.add_option("--send-changes", dest="send_changes", default='full', help="With --state-file, send changed recipients their full report or only the new and changed defects (full,delta)")
+        self._p.add_option("--job", action="append", dest="jobs", default=[], help="Run a report job, given as dest:format[:output] (may be repeated).  All jobs share one defect query.")
+        self._p.add_option("--output", dest="output", default=None, help="Write console output to this file instead of stdout.  \"%(scope)s\" is replaced by the project or stream name.")
+        self._p.add_option("--projects", dest="projects", default='', help="Run the reports for each of these projects (comma-separated)")
+        self._p.add_option("--streams", dest="streams", default='', help="Run the reports for each of these streams (comma-separated)")
+        self._p.add_option("--parallel", dest="parallel", type=int, default=4, help="Number of projects/streams to process at once (default 4)")
+        self._p.add_option("--render-workers", dest="render_workers", type=int, default=0, help="Render recipient reports in this many worker processes (default 0; values below 2 render them in this process)")
+        self._p.add_option("--time-budget", dest="time_budget", type=float, default=0, help="Seconds the reports should take.  If rendering detailed reports would take longer, source snippets and then checker descriptions are left out (default 0==no limit)")
+        self._p.add_option("--estimate", action='store_true', dest="estimate", default=False, help="Estimate the web service calls and time the reports would take, from a count of the defects, without running them")
+        self._p.add_option("--stats", action='store_true', dest="stats", default=False, help="Print statistics for the web service calls made")
+        self._p.add_option("--trace", dest="trace", default=None, help="Write a trace of the run to this file, in Chrome's trace event format")
+        self._p.add_option("--memprofile", dest="memprofile", default=None, help="Profile memory use at the end of each phase, and write a summary to this file")
+        self._p.add_option("--daemon", action='store_true', dest="daemon", default=False, help="Keep running, and run the reports on a schedule and/or for new snapshots")
+        self._p.add_option("--schedule", dest="schedule", default=None, help="With --daemon, run the reports on this crontab-style schedule, e.g. \"0 7 * * 1-5\"")
+        self._p.add_option("--watch-snapshots", action='store_true', dest="watch_snapshots", default=False, help="With --daemon, run the reports for each new snapshot in the streams being reported")
+        self._p.add_option("--poll-interval", dest="poll_interval", type=int, default=60, help="Seconds between checks for new snapshots (default 60)")
+        self._p.add_option("--cache-refresh", dest="cache_refresh", type=int, default=3600, help="Seconds before cached components and checkers are fetched again (default 3600).  See also --metadata-ttl.")
 
         # Make sure we validate options
         def validate_reporter(options, args):
@@ -162,6 +373,57 @@ class MyOptionParser(object):
             except KeyError:
                 return ['Unknown "--format" value ' + options.format]
         self._p.add_validator(validate_format)
+        def validate_delivery(options, args):
+            if options.delivery not in ('cim', 'smtp'):
+                return ['Unknown "--delivery" value ' + options.delivery]
+            if options.delivery == 'smtp' and not options.smtp_from:
+                return ['"--delivery smtp" requires "--smtp-from"']
+            if options.delivery == 'smtp' and not options.smtp_domain:
+                # CIM usernames are given without any LDAP domain (see
+                # notify_user()), so they need one to be addresses
+                return ['"--delivery smtp" requires "--smtp-domain"']
+        self._p.add_validator(validate_delivery)
+        def validate_send_changes(options, args):
+            if options.send_changes not in ('full', 'delta'):
+                return ['Unknown "--send-changes" value ' + options.send_changes]
+        self._p.add_validator(validate_send_changes)
+        def validate_time_budget(options, args):
+            if options.time_budget < 0:
+                return ['"--time-budget" can\'t be negative']
+        self._p.add_validator(validate_time_budget)
+        def validate_render_workers(options, args):
+            scopes = [x for x in (options.projects + ',' + options.streams).split(',') if x]
+            if options.render_workers > 1 and options.parallel > 1 and len(scopes) > 1:
+                # Forking while other scopes' threads hold locks could leave
+                # the workers deadlocked
+                return ['"--render-workers" can\'t be used with "--parallel" and several projects/streams']
+        self._p.add_validator(validate_render_workers)
+        def validate_jobs(options, args):
+            errors = []
+            for job in options.jobs:
+                spec = job.split(':', 2)
+                if len(spec) < 2:
+                    errors.append('Invalid "--job" value ' + job)
+                elif spec[0] not in reporters:
+                    errors.append('Unknown "--job" dest ' + spec[0])
+                elif spec[1] not in templates.available_formats:
+                    errors.append('Unknown "--job" format ' + spec[1])
+            return errors
+        self._p.add_validator(validate_jobs)
+        def validate_daemon(options, args):
+            if options.schedule:
+                try:
+                    daemon.CronSchedule(options.schedule).next_after(datetime.datetime.now())
+                except daemon.CronSchedule.ParseError, e:
+                    return [str(e)]
+            if options.daemon and not (options.schedule or options.watch_snapshots):
+                return ['"--daemon" requires "--schedule" and/or "--watch-snapshots"']
+            if options.watch_snapshots and options.instances:
+                # Snapshot ids are only meaningful on one instance
+                return ['"--watch-snapshots" can\'t be used with "--instances"']
+            if options.daemon and options.estimate:
+                return ['"--estimate" can\'t be used with "--daemon"']
+        self._p.add_validator(validate_daemon)
     
     def print_help(self):
         return self._p.print_help()
@@ -169,54 +431,255 @@ class MyOptionParser(object):
     def parse_args(self):
         (self.options, self.args) = self._p.parse_args()
         
-    def defect_scope(self, client):
-        return ws.OptionsProcessor(self.options, client)
+    def scopes(self):
+        '''
+        Returns a list of (name, options) for each project and stream given
+        with "--projects" and "--streams".  Each has a copy of the command-line
+        options with the project or stream replaced.  Without either option,
+        returns the command-line options as the only scope.
+        '''
+        scopes = []
+        for name in [x for x in self.options.projects.split(',') if x]:
+            options = copy.copy(self.options)
+            options.project = name
+            options.stream = None
+            scopes.append((name, options))
+        for name in [x for x in self.options.streams.split(',') if x]:
+            options = copy.copy(self.options)
+            options.project = None
+            options.stream = name
+            scopes.append((name, options))
+        return scopes or [(self.options.project or self.options.stream, self.options)]
+
+    def jobs(self, options=None):
+        '''
+        Returns a list of (options, output) for the report jobs given with
+        "--job".  Each job's options are a copy of "options" (by default,
+        the command-line options), with the reporter and format replaced.
+        Output is None for stdout.  Without any "--job", returns the options
+        and "--output" as the only job.
+        '''
+        if options is None:
+            options = self.options
+        if not options.jobs:
+            return [(options, options.output)]
+        jobs = []
+        for job in options.jobs:
+            spec = job.split(':', 2)
+            job_options = copy.copy(options)
+            job_options.reporter = spec[0]
+            job_options.format = spec[1]
+            jobs.append((job_options, len(spec) > 2 and spec[2] or None))
+        return jobs
+
+    # With "--instances", the clients for each instance.  Set once they're
+    # connected.
+    clients = None
+
+    def defect_scope(self, client, options=None):
+        if self.clients:
+            return ws.MultiScope(options or self.options, self.clients)
+        return ws.OptionsProcessor(options or self.options, client)
 
 ###########################################################
-#
-# MAIN
+# Report delivery
 
-def main():
-    # Supported report types
-    # Note that we don't instantiate the class yet--we need to have a
-    # connection to CIM first.  We need to define this dict early, though,
-    # so our OptionParser can validate the reporter option.
-    reporters = {
-        # Notify component subscribers
-        'subscribers': SubscriberReporter,
-        # Notify defect owners
-        'owners': OwnerReporter,
-        # Report everything to console
-        'console': ConsoleReporter,
-		# Metrics reports to console
-		'metrics': MetricsReporter,
-		# ComponentMetrics reports to console
-		'compmetrics': ComponentMetricsReporter
-    }
+def notify_user(user, options):
+    '''
+    Returns the username to notify for recipient "user".
+    '''
+    if user in (None, 'Unassigned'):
+        user = options.unassigned_to
 
-    # Process command line options so we know how to connect to CIM
-    # and which defects to report.
+    # Strip off any LDAP suffix that might be present, since the notify
+    # method won't work with that.  The suffix is prefixed with '@'
+    # or '['.  SMTP delivery gets the same username and adds
+    # --smtp-domain to it.
+    return re.split('\s*[@\[]\s*',user)[0]
+
+def cim_notify(user, subject, body):
+    '''
+    Send a notification using CIM's "notify" capability.
+    '''
+    # If AttributeError is raised, it likely means that the admin client
+    # doesn't exist.  That only happens for WS v4 (ie CIM 5.5.0+), where the
+    # notify method is part of the config service.
     try:
-        parser = MyOptionParser(reporters)
-        parser.parse_args()
-    except ws.WSOpts.ValidationError, e:
-        sys.stderr.write(str(e)+'\n\n')
-        parser.print_help()
-        sys.exit(-1)
+        notify = ws.client.admin.notify
+    except AttributeError:
+        notify = ws.client.config.notify
+    notify(user, subject, body)
 
-    # Open the base WS client services
-    ws.client.connect(api_version=4, options=parser.options)
+###########################################################
+# Report rendering
 
-    # Process the defect filters
-    scope = parser.defect_scope(ws.client)
+def render_report(user, defects, options, reporter, fragments=None):
+    '''
+    Render the report for one recipient.  Returns a (subject, body) tuple.
+    For a FragmentTemplate format, the defects' fragments can be given if
+    they're already rendered.
+    '''
+    # This controls whether the message talks about un"assign"ed or
+    # un"subscrib"ed defects
+    if options.reporter == 'owners':
+        relationship = 'assign'
+    else:
+        relationship = 'subscrib'
+    subject = render_subject(user=user, options=options, defects=defects, intro=reporter.intro, relationship=relationship)
+    intro = render_intro(user=user, options=options, defects=defects, intro=subject)
+    kw = {}
+    if fragments is not None:
+        kw['fragments'] = fragments
+    body = templates.available_formats[options.format](options=options, defects=defects, intro=intro, **kw)
+    return subject, body
+
+# The options, reporter and DefectTable used by a render worker.  It's only
+# set in the worker processes, by _init_render_worker(), so each task only
+# needs to carry a recipient and its array of rows.
+_render_state = None
+
+def _init_render_worker(options, reporter, table, fragments=None):
+    global _render_state
+    _render_state = (options, reporter, table)
+    if fragments is not None:
+        # The time budget of a worker rendering fragments covers just its
+        # share of them
+        templates.budget.expect_only(fragments)
+
+def _render_worker(task):
+    '''
+    Render the report for one recipient in a worker process.
+    '''
+    user, rows = task
+    options, reporter, table = _render_state
+    before = templates.budget.counts()
+    report = render_report(user, table.defects(rows), options, reporter)
+    # The parent's budget doesn't see what this process renders
+    return report, (before, templates.budget.counts())
+
+def _fragment_worker(rows):
+    '''
+    Render the fragments of the defects in rows in a worker process.
+    Returns their (key, detail, text), and the budget counts.
+    '''
+    options, reporter, table = _render_state
+    template = templates.available_formats[options.format]
+    before = templates.budget.counts()
+    fragments = [template.fragment(defect, options) for defect in table.defects(rows)]
+    return fragments, (before, templates.budget.counts())
+
+def _map_workers(func, tasks, workers, initargs):
+    # The workers are forked with their state, so it isn't pickled
+    pool = multiprocessing.Pool(workers, initializer=_init_render_worker,
+                                initargs=initargs)
+    try:
+        # map() returns the results in task order
+        return pool.map(func, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+def render_reports(users, email_cid, table, options, reporter):
+    '''
+    Render the report for each user in "users", whose rows in "table" are
+    given by email_cid[user].  Returns a list of (subject, body) tuples in
+    the same order as "users".  If options.render_workers is
+    greater than 1, the reports are rendered by a pool of worker processes.
+    That relies on fork(), so other platforms always render sequentially.
+
+    With a FragmentTemplate format, the workers render the fragment of each
+    defect once, and the reports are assembled from them here.  The
+    fragments are added to this process's cache for the later jobs of the
+    run.  Other formats render each recipient's report in a worker.
+    '''
+    workers = getattr(options, 'render_workers', 0) or 0
+    if not hasattr(os, 'fork'):
+        workers = 0
+    template = templates.available_formats[options.format]
+
+    if workers > 1 and isinstance(template, templates.FragmentTemplate):
+        rows = sorted(set(itertools.chain(*[email_cid[user] for user in users])))
+        workers = min(workers, len(rows))
+    else:
+        rows = None
+        workers = min(workers, len(users))
+    if workers < 2:
+        return [render_report(user, table.defects(email_cid[user]), options, reporter) for user in users]
+
+    if rows is None:
+        tasks = [(user, email_cid[user]) for user in users]
+        results = _map_workers(_render_worker, tasks, workers, (options, reporter, table))
+        for report, counts in results:
+            templates.budget.merge(*counts)
+        return [report for report, counts in results]
 
-    # Instantiate the reporters with the proper client
-    for k,v in reporters.items():
-        reporters[k] = v(ws.client)
+    # A few chunks of rows per worker, so they finish at about the same time
+    size = max(1, len(rows) / (workers * 4))
+    chunks = [rows[i:i + size] for i in range(0, len(rows), size)]
+    results = _map_workers(_fragment_worker, chunks, workers,
+                           (options, reporter, table, (len(rows) + workers - 1) / workers))
+    fragments = {}
+    for chunk, (rendered, counts) in zip(chunks, results):
+        templates.budget.merge(*counts)
+        for row, (key, detail, text) in zip(chunk, rendered):
+            ws._cache['fragments'][key] = text
+            fragments[row] = (detail, text)
+
+    reports = []
+    seen = set()
+    for user in users:
+        if template.degradable:
+            # Count each later use of a fragment as a cache hit, as if it
+            # had been rendered here
+            for row in email_cid[user]:
+                if row in seen:
+                    templates.budget.rendered(fragments[row][0], 0.0, cached=True)
+                seen.add(row)
+        reports.append(render_report(user, table.defects(email_cid[user]), options, reporter,
+                                     fragments=[fragments[row][1] for row in email_cid[user]]))
+    return reports
+
+###########################################################
+# Running reports
+
+def group_recipients(records, reporter, unassigned_to=None):
+    '''
+    Group defect records by recipient.  Returns a dict mapping each of
+    reporter's recipients to an array of their rows in records.  Records
+    without recipients go to the None recipient if unassigned_to is set.
+    '''
+    email_cid = {}
+    for row, mergedDefectDO in enumerate(records):
+        # Check whether there are recipients for this defect
+        recipients = reporter.recipients(mergedDefectDO)
+        if recipients is None and unassigned_to:
+            recipients = [None]
+        if recipients:
+            for user in set(recipients):
+                try:
+                    email_cid[user].append(row)
+                except KeyError:
+                    email_cid[user] = array('l', [row])
+    return email_cid
+
+def run_report(options, scope, reporter, out=None, tables=None, report_state=None):
+    '''
+    Fetch, group, render and deliver one report.  Console output goes to
+    "out", or stdout if it isn't given.  The DefectTable for each set of
+    fetched defects is kept in the "tables" dict, so reports sharing a scope
+    and tables also share the defect objects and anything they have fetched.
+    The reports sent are recorded in report_state, the ReportState for
+    "--state-file", which the caller saves.  Returns the exit status for
+    the report.
+    '''
+    if out is None:
+        out = sys.stdout
+    if tables is None:
+        tables = {}
 
     # Get the list of filtered defects
-    reporter = reporters[parser.options.reporter]
-    mergedDefectsPageDO = reporter.defects(scope)
+    with tracing.span('fetch defects', reporter=options.reporter):
+        mergedDefectsPageDO = reporter.defects(scope)
 	
     # If there is no "totalNumberOfRecords" attribute, then defects() didn't return a page
     # descriptor.  That means that it isn't a list of defects, but a list of metrics.
@@ -224,101 +687,370 @@ def main():
         recs = mergedDefectsPageDO.totalNumberOfRecords
         rec_l = mergedDefectsPageDO.mergedDefects
         def get_defect(mergedDefectDO, scope):
-            try:
-                return ws.DefectHandler(mergedDefectDO, projectId=scope.projectId, projectDOs=scope.projectDOs, scope = scope.triage_scope())
-            except UnboundLocalError:
-                return ws.DefectHandler(mergedDefectDO, scope = scope.triage_scope())
+            return scope.defect_handler(mergedDefectDO)
     except AttributeError:
         recs = len(mergedDefectsPageDO)
         rec_l = mergedDefectsPageDO
         def get_defect(mergedDefectDO, scope):
             return mergedDefectDO
 
-    if not parser.options.quiet: sys.stderr.write("%d defects found.\n" % (recs,))
+    if not options.quiet: sys.stderr.write("%d defects found.\n" % (recs,))
 		
-    # Group defects by recipient
+    # Group defects by recipient.  Each recipient gets an array of rows
+    # in the table of defect records.
+    try:
+        table = tables[id(rec_l)]
+    except KeyError:
+        table = DefectTable(rec_l, lambda record: get_defect(record, scope))
+        tables[id(rec_l)] = table
     email_cid = {}
     if recs:
-      for mergedDefectDO in rec_l:
-        # Check whether there are recipients for this defect
-        recipients = reporter.recipients(mergedDefectDO)
-        if recipients is None and parser.options.unassigned_to:
-            recipients = [None]
-        if recipients:
-            defect = get_defect(mergedDefectDO, scope)
-            for user in recipients:
-                try:
-                    email_cid[user].add(defect)
-                except:
-                    email_cid[user] = set([defect])
+        with tracing.span('resolve recipients', defects=recs):
+            email_cid = group_recipients(rec_l, reporter, options.unassigned_to)
 
-    # Print useful info in script output
-    if len(email_cid) == 0:
-        if not parser.options.quiet: print "No relevant defects"
-        sys.exit(0)
-
-    # Finally, send the notifications
     try:
         console_reporter = reporter.recipients(1) == ['console']
     except:
         console_reporter = False
 
+    # Drop recipients whose report hasn't changed since the last run.  With
+    # "--send-changes delta", the others only get their new or changed
+    # defects.  "sent" holds the complete defect set for each recipient
+    # whose state is recorded once the notifications go out.
+    state = None
+    sent = {}
+    if report_state and not console_reporter:
+        state = report_state.scope(ReportState.scope_key(options))
+        state.retain(email_cid.keys())
+        for user in email_cid.keys():
+            defects = table.records(email_cid[user])
+            if not state.changed(user, defects):
+                del email_cid[user]
+                continue
+            sent[user] = defects
+            if options.send_changes == 'delta':
+                delta = set([state.defect_key(d) for d in state.delta(user, defects)])
+                if delta:
+                    email_cid[user] = array('l', [row for row in email_cid[user]
+                                                  if state.defect_key(table.record(row)) in delta])
+                else:
+                    # Defects were only removed, so there's nothing to send
+                    del email_cid[user]
+
+    # Print useful info in script output
+    if len(email_cid) == 0:
+        if state:
+            if options.testing != True:
+                state.record_all(sent)
+            if not options.quiet: print >>out, "No changed reports"
+        elif not options.quiet: print >>out, "No relevant defects"
+        return 0
+
+    # Finally, send the notifications
+    render_email = templates.available_formats[options.format]
+    dispatcher = None
     if console_reporter:
-        print render_email(options=parser.options, defects=email_cid['console'], intro=reporter.intro)
+        # Some formats can write their output incrementally
+        if getattr(render_email, 'degradable', False):
+            templates.budget.expect(len(email_cid['console']))
+        with tracing.span('render', format=options.format):
+          if hasattr(render_email, 'stream'):
+            render_email.stream(out, options=options, defects=table.defects(email_cid['console']), intro=reporter.intro)
+          else:
+            print >>out, render_email(options=options, defects=table.defects(email_cid['console']), intro=reporter.intro)
     else:
       for email in email_cid:
-       if not parser.options.quiet:
+       if not options.quiet:
         if email is None or email.lower() in ('none', 'unassigned'):
             sys.stderr.write("Unassigned defects ")
-            sys.stderr.write(', '.join([str(x.cid) for x in email_cid[email]])+' ')
-            if parser.options.unassigned_to:
-                sys.stderr.write('will be sent to '+parser.options.unassigned_to+'\n')
+            sys.stderr.write(', '.join([str(x.cid) for x in table.records(email_cid[email])])+' ')
+            if options.unassigned_to:
+                sys.stderr.write('will be sent to '+options.unassigned_to+'\n')
             else:
                 sys.stderr.write('will be ignored\n')
         else:
-         sys.stderr.write(email+" will be notified about "+', '.join([str(x.cid) for x in email_cid[email]])+'\n')
+         sys.stderr.write(email+" will be notified about "+', '.join([str(x.cid) for x in table.records(email_cid[email])])+'\n')
 
-      for user,defects in email_cid.items():
-        # This controls whether the message talks about un"assign"ed or
-        # un"subscrib"ed defects
-        if parser.options.reporter == 'owners':
-            relationship = 'assign'
-        else:
-            relationship = 'subscrib'
-        subject = render_subject(user=user, options=parser.options, defects=defects, intro=reporter.intro, relationship=relationship)
-        intro = render_intro(user=user, options=parser.options, defects=defects, intro=subject)
+      # Render the reports in a stable order, so the output is the same
+      # whether or not we render in parallel.
+      users = sorted(email_cid.keys())
+      if getattr(render_email, 'degradable', False):
+          templates.budget.expect(sum([len(email_cid[user]) for user in users]))
+      with tracing.span('render', format=options.format, recipients=len(users)):
+          reports = render_reports(users, email_cid, table, options, reporter)
+      memprofile.profiler.note('rendered %s reports' % (options.format,),
+                               sum([len(body) for subject, body in reports]))
+
+      if options.testing != True:
+          if options.delivery == 'smtp':
+              send = delivery.SMTPDelivery(options.smtp_from,
+                  host=options.smtp_host,
+                  port=options.smtp_port,
+                  domain=options.smtp_domain,
+                  user=options.smtp_user,
+                  password=options.smtp_password,
+                  starttls=options.smtp_starttls,
+                  subtype=render_email.mime_subtype)
+          else:
+              send = cim_notify
+          dispatcher = delivery.NotificationDispatcher(send,
+              max_in_flight=options.send_workers,
+              retries=options.send_retries,
+              backoff=options.send_backoff)
+
+      for user,(subject,body) in zip(users, reports):
         if user in (None, 'Unassigned'):
-            user = parser.options.unassigned_to
+            user = options.unassigned_to
 
-        body = render_email(options=parser.options, defects=defects, intro=intro)
-        
-        if parser.options.testing == True:
-            print "***\n*** just testing\n***\n"
-            print 'To:', user
-            print 'Subject:', subject
-            print '\n',body
+        if options.testing == True:
+            print >>out, "***\n*** just testing\n***\n"
+            print >>out, 'To:', user
+            print >>out, 'Subject:', subject
+            print >>out, '\n',body
         else:
-          # We send the email using CIM's "notify" capability.  One downside to
-          # that approach, is that CIM (as of 5.5.1) has a fixed format for
-          # the message and we can't change the MIME headers.  We could theoretically
-          # use Python's email support to have complete control over the message
-          # format, but then we couldn't leverage CIM's user and mail settings.
-
-          # Strip off any LDAP suffix that might be present, since the notify
-          # method won't work with that.  The suffix is prefixed with '@'
-          # or '['
-          user = re.split('\s*[@\[]\s*',user)[0]
-
-          # Send the email.  If AttributeError is raised, it likely
-          # means that the admin client doesn't exist.  That only happens
-          # for WS v4 (ie CIM 5.5.0+), where the notify method is part
-          # of the config service.
-          try:
-            ws.client.admin.notify(user, subject, body)
-          except AttributeError:
-            ws.client.config.notify(user, subject, body)
-            
-    if not parser.options.quiet: sys.stderr.write("%d defects processed.\n" % (recs,))
+          # By default we send the email using CIM's "notify" capability.  One
+          # downside to that approach, is that CIM (as of 5.5.1) has a fixed
+          # format for the message and we can't change the MIME headers.  With
+          # "--delivery smtp" we use Python's email support to have complete
+          # control over the message format, but then we can't leverage CIM's
+          # user and mail settings.
+
+          dispatcher.submit(notify_user(user, options), subject, body)
+
+      if dispatcher:
+        with tracing.span('notify', recipients=len(users)):
+            dispatcher.close()
+        if hasattr(send, 'close'):
+            send.close()
+        if not options.quiet or dispatcher.failures:
+            sys.stderr.write(dispatcher.summary()+'\n')
+
+    # Remember what we told each recipient, except those we failed to notify
+    if state and options.testing != True:
+        failed = set([user for user, error in dispatcher.failures])
+        for user in sent.keys():
+            if notify_user(user, options) in failed:
+                del sent[user]
+        state.record_all(sent)
+
+    if not options.quiet: sys.stderr.write("%d defects processed.\n" % (recs,))
+    if dispatcher and dispatcher.failures:
+        return 1
+    return 0
+
+def scope_output(output, name, multiple):
+    '''
+    Returns the output file name for the project or stream "name".
+    "%(scope)s" in output is replaced by the name.  Otherwise, if there are
+    multiple projects or streams, the name is prefixed to the file name.
+    '''
+    name = re.sub(r'[^\w.-]', '_', name or 'all')
+    if '%(scope)s' in output:
+        return output.replace('%(scope)s', name)
+    elif multiple:
+        head, tail = os.path.split(output)
+        return os.path.join(head, name + '-' + tail)
+    return output
+
+def run_scope(parser, name, options, reporters, multiple=False, report_state=None):
+    '''
+    Run every report job for one project or stream.  All the jobs share the
+    scope, so the defects are fetched only once, and record the reports they
+    send in report_state.  Returns a tuple (status,
+    text), where text is the console output that wasn't written to a file if
+    "multiple" is set, or None otherwise.
+    '''
+    # Process the defect filters
+    with tracing.span('process options', scope=name):
+        scope = parser.defect_scope(ws.client, options)
+
+    # Instantiate the reporters with the proper client.  Reporters keep
+    # per-scope state, so each project or stream gets its own.  With
+    # "--instances" there is one per instance, and their results are merged.
+    if isinstance(scope, ws.MultiScope):
+        reporters = dict([(k, ws.MultiReporter(dict([(c.name, v(ws.client)) for c, s in scope.scopes])))
+                          for k,v in reporters.items()])
+    else:
+        reporters = dict([(k, v(ws.client)) for k,v in reporters.items()])
+
+    status = 0
+    tables = {}
+    buf = None
+    if multiple:
+        buf = StringIO()
+    for job_options, output in parser.jobs(options):
+        if output:
+            out = open(scope_output(output, name, multiple), 'w')
+        else:
+            out = buf or sys.stdout
+        try:
+            with tracing.span('report', scope=name, reporter=job_options.reporter, format=job_options.format):
+                status = run_report(job_options, scope, reporters[job_options.reporter], out, tables,
+                                    report_state) or status
+        finally:
+            if output:
+                out.close()
+
+    return status, buf and buf.getvalue()
+
+def run_scopes(parser, scopes, reporters):
+    '''
+    Run the reports for each project or stream in "scopes".  If there are
+    several, run them concurrently.  They share the connection, the ws
+    caches and the "--state-file", and their console output is collected
+    so it isn't interleaved.  Returns the exit status.
+    '''
+    templates.budget.start(parser.options.time_budget)
+    report_state = None
+    if parser.options.state_file:
+        report_state = ReportState(parser.options.state_file)
+    if len(scopes) == 1:
+        name, options = scopes[0]
+        results = [run_scope(parser, name, options, reporters, report_state=report_state)]
+    else:
+        def run(item):
+            name, options = item
+            try:
+                # The scopes take turns for the server
+                with ws.scheduler.report(name):
+                    return run_scope(parser, name, options, reporters, multiple=True,
+                                     report_state=report_state)
+            except Exception:
+                sys.stderr.write('Reports for %s failed:\n%s' % (name, traceback.format_exc()))
+                return 1, None
+        pool = ThreadPool(max(1, min(parser.options.parallel, len(scopes))))
+        try:
+            results = pool.map(run, scopes)
+        finally:
+            pool.close()
+            pool.join()
+
+    status = 0
+    for scope_status, text in results:
+        if text:
+            sys.stdout.write(text)
+        status = max(status, scope_status)
+
+    if report_state and parser.options.testing != True:
+        report_state.save()
+
+    # Keep the metadata fetched for the next run
+    ws.metadata.save()
+
+    if templates.budget.summary() and parser.options.quiet != True:
+        sys.stderr.write(templates.budget.summary())
+
+    if parser.options.stats:
+        sys.stderr.write(ws.stats.summary())
+        sys.stderr.write(ws.scheduler.summary())
+        if ws.hedging.methods:
+            sys.stderr.write(ws.hedging.summary())
+
+    # Each daemon run overwrites the trace with its own events, and the
+    # "--record-ws" cassette with its calls
+    if parser.options.trace:
+        tracing.tracer.export(parser.options.trace)
+        tracing.tracer.clear()
+    cassette.flush()
+
+    if parser.options.memprofile:
+        memprofile.profiler.write(parser.options.memprofile)
+    return status
+
+###########################################################
+#
+# MAIN
+
+def main():
+    # Supported report types
+    # Note that we don't instantiate the class yet--we need to have a
+    # connection to CIM first.  We need to define this dict early, though,
+    # so our OptionParser can validate the reporter option.
+    reporters = {
+        # Notify component subscribers
+        'subscribers': SubscriberReporter,
+        # Notify defect owners
+        'owners': OwnerReporter,
+        # Report everything to console
+        'console': ConsoleReporter,
+		# Metrics reports to console
+		'metrics': MetricsReporter,
+		# ComponentMetrics reports to console
+		'compmetrics': ComponentMetricsReporter
+    }
+
+    # Process command line options so we know how to connect to CIM
+    # and which defects to report.
+    try:
+        parser = MyOptionParser(reporters)
+        parser.parse_args()
+    except ws.WSOpts.ValidationError, e:
+        sys.stderr.write(str(e)+'\n\n')
+        parser.print_help()
+        sys.exit(-1)
+
+    if parser.options.trace:
+        tracing.tracer.enable()
+    if parser.options.memprofile:
+        memprofile.profiler.enable()
+
+    ws.metadata.configure(parser.options)
+    ws.snapshot_cids.configure(parser.options)
+    ws.scheduler.configure(parser.options)
+    ws.hedging.configure(parser.options)
+
+    # Open the base WS client services.  With "--instances", connect to all
+    # of them, and use the first for anything not specific to an instance
+    # (like sending notifications).
+    if parser.options.instances:
+        instances = ws.MultiServiceClient()
+        with tracing.span('connect', instances=parser.options.instances):
+            instances.connect(parser.options.instances.split(','), api_version=4, options=parser.options)
+        parser.clients = instances.clients
+        ws.client.set_default(instances.clients[0])
+    else:
+        with tracing.span('connect', host=parser.options.host):
+            ws.client.connect(api_version=4, options=parser.options)
+
+    if parser.options.estimate:
+        sys.exit(estimate.run(parser, parser.scopes(), reporters))
+
+    if not parser.options.daemon:
+        status = run_scopes(parser, parser.scopes(), reporters)
+        if status:
+            sys.exit(status)
+        return
+
+    # Run as a daemon.  The connection and ws caches are kept between runs.
+    scopes = parser.scopes()
+    def run(stream=None, snapshot=None):
+        if snapshot is None:
+            run_scopes(parser, scopes, reporters)
+        else:
+            options = copy.copy(parser.options)
+            options.project = None
+            options.stream = stream
+            options.snapshot = snapshot
+            run_scopes(parser, [(stream, options)], reporters)
+
+    watcher = None
+    if parser.options.watch_snapshots:
+        streams = {}
+        for name, options in scopes:
+            for sid in parser.defect_scope(ws.client, options).streamIdDOs:
+                streams[sid.name] = sid
+        watcher = daemon.SnapshotWatcher(ws.client, streams.values())
+
+    schedule = None
+    if parser.options.schedule:
+        schedule = daemon.CronSchedule(parser.options.schedule)
+
+    try:
+        daemon.ReportDaemon(run, schedule, watcher,
+            poll_interval=parser.options.poll_interval,
+            cache_refresh=parser.options.cache_refresh).run_forever()
+    except KeyboardInterrupt:
+        pass
 
 # -----------------------------------------------------------------------------
 if __name__ == '__main__':
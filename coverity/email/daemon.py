@@ -0,0 +1,213 @@
+'''
+Support for running reports from a long-running process, so the WS
+connections and the caches in coverity.ws stay warm between runs.
+
+Reports can be run on a cron-like schedule, and when new snapshots are
+committed to the streams being watched.
+'''
+
+import sys
+import time
+import datetime
+import traceback
+
+from coverity import ws
+
+class CronSchedule(object):
+    '''
+    A schedule given in crontab format: "minute hour day-of-month month
+    day-of-week".  Each field may be "*", a number, a range like "1-5", a
+    step like "*/15" or "8-18/2", or a comma-separated list of those.  Day of
+    week is 0-7, with 0 and 7 meaning Sunday.  As with cron, if both day
+    fields are restricted (don't start with "*"), a time matches if either
+    of them matches.
+    '''
+    class ParseError(ValueError): pass
+
+    _ranges = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, spec):
+        self.spec = spec
+        fields = spec.split()
+        if len(fields) != 5:
+            raise self.ParseError('Expected 5 fields in schedule "%s"' % (spec,))
+        self._fields = [self._parse(f, lo, hi) for f, (lo, hi) in zip(fields, self._ranges)]
+        if 7 in self._fields[4]:
+            self._fields[4].discard(7)
+            self._fields[4].add(0)
+        # Like cron, "*/2" doesn't restrict the days any more than "*"
+        self._any_dom = fields[2].startswith('*')
+        self._any_dow = fields[4].startswith('*')
+
+    def _parse(self, field, lo, hi):
+        values = set()
+        for part in field.split(','):
+            step = 1
+            if '/' in part:
+                part, step = part.split('/', 1)
+                step = int(step)
+            if part == '*':
+                start, end = lo, hi
+            elif '-' in part:
+                start, end = [int(x) for x in part.split('-', 1)]
+            else:
+                start = end = int(part)
+            if start < lo or end > hi or start > end or step < 1:
+                raise self.ParseError('Invalid schedule field "%s"' % (field,))
+            values.update(range(start, end + 1, step))
+        return values
+
+    def matches(self, dt):
+        '''
+        Returns True if the schedule fires at datetime dt (to the minute).
+        '''
+        minute, hour = self._fields[:2]
+        return dt.minute in minute and dt.hour in hour and self._day_matches(dt)
+
+    def _day_matches(self, dt):
+        dom, month, dow = self._fields[2:]
+        if dt.month not in month:
+            return False
+        # datetime counts Monday as 0, cron counts Sunday as 0
+        dom_ok = dt.day in dom
+        dow_ok = (dt.weekday() + 1) % 7 in dow
+        if self._any_dom or self._any_dow:
+            return dom_ok and dow_ok
+        return dom_ok or dow_ok
+
+    def next_after(self, dt):
+        '''
+        Returns the first time after datetime dt when the schedule fires.
+        '''
+        t = dt.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        day = t.replace(hour=0, minute=0)
+        # Anything valid fires at least once in 8 years, since a century
+        # year may not be a leap year
+        for i in range(8 * 366):
+            if self._day_matches(day):
+                for hour in sorted(self._fields[1]):
+                    for minute in sorted(self._fields[0]):
+                        fire = day.replace(hour=hour, minute=minute)
+                        if fire >= t:
+                            return fire
+            day += datetime.timedelta(days=1)
+        raise self.ParseError('Schedule "%s" never fires' % (self.spec,))
+
+class SnapshotWatcher(object):
+    '''
+    Polls a set of streams via getSnapshotsForStream() and reports snapshots
+    that have appeared since the previous poll.  The first poll only records
+    the existing snapshots.
+    '''
+    # How far back to look for snapshots after the first poll.  Snapshots
+    # are dated when they're created, which can be well before their commit
+    # finishes and they become visible.
+    window = datetime.timedelta(days=1)
+
+    def __init__(self, client, streamIdDOs):
+        self._client = client
+        self._streams = streamIdDOs
+        self._latest = {}
+
+    def poll(self):
+        '''
+        Returns a list of (stream name, snapshot id) for new snapshots.
+        '''
+        new = []
+        for stream in self._streams:
+            latest = self._latest.get(stream.name)
+            if latest is None:
+                f = self._client.config.getDO('snapshotFilterSpecDataObj')
+            else:
+                f = self._client.config.getDO('snapshotFilterSpecDataObj',
+                    startDate=datetime.datetime.now() - self.window)
+            ids = sorted([x.id for x in self._client.config.getSnapshotsForStream(stream, f) or []])
+            if latest is not None:
+                new.extend([(stream.name, i) for i in ids if i > latest])
+            if ids:
+                self._latest[stream.name] = max(ids[-1], latest or 0)
+            elif latest is None:
+                self._latest[stream.name] = 0
+        return new
+
+class ReportDaemon(object):
+    '''
+    Runs reports on a schedule and/or when new snapshots appear, until
+    interrupted.  "run" is called as run() for scheduled reports, and as
+    run(stream_name, snapshot_id) for each new snapshot.
+
+    The caches of fragments and source files are cleared after every run,
+    so they don't grow with every snapshot reported, and ws.metadata drops
+    its expired entries.  The caches of components and checkers are
+    dropped every cache_refresh seconds so changes on the server are picked
+    up.  Users, projects, streams and snapshots expire according to
+    ws.metadata's TTLs.
+    '''
+    # Caches which only serve one run
+    run_caches = ('fragments', 'files')
+
+    # Caches which may go stale while the daemon runs
+    volatile_caches = ('components', 'checkers')
+
+    def __init__(self, run, schedule=None, watcher=None, poll_interval=60,
+                 cache_refresh=3600, log=sys.stderr):
+        self._run = run
+        self._schedule = schedule
+        self._watcher = watcher
+        self._poll_interval = poll_interval
+        self._cache_refresh = cache_refresh
+        self._log = log
+        self._cache_time = time.time()
+
+    def _note(self, msg):
+        self._log.write('%s %s\n' % (datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), msg))
+        self._log.flush()
+
+    def _call(self, *args):
+        try:
+            self._run(*args)
+        except Exception:
+            self._note('Report failed:\n' + traceback.format_exc())
+        for name in self.run_caches:
+            ws._cache.get(name, {}).clear()
+        ws.metadata.prune()
+
+    def _expire_caches(self):
+        if time.time() - self._cache_time >= self._cache_refresh:
+            for name in self.volatile_caches:
+                ws._cache.get(name, {}).clear()
+            self._cache_time = time.time()
+
+    def run_forever(self):
+        next_run = None
+        if self._schedule:
+            next_run = self._schedule.next_after(datetime.datetime.now())
+            self._note('Next scheduled report at %s' % (next_run,))
+        if self._watcher:
+            self._watcher.poll()
+
+        while True:
+            if next_run and datetime.datetime.now() >= next_run:
+                self._note('Running scheduled reports')
+                self._call()
+                next_run = self._schedule.next_after(datetime.datetime.now())
+                self._note('Next scheduled report at %s' % (next_run,))
+
+            if self._watcher:
+                try:
+                    snapshots = self._watcher.poll()
+                except Exception:
+                    self._note('Snapshot poll failed:\n' + traceback.format_exc())
+                    snapshots = []
+                for stream, snapshot in snapshots:
+                    self._note('Running reports for snapshot %s in stream %s' % (snapshot, stream))
+                    self._call(stream, snapshot)
+
+            self._expire_caches()
+
+            # Sleep until the next poll or scheduled run, whichever is first
+            delay = self._poll_interval
+            if next_run:
+                until = next_run - datetime.datetime.now()
+                delay = min(delay, until.days * 86400 + until.seconds + 1)
+            time.sleep(max(1, delay))
@@ -0,0 +1,227 @@
+'''
+Helpers for delivering the rendered reports.
+
+Reports are normally sent through CIM's "notify" web service.  SMTPDelivery
+sends them directly to a mail server instead.  To try it out without a real
+mail server, run Python's debugging SMTP server::
+
+    python -m smtpd -n -c DebuggingServer localhost:1025
+
+and use "--delivery smtp --smtp-host localhost --smtp-port 1025", with
+"--smtp-from" and "--smtp-domain".
+'''
+
+import time
+import socket
+import httplib
+import urllib2
+import smtplib
+import threading
+import Queue
+from email.mime.text import MIMEText
+from email.header import Header
+from email.utils import formatdate, make_msgid
+
+from suds.transport import TransportError
+
+from coverity import tracing
+
+# Exceptions that indicate a failure which might succeed if retried.  Anything
+# else (like a WebFault for an unknown user) is treated as permanent.
+transient_errors = (socket.error, httplib.HTTPException, urllib2.URLError,
+                    TransportError, smtplib.SMTPServerDisconnected,
+                    smtplib.SMTPConnectError)
+
+class NotificationDispatcher(object):
+    '''
+    Sends notifications on a pool of worker threads, so we don't wait for
+    each round trip in turn.  At most max_in_flight notifications are being
+    sent at any time, and submit() blocks while the queue of waiting
+    notifications is full.  Transient failures are retried with exponential
+    backoff.
+
+    The send function is called as send(user, subject, body).
+    '''
+    def __init__(self, send, max_in_flight=1, retries=2, backoff=1.0):
+        self._send = send
+        self._retries = retries
+        self._backoff = backoff
+        self._lock = threading.Lock()
+        self._queue = Queue.Queue(max(1, max_in_flight))
+
+        self.latencies = []
+        self.failures = []
+        self.retried = 0
+        self.elapsed = None
+        self._start = time.time()
+
+        self._threads = []
+        for i in range(max(1, max_in_flight)):
+            t = threading.Thread(target=self._worker, name='notify-%d' % (i,))
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, user, subject, body):
+        '''
+        Queue a notification to be sent.
+        '''
+        self._queue.put((user, subject, body))
+
+    def close(self):
+        '''
+        Wait for all queued notifications to be sent, and stop the workers.
+        '''
+        for t in self._threads:
+            self._queue.put(None)
+        for t in self._threads:
+            t.join()
+        self.elapsed = time.time() - self._start
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            self._deliver(*item)
+
+    def _deliver(self, user, subject, body):
+        attempt = 0
+        while True:
+            start = time.time()
+            try:
+                with tracing.span('send', 'notify', user=user, attempt=attempt):
+                    self._send(user, subject, body)
+            except transient_errors, e:
+                if attempt < self._retries:
+                    with self._lock:
+                        self.retried += 1
+                    time.sleep(self._backoff * (2 ** attempt))
+                    attempt += 1
+                    continue
+                error = e
+            except Exception, e:
+                error = e
+            else:
+                with self._lock:
+                    self.latencies.append(time.time() - start)
+                return
+
+            with self._lock:
+                self.failures.append((user, error))
+            return
+
+    def summary(self):
+        '''
+        Returns a string summarizing the notifications sent so far.
+        '''
+        lat = sorted(self.latencies)
+        elapsed = self.elapsed
+        if elapsed is None:
+            elapsed = time.time() - self._start
+        s = ['%d notifications sent in %.1fs (%d failed, %d retries)' % (
+                len(lat), elapsed, len(self.failures), self.retried)]
+        if lat:
+            s.append('latency min %.2fs, mean %.2fs, p95 %.2fs, max %.2fs' % (
+                lat[0], sum(lat)/len(lat), lat[int(0.95*(len(lat)-1))], lat[-1]))
+        for user, error in self.failures:
+            s.append('failed to notify %s: %s' % (user, error))
+        return '\n  '.join(s)
+
+class SMTPDelivery(object):
+    '''
+    Sends notifications directly to an SMTP server.  Each sending thread
+    keeps its own connection open and reuses it for all of its messages, so
+    when used with a NotificationDispatcher there is a pool of persistent
+    connections, one per worker.
+
+    Users are addressed as user@domain, since their names don't include
+    one (see coverity.email.notify_user()).  The reports are sent as
+    text/subtype, the MIME subtype of their format.
+    '''
+    def __init__(self, sender, host='localhost', port=25, domain=None,
+                 user=None, password=None, starttls=False, subtype='plain'):
+        self._sender = sender
+        self._host = host
+        self._port = port
+        self._domain = domain
+        self._user = user
+        self._password = password
+        self._starttls = starttls
+        self._subtype = subtype
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+
+    def _connection(self):
+        '''
+        Get the current thread's connection, opening it if necessary.
+        '''
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = smtplib.SMTP(self._host, self._port)
+            conn.ehlo()
+            if self._starttls:
+                conn.starttls()
+                conn.ehlo()
+            if self._user:
+                conn.login(self._user, self._password)
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def _drop_connection(self):
+        conn = getattr(self._local, 'conn', None)
+        self._local.conn = None
+        if conn is not None:
+            with self._lock:
+                if conn in self._connections:
+                    self._connections.remove(conn)
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    def address(self, user):
+        '''
+        Returns the email address for a CIM user.
+        '''
+        if self._domain:
+            return '%s@%s' % (user, self._domain)
+        return user
+
+    def message(self, user, subject, body):
+        '''
+        Returns the MIME message for a report.
+        '''
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+        msg = MIMEText(body, self._subtype, 'utf-8')
+        msg['Subject'] = Header(subject, 'utf-8')
+        msg['From'] = self._sender
+        msg['To'] = self.address(user)
+        msg['Date'] = formatdate(localtime=True)
+        msg['Message-ID'] = make_msgid()
+        return msg
+
+    def __call__(self, user, subject, body):
+        msg = self.message(user, subject, body)
+        try:
+            self._connection().sendmail(self._sender, [msg['To']], msg.as_string())
+        except (smtplib.SMTPServerDisconnected, socket.error):
+            # Don't reuse a broken connection.  The dispatcher will retry.
+            self._drop_connection()
+            raise
+
+    def close(self):
+        '''
+        Close all the connections.
+        '''
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            try:
+                conn.quit()
+            except (smtplib.SMTPException, socket.error):
+                conn.close()
@@ -0,0 +1,332 @@
+'''
+Estimating what the reports will cost before running them ("--estimate").
+
+Each project or stream's scope is set up as for a run, which may call the
+server to find its streams, users and snapshots unless the metadata cache
+already has them.  Then, instead of fetching the defects, a page of one
+defect is requested with the scope's filters, for its
+totalNumberOfRecords.  From that count, each job's reporter and format,
+and what is cached, the web service calls of each phase are predicted:
+the pages of defects, the recipient lookups, what rendering fetches for
+each defect, and the notifications.  Many are upper bounds, marked "<=",
+since the numbers of distinct checkers, components and recipients aren't
+known until the defects are fetched.  The source files are read for each
+instance of a defect, so they are only estimated, at one per defect, and
+marked "~".
+
+Each call is timed with the mean latency of its method so far in this
+process, or else of the other lookups made so far, or else of the page of
+one defect.
+'''
+
+import sys
+import time
+import math
+
+from coverity import ws
+
+# What each format looks up for every defect it renders: its stream defect
+# (instances and history), the source files and checker descriptions for
+# those, its component's rules, or its project (for the defect's URL).
+# Formats not listed only use the defect records.
+format_lookups = {
+    'table': ('projects',),
+    'list': ('projects',),
+    'details': ('stream defects', 'files', 'checkers', 'projects'),
+    'details_html': ('stream defects', 'files', 'checkers', 'projects'),
+    'json_instances': ('stream defects',),
+    'ndjson_instances': ('stream defects',),
+    'multcomp_csv': ('stream defects',),
+    'compowner_csv': ('components',),
+    'circles_chart': ('checkers',),
+    }
+
+def _total_calls():
+    return sum([m['calls'] for m in ws.stats.as_dict().values()])
+
+def _combined_mark(marks):
+    if '~' in marks:
+        return '~'
+    if '<=' in marks:
+        return '<='
+    return ''
+
+def _is_console(reporter_class):
+    # The same test run_report() uses
+    try:
+        return reporter_class(None).recipients(1) == ['console']
+    except:
+        return False
+
+class ReportEstimate(object):
+    '''
+    The predicted web service calls and time for the report jobs of one
+    project or stream.  "jobs" is a list of (options, output) as returned
+    by MyOptionParser.jobs(), and "reporters" maps "--dest" values to
+    reporter classes.
+    '''
+    # Server and transfer time per defect in a page, which a page of one
+    # defect doesn't show
+    record_seconds = 0.0002
+
+    # Latency used when no call has been timed yet (replaying a cassette
+    # with "--replay-timing 0", say)
+    default_seconds = 0.1
+
+    # Calls in one row of the estimate above which the configuration is
+    # worth a warning
+    warn_calls = 10000
+
+    def __init__(self, name, scope, jobs, reporters, setup_calls=0, setup_seconds=0.0):
+        self.name = name
+        self.rows = []
+        self.warnings = []
+
+        if isinstance(scope, ws.MultiScope):
+            instances = scope.scopes
+        else:
+            instances = [(None, scope)]
+
+        defect_jobs = [(o, reporters[o.reporter]) for o, output in jobs
+                       if not issubclass(reporters[o.reporter], ws.MetricsReporter)]
+        metrics_jobs = [(o, reporters[o.reporter]) for o, output in jobs
+                        if issubclass(reporters[o.reporter], ws.MetricsReporter)]
+
+        # Count the defects in each instance
+        counts = []
+        if defect_jobs:
+            for c, s in instances:
+                with ws.using(c):
+                    counts.append(self._count(s))
+        self.defects = sum([n for n, pages in counts])
+        self.pages = sum([pages for n, pages in counts])
+        self.owner_filtered = bool([s for c, s in instances if s.ownerFilter is not None])
+        self._methods = ws.stats.as_dict()
+
+        self._add('set up', '(made)', setup_calls, seconds=setup_seconds)
+
+        for options, reporter_class in metrics_jobs:
+            if issubclass(reporter_class, ws.ComponentMetricsReporter):
+                self._add('fetch metrics', 'getComponentMetricsForProject', 1)
+            else:
+                self._add('fetch metrics', 'getTrendRecordsForProject', 1)
+        if not defect_jobs:
+            return
+
+        n = self.defects
+        self._add('fetch defects', 'getMergedDefectsForStreams', self.pages,
+                  seconds=n * self.record_seconds)
+
+        # A distinct component is looked up at most once per reporter
+        components = n
+        if 'componentIdList' in scope.filters:
+            components = min(n, len(scope.filters['componentIdList']) * len(instances))
+
+        # Recipients.  Reporters are shared by the jobs with the same
+        # "--dest", but owners are looked up again for each job.
+        subscriber_dests = set()
+        for options, reporter_class in defect_jobs:
+            if options.reporter == 'owners':
+                if options.unassigned != 'only':
+                    self._add('resolve recipients', 'getMergedDefectHistory', n)
+            elif not _is_console(reporter_class) and options.reporter not in subscriber_dests:
+                subscriber_dests.add(options.reporter)
+                self._add('resolve recipients', 'getComponent', components, bound=True)
+
+        # What rendering fetches.  The defects, and the caches, are shared
+        # by all the jobs.
+        lookups = set()
+        for options, reporter_class in defect_jobs:
+            lookups.update(format_lookups.get(options.format, ()))
+        if 'stream defects' in lookups:
+            self._add('render', 'getStreamDefects', n)
+        if 'files' in lookups:
+            # One per instance, which isn't known without its stream
+            # defect, and fewer for the files already read
+            self._add('render', 'getFileContents', n, estimated=True)
+        if 'checkers' in lookups:
+            self._add('render', 'getCheckerProperties', n, bound=True)
+        if 'components' in lookups:
+            self._add('render', 'getComponentMaps', components, bound=True)
+        if 'projects' in lookups:
+            # A defect's project is looked up if the scope has several,
+            # unless the metadata cache already knows it
+            calls = 0
+            for (c, s), (count, pages) in zip(instances, counts):
+                if s.projectId is None:
+                    with ws.using(c):
+                        known = len([k for k in ws.metadata.keys(ws.client, 'projects')
+                                     if isinstance(k, tuple) and k[0] == 'cid'])
+                    calls += max(0, count - known) * len(s.projectDOs or [])
+            if calls:
+                self._add('render', 'getMergedDefectsForStreams', calls, bound=True)
+                if calls > self.warn_calls:
+                    self._warn('Finding the project of each defect for its URL '
+                        'searches every project; use "--project" or "--stream" with a '
+                        'single project')
+
+        # Notifications, to at most one recipient per defect
+        for options, reporter_class in defect_jobs:
+            if options.testing == True or _is_console(reporter_class):
+                continue
+            users = None
+            for c, s in instances:
+                names = s.filters.get('ownerNameList') or s.ownerFilter
+                if names is not None:
+                    users = (users or 0) + len(names)
+            recipients = n
+            if users is not None:
+                recipients = min(n, users)
+            if options.delivery == 'smtp':
+                method = 'smtp'
+            else:
+                method = 'notify'
+            self._add('notify', method, recipients, bound=True,
+                      workers=max(1, options.send_workers))
+            if options.state_file:
+                self._warn('With "--state-file", only the recipients whose '
+                    'report changed are notified')
+
+        for c, s in instances:
+            owners = len(s.filters.get('ownerNameList') or [])
+            if owners > ws.OptionsProcessor.local_owner_threshold:
+                self._warn('Every page request carries %d owners; '
+                    '"--owner-filter local" filters them here instead' % (owners,))
+
+        for phase, method, calls, mark, seconds in self.rows:
+            if calls > self.warn_calls:
+                if method == 'getMergedDefectHistory':
+                    self._warn('The owner of every defect is found from its '
+                        'history (%d calls); narrow the report with "--days", "--status" '
+                        'or "--component"' % (calls,))
+                elif method == 'getStreamDefects':
+                    self._warn('Rendering fetches the instances of every defect '
+                        '(%d calls); a format without them is much cheaper' % (calls,))
+        if self.owner_filtered:
+            self._warn('The defect count is before the owners are filtered here')
+
+    def _count(self, scope):
+        '''
+        Returns (defects, pages): the number of defects matching the scope,
+        and the number of pages DefectReporter.defects() will request.
+        '''
+        page_size = ws.DefectReporter.page_size
+        def pages(n):
+            # The last page is always empty
+            return int(math.ceil(float(n) / page_size)) + 1
+
+        if scope.cidList is not None:
+            # With "--local-diff", the CIDs are known, and fetched a chunk
+            # at a time
+            chunk = ws.DefectReporter.cid_chunk
+            return len(scope.cidList), sum([pages(min(chunk, len(scope.cidList) - i))
+                                            for i in range(0, len(scope.cidList), chunk)])
+
+        f = ws.client.defect.getDO('mergedDefectFilterSpecDataObj', **scope.filters)
+        ps = ws.client.defect.getDO('pageSpecDataObj',
+            pageSize = 1, sortAscending = False, startIndex = 0)
+        n = ws.client.defect.getMergedDefectsForStreams(scope.streamIdDOs, f, ps).totalNumberOfRecords
+        return n, pages(n)
+
+    def _latency(self, method):
+        '''
+        Returns the mean seconds per call to method so far.  If it hasn't
+        been called, returns the mean of the other calls, except the pages
+        of defects which are usually much slower, or failing that, of the
+        pages.
+        '''
+        def mean(methods):
+            calls = sum([m['calls'] for m in methods])
+            seconds = sum([m['seconds'] for m in methods])
+            return calls and seconds and seconds / calls or None
+        return (mean([m for name, m in self._methods.items() if name == method])
+                or mean([m for name, m in self._methods.items()
+                         if name != 'getMergedDefectsForStreams'])
+                or mean(self._methods.values())
+                or self.default_seconds)
+
+    def _add(self, phase, method, calls, bound=False, estimated=False, seconds=0.0, workers=1):
+        '''
+        Add a row for calls to method, made by "workers" at once.  They
+        take their latency plus "seconds".  bound is set if calls is an
+        upper bound, and estimated if it could be more or less.
+        '''
+        if method != '(made)':
+            seconds += calls * self._latency(method) / workers
+        mark = estimated and '~' or bound and '<=' or ''
+        self.rows.append((phase, method, calls, mark, seconds))
+
+    def _warn(self, message):
+        if message not in self.warnings:
+            self.warnings.append(message)
+
+    @property
+    def calls(self):
+        return sum([calls for phase, method, calls, mark, seconds in self.rows])
+
+    @property
+    def seconds(self):
+        return sum([seconds for phase, method, calls, mark, seconds in self.rows])
+
+    @property
+    def mark(self):
+        '''
+        How the total is marked: "~" if any row is estimated, "<=" if any
+        is an upper bound, or else "".
+        '''
+        return _combined_mark([r[3] for r in self.rows])
+
+    def report(self):
+        '''
+        Returns the estimate as a table.
+        '''
+        if self.pages:
+            s = ['%s: %d defects in %d pages' % (self.name or 'all', self.defects, self.pages)]
+        else:
+            s = ['%s:' % (self.name or 'all',)]
+        s.append('  %-20s %-32s %11s %10s' % ('phase', 'method', 'calls', 'seconds'))
+        for phase, method, calls, mark, seconds in self.rows:
+            s.append('  %-20s %-32s %2s %8d %10.1f' % (phase, method,
+                mark, calls, seconds))
+        s.append('  %-20s %-32s %2s %8d %10.1f' % ('total', '',
+            self.mark, self.calls, self.seconds))
+        s.extend(['  warning: ' + w for w in self.warnings])
+        return '\n'.join(s) + '\n'
+
+def run(parser, scopes, reporters, out=None):
+    '''
+    Estimate the reports for each project or stream in "scopes", and write
+    the estimates to "out", or stdout.  Returns the exit status.
+    '''
+    if out is None:
+        out = sys.stdout
+
+    estimates = []
+    for name, options in scopes:
+        calls = _total_calls()
+        start = time.time()
+        scope = parser.defect_scope(ws.client, options)
+        e = ReportEstimate(name, scope, parser.jobs(options), reporters,
+                           setup_calls=_total_calls() - calls,
+                           setup_seconds=time.time() - start)
+        out.write(e.report())
+        estimates.append(e)
+
+    if len(estimates) > 1:
+        seconds = sum([e.seconds for e in estimates])
+        mark = _combined_mark([e.mark for e in estimates])
+        out.write('all: %s%d calls, %.1f seconds (about %.1f with --parallel %d)\n' % (
+            mark and mark + ' ',
+            sum([e.calls for e in estimates]), seconds,
+            seconds / max(1, min(parser.options.parallel, len(estimates))),
+            parser.options.parallel))
+
+    # Keep the metadata fetched for the run
+    ws.metadata.save()
+
+    if parser.options.stats:
+        sys.stderr.write(ws.stats.summary())
+        sys.stderr.write(ws.scheduler.summary())
+        if ws.hedging.methods:
+            sys.stderr.write(ws.hedging.summary())
+    return 0
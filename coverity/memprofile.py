@@ -0,0 +1,212 @@
+'''
+Memory profiling of a run, one snapshot at the end of each phase (see
+coverity.tracing).
+
+Each snapshot records the process's resident memory, the objects whose
+counts grew most since the previous snapshot (by type, using the garbage
+collector), and the size of each cache in coverity.ws.  If the tracemalloc
+module is available (it's in the standard library from Python 3.4, and
+pytracemalloc provides it for patched Python 2 builds), the snapshot also
+lists the source lines which allocated the most memory since the previous
+one.
+'''
+
+import gc
+import os
+import sys
+import time
+import threading
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from coverity import tracing
+
+def _rss():
+    '''
+    Returns (current, peak) resident memory in bytes.  Either may be None if
+    it isn't available on this platform.
+    '''
+    current = peak = None
+    try:
+        f = open('/proc/self/statm')
+        try:
+            current = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        finally:
+            f.close()
+    except (IOError, OSError, ValueError, AttributeError):
+        pass
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports KB, Mac OS X reports bytes
+        if sys.platform != 'darwin':
+            peak *= 1024
+    return current, peak
+
+def _sizeof(obj, seen, depth=6):
+    '''
+    Roughly estimate the memory used by obj and the objects it refers to.
+    '''
+    if id(obj) in seen or depth == 0:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj, 0)
+    if isinstance(obj, dict):
+        for k, v in obj.items():
+            size += _sizeof(k, seen, depth-1) + _sizeof(v, seen, depth-1)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for x in obj:
+            size += _sizeof(x, seen, depth-1)
+    elif hasattr(obj, '__dict__'):
+        size += _sizeof(obj.__dict__, seen, depth-1)
+    return size
+
+def _type_counts():
+    counts = {}
+    for obj in gc.get_objects():
+        name = type(obj).__name__
+        if name == 'instance':
+            # Old-style classes, including suds objects
+            name = obj.__class__.__name__
+        counts[name] = counts.get(name, 0) + 1
+    return counts
+
+def _human(n):
+    if n is None:
+        return '?'
+    for unit in ('B', 'KB', 'MB'):
+        if abs(n) < 1024:
+            return '%d%s' % (n, unit)
+        n /= 1024.0
+    return '%.1fGB' % (n,)
+
+class MemoryProfiler(object):
+    '''
+    Takes a snapshot at the end of each phase span once enabled, and
+    summarizes them with report().
+    '''
+    # Number of types and allocating lines listed per snapshot
+    top = 10
+
+    def __init__(self):
+        self.enabled = False
+        self.snapshots = []
+        self.notes = []
+        self._lock = threading.Lock()
+        self._counts = None
+        self._trace = None
+
+    def enable(self):
+        if self.enabled:
+            return
+        self.enabled = True
+        if tracemalloc is not None:
+            tracemalloc.start(10)
+            self._trace = tracemalloc.take_snapshot()
+        self._counts = _type_counts()
+        tracing.tracer.add_listener(self._span_ended)
+
+    def _span_ended(self, name, category, args):
+        if category == 'phase':
+            label = name
+            if args.get('scope'):
+                label += ' (%s)' % (args['scope'],)
+            self.snapshot(label)
+
+    def cache_sizes(self):
+        '''
+        Returns a list of (name, entries, estimated bytes) for the caches in
+        coverity.ws.
+        '''
+        from coverity import ws
+        caches = [(name, bucket) for name, bucket in sorted(ws._cache.items())]
+        caches.append(('metadata', ws.metadata._entries))
+        caches.append(('snapshot_cids', ws.snapshot_cids._cids))
+        return [(name, len(bucket), _sizeof(bucket, set()))
+                for name, bucket in caches]
+
+    def snapshot(self, label):
+        '''
+        Record the memory use now, labelled with label.
+        '''
+        with self._lock:
+            current, peak = _rss()
+            counts = _type_counts()
+            growth = sorted([(n - self._counts.get(name, 0), name)
+                             for name, n in counts.items()], reverse=True)
+            self._counts = counts
+
+            allocators = []
+            if tracemalloc is not None:
+                trace = tracemalloc.take_snapshot()
+                for stat in trace.compare_to(self._trace, 'lineno')[:self.top]:
+                    frame = stat.traceback[0]
+                    allocators.append(('%s:%d' % (frame.filename, frame.lineno),
+                                       stat.size_diff, stat.count_diff))
+                self._trace = trace
+
+            self.snapshots.append({
+                'label': label,
+                'time': time.time(),
+                'rss': current,
+                'peak_rss': peak,
+                'objects': sum(counts.values()),
+                'growth': [(name, n) for n, name in growth[:self.top] if n > 0],
+                'allocators': allocators,
+                'caches': self.cache_sizes(),
+                })
+
+    def note(self, label, nbytes):
+        '''
+        Record the size of something that isn't in a cache, like the
+        rendered reports.
+        '''
+        if self.enabled:
+            with self._lock:
+                self.notes.append((label, nbytes))
+
+    def report(self):
+        '''
+        Returns a text summary of the snapshots.
+        '''
+        s = []
+        prev = None
+        for snap in self.snapshots:
+            delta = ''
+            if prev and snap['rss'] is not None and prev['rss'] is not None:
+                delta = ' (%+d KB)' % ((snap['rss'] - prev['rss']) / 1024,)
+            s.append('After %s: rss %s%s, peak %s, %d objects' % (snap['label'],
+                _human(snap['rss']), delta, _human(snap['peak_rss']), snap['objects']))
+            if snap['growth']:
+                s.append('  object growth:')
+                s.extend(['    %-40s %+d' % x for x in snap['growth']])
+            if snap['allocators']:
+                s.append('  top allocators:')
+                s.extend(['    %-60s %10s %+d blocks' % (where, _human(size), count)
+                          for where, size, count in snap['allocators']])
+            s.append('  caches:')
+            s.extend(['    %-20s %8d entries %10s' % (name, n, _human(size))
+                      for name, n, size in snap['caches']])
+            prev = snap
+        if self.notes:
+            s.append('Other:')
+            s.extend(['  %-40s %s' % (label, _human(n)) for label, n in self.notes])
+        if tracemalloc is None:
+            s.append('(tracemalloc is not available, so allocating lines are not listed)')
+        return '\n'.join(s) + '\n'
+
+    def write(self, filename):
+        f = open(filename, 'w')
+        try:
+            f.write(self.report())
+        finally:
+            f.close()
+
+profiler = MemoryProfiler()
@@ -9,7 +9,7 @@
 # Seek to "TEMPLATE_START" to view the existing templates.
 # Seek to "TEMPLATE_END" to add new templates.
 
-from cim_charts import defect_counts, Template, CSVTemplate, ChartTemplate, MetricsChartTemplate, CircleChartTemplate, XMLTemplate
+from cim_charts import defect_counts, Template, CSVTemplate, ChartTemplate, MetricsChartTemplate, CircleChartTemplate, XMLTemplate, JSONTemplate, NDJSONTemplate, FragmentTemplate, budget
 
 #=========================================================
 # Template classes to be used for the individual reports
@@ -75,6 +75,16 @@ render_as_xml = XMLTemplate('cid','status','checkerName','classification','owner
 render_as_csv = CSVTemplate('cid','status','checkerName','classification','owner','severity','action','firstDetected.strftime("%Y-%m-%d")','componentName','filePathname','scope',
     columns=('CID','Status','Checker','Classification','Owner','Severity','Action','FirstDetected','Component','File','Scope')
 )
+
+# List the defects as JSON, either as a single document or as one object per
+# line.  The "_instances" variants also include each defect's defectInstances.
+_json_fields = ('cid','status','checkerName','classification','owner','severity','action','firstDetected.strftime("%Y-%m-%d")','componentName','filePathname','scope')
+_json_columns = ('cid','status','checker','classification','owner','severity','action','first_detected','component','file','scope')
+render_as_json = JSONTemplate(*_json_fields, columns=_json_columns)
+render_as_ndjson = NDJSONTemplate(*_json_fields, columns=_json_columns)
+render_as_json_instances = JSONTemplate(*_json_fields, columns=_json_columns, instances=True)
+render_as_ndjson_instances = NDJSONTemplate(*_json_fields, columns=_json_columns, instances=True)
+
 render_as_metrics_csv = CSVTemplate('metricsDate', 'projectId.name',"totalCount","newCount","outstandingCount","resolvedCount","dismissedCount","fixedCount","inspectedCount","triagedCount",
     columns=('Date', 'Project',"Total","New","Outstanding","Resolved","Dismissed","Fixed","Inspected","Triaged")
 )
@@ -102,7 +112,7 @@ render_as_multcomp_csv = CSVTemplate('cid','status','classification','owner','co
 # More complex reports
 
 # List the defects in an HTML table format.
-render_as_table = Template(
+render_as_table = FragmentTemplate(
     '''
     <html><body>
     <p>${intro}$</p>
@@ -115,7 +125,11 @@ render_as_table = Template(
         <th>File</th>
         <th>Function</th>
     </tr>
-    ${for defect in defects:}$
+    ${emit(''.join(fragments))}$
+    </table>
+    </body></html>
+    ''',
+    '''
         <tr>
         <td><a href="${defect.url}$">${defect.cid}$</a></td>
         <td>${defect.checkerName}$</td>
@@ -125,41 +139,44 @@ render_as_table = Template(
         <td>${defect.filePathname}$</td>
         <td>${defect.scope}$</td>
         </tr>
-    ${:end-for}$
-    </table>
-    </body></html>
-    '''
+    ''',
+    mime_subtype='html'
     )
 
 # List the defects in an HTML list format.
 
-render_as_list = Template(
+render_as_list = FragmentTemplate(
 '''
 <html><body>
 <p>${intro}$</p>
 <ul>
-${for defect in defects:
-}$<li><div>
+${emit(''.join(fragments))}$
+</ul>
+</body></html>
+''',
+'''<li><div>
 <a href="${defect.url}$">${defect.cid}$</a> ${
 defect.checkerName}$ / ${defect.status}$ ${defect.owner}$ ${
 defect.firstDetected.strftime("%Y-%m-%d")}$
 <div>${defect.filePathname}$</div>
 <div>${defect.scope}$</div>
 </div></li>
-${:end-for}$
-</ul>
-</body></html>
-'''
+''',
+mime_subtype='html'
 )
 
 # This template renders the list of defects as a text report, and includes details
 # like events and source code snippets related to the defect.  The template text is a
-# bit hard to read since whitespace is significant in plain text output.
+# bit hard to read since whitespace is significant in plain text output.  To keep to
+# "--time-budget", it may leave out the snippets, listing just the events, and then
+# the checker descriptions.
 
-render_as_details = Template(
+render_as_details = FragmentTemplate(
 '''${intro}$
     
-${for defect in defects:}$
+${emit(''.join(fragments))}$
+''',
+'''
 ############################################
 ${defect.cid}$ ${defect.checkerName}$, found ${emit(defect.firstDetected.strftime("%Y-%m-%d %H:%M"))}$
 ${defect.status}$ / ${defect.owner}$
@@ -169,7 +186,7 @@ ${for inst in defect.defectInstances:}$
 In ${
 try: emit(inst.function.functionDisplayName)
 except AttributeError: emit('<unknown function>') }$ (${inst.function.fileId.filePathname}$)
-${src = SourceFile(defect.streamId, inst.function.fileId)
+${if show_source:}$${src = SourceFile(defect.streamId, inst.function.fileId)
 }$${for event in inst.events:}$${if not event.eventNumber:}$
 
 "${event.eventTag}$" event
@@ -185,26 +202,38 @@ ${for l in src.snippet(event.lineNumber, caption=event.eventDescription):}$${
     }$${:endif}$
 ${if l.lineNum:}$   ${:else:}$${if event.main:}$==> ${:else:}$ -> ${:endif}$${:endif
     }$ ${l.lineNum}$ ${l.text}$${
-:end-for}$${:endif}$${:end-for}$${:end-for}$
-${if not defect.defectInstances:}$
+:end-for}$${:endif}$${:end-for}$${:else:}$${for event in inst.events:}$${if not event.eventNumber:}$
+${if event.main:}$==> ${:else:}$ -> ${:endif}$${event.lineNumber}$ "${event.eventTag}$" ${event.eventDescription}$${
+    if event.main and show_description:}$${
+        checker = CheckerDescription(defect.checkerSubcategoryId)
+        }$
+      CID ${defect.cid}$: ${emit(checker.subcategoryShortDescription
+            or 'Unknown defect')}$${:endif}$${:endif}$${:end-for}$${:endif}$${:end-for}$
+${if not show_source and defect.defectInstances:}$
+(Source snippets left out to send this report on time)
+${:endif}$${if not defect.defectInstances:}$
 No source available; originally found in
 ${defect.scope}$ from ${defect.filePathname}$${:endif}$
-${:end-for}$
-'''
+''',
+degradable=True,
+per_stream=True
 )
 
 # This template renders the list of defects as an html report, and includes details
 # like events and source code snippets related to the defect.  Unfortunately, we can't
 # take advantage of much CSS or layout because some popular email readers like Outlook
-# 2007 have very limited HTML support.
+# 2007 have very limited HTML support.  Like the text version, it may leave out the
+# snippets and checker descriptions to keep to "--time-budget".
 
-render_as_details_html = Template(
+render_as_details_html = FragmentTemplate(
 '''<p>${intro}$<p>
 
-${for defect in defects:}$
-  ${checker = CheckerDescription(defect.checkerSubcategoryId)}$
+${emit(''.join(fragments))}$
+''',
+'''
+  ${if show_description:}$${checker = CheckerDescription(defect.checkerSubcategoryId)}$${:endif}$
   <div style="background-color:#ccc; padding:5px;"><a href="${defect.url}$">${defect.cid}$ ${defect.checkerName}$</a> found ${emit(defect.firstDetected.strftime("%Y-%m-%d %H:%M"))}$<br>
-  ${checker.subcategoryLongDescription}$
+  ${if show_description:}$${checker.subcategoryLongDescription}$${:else:}$<i>Checker description left out to send this report on time</i>${:endif}$
   </div>
   <p>${defect.status}$ / ${defect.owner}$</p>
   <ol>
@@ -213,7 +242,7 @@ ${for defect in defects:}$
         try: emit(inst.function.functionDisplayName)
         except AttributeError: emit('<unknown function>')
         }$ (${inst.function.fileId.filePathname}$)
-        ${src = SourceFile(defect.streamId, inst.function.fileId)}$
+        ${if show_source:}$${src = SourceFile(defect.streamId, inst.function.fileId)}$
         ${for event in inst.events:}$
             ${if not event.eventNumber:}$
                 <div>"<b>${event.eventTag}$" event</b></div>
@@ -237,15 +266,31 @@ ${for defect in defects:}$
                 ${:end-for}$
                 </table>
             ${:endif}$
+        ${:end-for}$${:else:}$
+        <table>
+        ${for event in inst.events:}$
+            ${if not event.eventNumber:}$
+                <tr>
+                <td color="#ccc" align="right">${event.lineNumber}$</td>
+                <td ${if event.main:}$style="background-color:#fcc; color:#f44; padding:3px;"${:endif}$
+                ><b>"${event.eventTag}$"</b> ${event.eventDescription}$${if event.main and show_description:}$<br>
+                    <b>CID ${defect.cid}$: ${emit(checker.subcategoryShortDescription
+                        or 'Unknown defect')}$</b>${:endif}$</td>
+                </tr>
+            ${:endif}$
         ${:end-for}$
+        </table>${:endif}$
     </li>
-  ${:end-for}$
+  ${:end-for}$${if not show_source and defect.defectInstances:}$
+  <p><i>Source snippets left out to send this report on time</i></p>${:endif}$
   ${if not defect.defectInstances:}$
     No source available; originally found in
     ${defect.scope}$ from ${defect.filePathname}$
   ${:endif}$
-${:end-for}$
-'''
+''',
+degradable=True,
+per_stream=True,
+mime_subtype='html'
 )
 
 # This report creates an HTML file which uses Javascript and the d3.js library
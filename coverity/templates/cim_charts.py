@@ -3,7 +3,14 @@ import math
 import sys
 import re
 import datetime
+import json
+import time
+import threading
 import suds
+import suds.sudsobject
+from cStringIO import StringIO
+from coverity.ws import using
+from coverity import tracing
 
 try:
     from collections import OrderedDict as odict
@@ -96,9 +103,11 @@ def defect_counts(defects, group_by, then_by = None):
     return dict_to_series(ret), cats
 
 # Use the "templite" module for string formatting.  Pasted here to reduce the
-# number of separate files required.  One change was made to the Templite+
+# number of separate files required.  Two changes were made to the Templite+
 # code: '.' was added to the Template.auto_emit re, so it will include object
-# members as well as variable names.
+# members as well as variable names, and render() collects the output of each
+# call in a list of its own instead of redirecting sys.stdout to the
+# instance, so templates can be rendered on several threads at once.
 
 ##################################################################
 #       Templite+
@@ -172,18 +181,14 @@ class Templite(object):
         namespace = {}
         if __namespace: namespace.update(__namespace)
         if kw: namespace.update(kw)
-        namespace['emit'] = self.write
-        
-        __stdout = sys.stdout
-        sys.stdout = self
-        self.__output = []
+        output = []
+        def emit(*args):
+            for a in args:
+                output.append(str(a))
+        namespace['emit'] = emit
+
         eval(self.__code, namespace)
-        sys.stdout = __stdout
-        return ''.join(self.__output)
-    
-    def write(self, *args):
-        for a in args:
-            self.__output.append(str(a))
+        return ''.join(output)
 
 # End of Templite.py code
 #=========================================
@@ -197,10 +202,15 @@ class Template(Templite):
     # Pull in some Coverity helper classes
     from coverity.ws import SourceFile, CheckerDescription, Component
 
-    def __init__(self, template, factory=None, **kw):
+    # The MIME subtype of the text/* reports when they're mailed
+    mime_subtype = 'plain'
+
+    def __init__(self, template, factory=None, mime_subtype=None, **kw):
         super(Template, self).__init__(template, **kw)
         # factory can be used to post-process the template text
         self._factory = factory
+        if mime_subtype:
+            self.mime_subtype = mime_subtype
 
     def __call__(self, __namespace=None, **kw):
         # Map in our local helpers
@@ -216,7 +226,220 @@ class Template(Templite):
             t = self._factory(t)
         return t
 
+# Levels of detail for the fragments of a "degradable" FragmentTemplate, as
+# the time budget runs out
+FULL_DETAIL, NO_SOURCE, NO_DESCRIPTIONS = 0, 1, 2
+
+class TimeBudget(object):
+    '''
+    The time allowed for a run ("--time-budget"), and the detail that the
+    defects left to render can still afford.  start() begins the run,
+    expect() adds defects to be rendered, and rendered() records how long
+    each took.  When rendering the rest at the current detail looks likely
+    to overrun, detail() drops the source snippets, and then the checker
+    descriptions as well.  A fraction of the budget is kept back for
+    sending the reports.
+    '''
+    reserve = 0.1
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.start(0)
+
+    def start(self, seconds):
+        '''
+        Begin a run with a budget of "seconds" (0 for no budget).
+        '''
+        with self._lock:
+            self.seconds = seconds
+            self._start = time.time()
+            self._remaining = 0
+            # Seconds and number of fragments rendered at each detail
+            self._costs = {}
+            self.truncated = {}
+
+    def expect(self, n):
+        '''
+        Add n fragments to be rendered, including any which will be found
+        in the cache.
+        '''
+        with self._lock:
+            self._remaining += n
+
+    def rendered(self, detail, seconds, cached=False):
+        '''
+        Record a fragment rendered with the given detail in "seconds".  A
+        fragment found in the cache is recorded as costing nothing, so the
+        mean cost reflects the share of fragments that are reused.  It
+        isn't counted as truncated again.
+        '''
+        with self._lock:
+            self._remaining = max(0, self._remaining - 1)
+            total, n = self._costs.get(detail, (0.0, 0))
+            self._costs[detail] = (total + seconds, n + 1)
+            if detail != FULL_DETAIL and not cached:
+                self.truncated[detail] = self.truncated.get(detail, 0) + 1
+
+    def detail(self):
+        '''
+        Returns the most detail the remaining defects can afford.  Details
+        whose cost isn't known yet are tried while there's time left.
+        '''
+        if not self.seconds:
+            return FULL_DETAIL
+        with self._lock:
+            left = self.seconds * (1 - self.reserve) - (time.time() - self._start)
+            for detail in (FULL_DETAIL, NO_SOURCE):
+                if detail not in self._costs:
+                    if left > 0:
+                        return detail
+                    continue
+                total, n = self._costs[detail]
+                # A worker's share of the fragments may be a few short
+                if max(1, self._remaining) * total / n <= left:
+                    return detail
+            return NO_DESCRIPTIONS
+
+    def counts(self):
+        '''
+        Returns the fragments rendered so far, to pass to merge().
+        '''
+        with self._lock:
+            return dict(self._costs), dict(self.truncated)
+
+    def expect_only(self, n):
+        '''
+        Expect just n more fragments, in a render worker rendering its share
+        of the parent's.
+        '''
+        with self._lock:
+            self._remaining = n
+
+    def merge(self, before, after):
+        '''
+        Add the fragments rendered by another process (a render worker)
+        between its counts() "before" and "after".
+        '''
+        with self._lock:
+            for detail, (total, n) in after[0].items():
+                total_before, n_before = before[0].get(detail, (0.0, 0))
+                if n > n_before:
+                    t, m = self._costs.get(detail, (0.0, 0))
+                    self._costs[detail] = (t + total - total_before, m + n - n_before)
+                    self._remaining = max(0, self._remaining - (n - n_before))
+            for detail, n in after[1].items():
+                n -= before[1].get(detail, 0)
+                if n:
+                    self.truncated[detail] = self.truncated.get(detail, 0) + n
+
+    def summary(self):
+        '''
+        Returns a line describing the defects rendered with less detail, or
+        None if there weren't any.
+        '''
+        if not self.truncated:
+            return None
+        return ('%d defects were rendered without source snippets, %d of them also without '
+                'checker descriptions, to keep to the time budget\n'
+                % (sum(self.truncated.values()), self.truncated.get(NO_DESCRIPTIONS, 0)))
+
+budget = TimeBudget()
+
+class FragmentTemplate(Template):
+    '''
+    A Template which renders each defect separately, using the "fragment"
+    template, and caches the result.  A defect that is reported to several
+    recipients is then rendered only once per run, and each report is just
+    an assembly of cached fragments.  The main template receives the rendered
+    fragments as "fragments", in the same order as "defects".
+
+    The fragment template only receives "defect" and "options", so it must
+    not depend on anything specific to the recipient.  If "degradable" is
+    set, it also receives "show_source" and "show_description", which are
+    turned off as the time budget runs out.  The fragment should then skip
+    the source snippets or checker descriptions, and say it has.  If the
+    fragment shows the defect as found in one stream (its instances, events
+    and source), set "per_stream" so it isn't reused for another stream.
+
+    The fragments can also be passed to the template already rendered, as
+    "fragments" (see coverity.email.render_reports()).
+    '''
+    from coverity.ws import _cache
+
+    # Defect fields which change when the defect is modified.  These are part
+    # of the cache key so we never reuse a fragment for a stale defect.
+    _state_fields = ('status', 'owner', 'classification', 'action', 'severity',
+                     'lastTriaged', 'lastDetected')
+
+    def __init__(self, template, fragment, factory=None, degradable=False, per_stream=False, **kw):
+        super(FragmentTemplate, self).__init__(template, factory=factory, **kw)
+        self._fragment = Template(fragment, **kw)
+        self.degradable = degradable
+        self.per_stream = per_stream
+        self._cache.setdefault('fragments', {})
+
+    def fragment_key(self, defect, detail=FULL_DETAIL):
+        '''
+        Returns the cache key for defect's fragment with the given detail.
+        The format is identified by this template instance, and the server
+        by the defect's instance when reporting on several servers.  The
+        project is part of the key since it's in the defect's URL.
+        '''
+        key = (defect.cid, getattr(defect, 'instance', None), getattr(defect, 'projId', None), id(self), detail)
+        if self.per_stream:
+            key += (defect.streamId.name,)
+        return key + tuple([getattr(defect, f, None) for f in self._state_fields])
+
+    def render_fragment(self, defect, options=None):
+        '''
+        Returns the rendered fragment for defect, rendering it if necessary.
+        '''
+        return self.fragment(defect, options)[2]
+
+    def fragment(self, defect, options=None):
+        '''
+        Returns (key, detail, text) for defect's fragment: its cache key, its
+        detail and its text, rendering it if necessary.  A fragment already
+        rendered with more detail than the budget allows now is used as it
+        is.  Helpers like SourceFile use the defect's server.
+        '''
+        detail = FULL_DETAIL
+        if self.degradable:
+            detail = budget.detail()
+        for cached in range(FULL_DETAIL, detail + 1):
+            key = self.fragment_key(defect, cached)
+            try:
+                text = self._cache['fragments'][key]
+            except KeyError:
+                continue
+            tracing.instant('cache hit', 'cache', cache='fragments')
+            if self.degradable:
+                budget.rendered(cached, 0.0, cached=True)
+            return key, cached, text
+
+        tracing.instant('cache miss', 'cache', cache='fragments')
+        start = time.time()
+        kw = {}
+        if self.degradable:
+            kw = {'show_source': detail < NO_SOURCE,
+                  'show_description': detail < NO_DESCRIPTIONS}
+        with using(getattr(defect, 'client', None)):
+            text = self._fragment(defect=defect, options=options, **kw)
+        if self.degradable:
+            budget.rendered(detail, time.time() - start)
+        key = self.fragment_key(defect, detail)
+        self._cache['fragments'][key] = text
+        return key, detail, text
+
+    def __call__(self, __namespace=None, **kw):
+        defects = list(kw.pop('defects', ()))
+        fragments = kw.pop('fragments', None)
+        if fragments is None:
+            fragments = [self.render_fragment(d, kw.get('options')) for d in defects]
+        return super(FragmentTemplate, self).__call__(__namespace, defects=defects, fragments=fragments, **kw)
+
 class ChartTemplate(Template):
+    mime_subtype = 'html'
     _template = '''
 <!DOCTYPE html>
 <html>
@@ -710,8 +933,39 @@ ${:end-for}$
             self._clean = False
         if not fields:
             raise ValueError("You must specify a list of fields for the CSV output!")
+        self._compiled = {}
         super(CSVTemplate, self).__init__(self._template, factory=None, **kw)
 
+    def _resolve(self, obj, x):
+        '''
+        Resolve field specification "x" against obj, returning the raw value.
+        '''
+        try:
+            field, rest, code = self._compiled[x]
+        except KeyError:
+            prefix = 'raise Exception("BAD EXPRESSION")'
+            if x[0] == '!':
+                field,rest = x[1:].split(' ',1)
+                prefix = ''
+            elif '.' in x:
+                field,rest = x.split('.',1)
+                prefix = 'v.'
+            else:
+                field = x
+                rest = ''
+            # Compile the expression once, rather than once per defect
+            code = rest and compile(prefix+rest, '<field %s>' % (x,), 'eval')
+            self._compiled[x] = (field, rest, code)
+        # Get the member value
+        v = getattr(obj, field, '')
+        if rest:
+            # Apply method if specified
+            try:
+                v = eval(code, {}, {'v':v})
+            except AttributeError, e:
+                raise Exception('ERROR with %s.%s'%(field,rest), obj.component, v, e)
+        return v
+
     def __call__(self, __namespace=None, **kw):
         def do_quote(x):
             '''
@@ -729,24 +983,7 @@ ${:end-for}$
             '''
             Function to handle resolving members and quoting appropriately.
             '''
-            prefix = 'raise Exception("BAD EXPRESSION")'
-            if x[0] == '!':
-                field,rest = x[1:].split(' ',1)
-                prefix = ''
-            elif '.' in x:
-                field,rest = x.split('.',1)
-                prefix = 'v.'
-            else:
-                field = x
-                rest = ''
-            # Get the member value
-            v = getattr(obj, field, '')
-            if rest:
-                # Apply method if specified
-                try:
-                    v = eval(prefix+rest, {}, {'v':v})
-                except AttributeError, e:
-                    raise Exception('ERROR with %s.%s'%(field,rest), obj.component, v, e)
+            v = self._resolve(obj, x)
             return self._unquoted and v or do_quote(v)
         return super(CSVTemplate, self).__call__(__namespace, fields=self._fields, columns=self._columns, resolve=res, clean=self._clean, **kw)
 
@@ -756,6 +993,7 @@ class XMLTemplate(CSVTemplate):
     '''
     
     _unquoted = True
+    mime_subtype = 'xml'
 
     # This is our basic template
     _template = '''${if options.raw != True:}$<?xml version="1.0" encoding="UTF-8"?>
@@ -767,6 +1005,96 @@ columns[i]}$>${emit(resolve(defect,fields[i]))}$</${columns[i]}$>${
 }$</defect>
 ${:end-for}$'''
 
+class JSONTemplate(CSVTemplate):
+    '''
+    A wrapper for Template that outputs JSON data.  The defects are serialized
+    with a JSON encoder rather than through Templite, so there is no per-defect
+    template evaluation, and the output is written in batches as it is
+    produced.  Pass instances=True to include each defect's defectInstances.
+    '''
+
+    # We produce the output ourselves, so the Templite template is unused
+    _template = ''
+
+    # Number of defects to serialize between writes to the output
+    _batch_size = 500
+
+    def __init__(self, *fields, **kw):
+        self._instances = kw.pop('instances', False)
+        super(JSONTemplate, self).__init__(*fields, **kw)
+        self._encoder = json.JSONEncoder(default=self._default, separators=(',',':'))
+
+    @staticmethod
+    def _default(obj):
+        '''
+        Convert the types that the json module doesn't handle natively.
+        '''
+        if isinstance(obj, (datetime.datetime, datetime.date)):
+            return obj.isoformat()
+        elif isinstance(obj, suds.sudsobject.Object):
+            return odict(suds.sudsobject.items(obj))
+        raise TypeError('Type %s not supported by JSONTemplate' % (type(obj),))
+
+    def _record(self, defect):
+        '''
+        Build the mapping of column names to values for a single defect.
+        '''
+        rec = odict()
+        for field, column in zip(self._fields, self._columns):
+            rec[column] = self._resolve(defect, field)
+        if self._instances:
+            rec['defectInstances'] = getattr(defect, 'defectInstances', None) or []
+        return rec
+
+    def _pieces(self, defects, intro, raw):
+        '''
+        Generate the output text, one defect at a time.
+        '''
+        encode = self._encoder.encode
+        if not raw:
+            yield '{"intro":%s,"defects":' % (encode(intro),)
+        yield '['
+        sep = ''
+        for defect in defects:
+            yield sep + encode(self._record(defect))
+            sep = ','
+        yield ']'
+        if not raw:
+            yield '}'
+        yield '\n'
+
+    def stream(self, out, __namespace=None, **kw):
+        '''
+        Write the report to file-like object "out".  Takes the same arguments
+        as calling the template.
+        '''
+        ns = dict(__namespace or {})
+        ns.update(kw)
+        raw = getattr(ns.get('options'), 'raw', None) == True
+        batch = []
+        for piece in self._pieces(ns.get('defects', ()), ns.get('intro', ''), raw):
+            batch.append(piece)
+            if len(batch) >= self._batch_size:
+                out.write(''.join(batch))
+                batch = []
+        if batch:
+            out.write(''.join(batch))
+
+    def __call__(self, __namespace=None, **kw):
+        out = StringIO()
+        self.stream(out, __namespace, **kw)
+        return out.getvalue()
+
+class NDJSONTemplate(JSONTemplate):
+    '''
+    A wrapper for Template that outputs newline-delimited JSON data, with
+    one defect object per line and no header.
+    '''
+    def _pieces(self, defects, intro, raw):
+        encode = self._encoder.encode
+        for defect in defects:
+            yield encode(self._record(defect)) + '\n'
+
 class CircleChartTemplate(ChartTemplate):
     _template = '''
 <!DOCTYPE html>
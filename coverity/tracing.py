@@ -0,0 +1,107 @@
+'''
+Span-based tracing of a run, exported in the Chrome trace event format.
+
+Tracing is off until tracer.enable() is called, and the hooks cost little
+while it's off.  Code marks its phases with::
+
+    with tracing.span('fetch defects', 'phase', project=name):
+        ...
+
+and point events like cache hits with tracing.instant().  The exported
+file can be opened in chrome://tracing or https://ui.perfetto.dev.
+
+Functions added with tracer.add_listener() are called as
+listener(name, category, args) at the end of every span, whether or not
+events are being recorded.
+'''
+
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+class Tracer(object):
+    '''
+    Collects trace events from all threads.
+    '''
+    def __init__(self):
+        self.enabled = False
+        self._listeners = []
+        self._events = []
+        self._lock = threading.Lock()
+        self._start = time.time()
+
+    def enable(self):
+        self.enabled = True
+
+    def add_listener(self, func):
+        self._listeners.append(func)
+
+    def clear(self):
+        with self._lock:
+            self._events = []
+
+    def _timestamp(self, t=None):
+        # Microseconds since the tracer was created
+        return int(((t or time.time()) - self._start) * 1e6)
+
+    def _add(self, event):
+        event['pid'] = os.getpid()
+        event['tid'] = threading.current_thread().ident
+        with self._lock:
+            self._events.append(event)
+
+    @contextmanager
+    def span(self, name, category='phase', **args):
+        '''
+        Record the "with" block as a span.
+        '''
+        if not (self.enabled or self._listeners):
+            yield
+            return
+        start = time.time()
+        try:
+            yield
+        finally:
+            if self.enabled:
+                self._add({'name': name, 'cat': category, 'ph': 'X',
+                           'ts': self._timestamp(start),
+                           'dur': self._timestamp() - self._timestamp(start),
+                           'args': args})
+            for func in self._listeners:
+                func(name, category, args)
+
+    def instant(self, name, category='event', **args):
+        '''
+        Record a point event, like a cache hit.
+        '''
+        if self.enabled:
+            self._add({'name': name, 'cat': category, 'ph': 'i', 's': 't',
+                       'ts': self._timestamp(), 'args': args})
+
+    def events(self):
+        '''
+        Returns the events recorded so far, plus the thread names.
+        '''
+        with self._lock:
+            events = list(self._events)
+        for t in threading.enumerate():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(),
+                           'tid': t.ident, 'args': {'name': t.name}})
+        return events
+
+    def export(self, filename):
+        '''
+        Write the events to filename as Chrome trace event JSON.
+        '''
+        f = open(filename, 'w')
+        try:
+            json.dump({'traceEvents': self.events(), 'displayTimeUnit': 'ms'},
+                      f, default=str)
+        finally:
+            f.close()
+
+tracer = Tracer()
+span = tracer.span
+instant = tracer.instant
@@ -19,6 +19,10 @@ Typical usage will look something like this:
 Once connected, you can interact with the web services via
 ws.client.config, ws.client.defect, and ws.client.admin
 
+To report on several servers at once, connect a MultiServiceClient instead
+and use MultiScope and MultiReporter.  ws.client then refers to whichever
+server the current thread is using (see using()).
+
 note that the admin service is only applicable to 5.0 through 5.4.1.
 
 This module has been most extensively used with CIM v5.5.1 and v6.5.1.
@@ -27,10 +31,565 @@ That is especially true of the helper classes like the Reporter, Handler,
 Processor, and so forth.
 """
 
-import os, urllib, datetime, zlib, sys
+import os, re, urllib, datetime, zlib, sys, threading, copy, time, collections, Queue
+from array import array
+import cPickle as pickle
+from contextlib import contextmanager
+import suds.sudsobject
+from suds.plugin import MessagePlugin
+
+from coverity import tracing
+from coverity.ws import cassette
 from base64 import standard_b64decode
 from optparse import OptionParser
 
+# -----------------------------------------------------------------------------
+# Instrumentation of the web service calls
+class CallStats(object):
+    '''
+    Statistics for each web service method called: the number of calls and
+    errors, a histogram of latencies, and the bytes sent and received.
+    Every call through a CoverityWebServiceClient is recorded in ws.stats.
+    '''
+    # Upper bounds in seconds of the latency histogram buckets.  There is
+    # one more bucket for anything slower.
+    buckets = (0.01, 0.03, 0.1, 0.3, 1, 3, 10)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.methods = {}
+
+    def _method(self, name):
+        try:
+            return self.methods[name]
+        except KeyError:
+            m = self.methods[name] = {
+                'calls': 0,
+                'errors': 0,
+                'seconds': 0.0,
+                'max_seconds': 0.0,
+                'histogram': [0] * (len(self.buckets) + 1),
+                'bytes_sent': 0,
+                'bytes_received': 0,
+                }
+            return m
+
+    def record(self, name, seconds, sent=0, received=0, error=None):
+        with self._lock:
+            m = self._method(name)
+            m['calls'] += 1
+            m['seconds'] += seconds
+            m['max_seconds'] = max(m['max_seconds'], seconds)
+            m['bytes_sent'] += sent
+            m['bytes_received'] += received
+            if error is not None:
+                m['errors'] += 1
+            for i, bound in enumerate(self.buckets):
+                if seconds < bound:
+                    break
+            else:
+                i = len(self.buckets)
+            m['histogram'][i] += 1
+
+    def call(self, name, method, *args, **kw):
+        '''
+        Call a web service method, and record it as "name".
+        '''
+        _local.message_bytes = [0, 0]
+        start = time.time()
+        error = None
+        try:
+            with tracing.span(name, 'ws'):
+                return method(*args, **kw)
+        except Exception, e:
+            error = e
+            raise
+        finally:
+            sent, received = _local.message_bytes
+            self.record(name, time.time() - start, sent, received, error)
+
+    def as_dict(self):
+        '''
+        Returns a copy of the statistics, keyed by method name.
+        '''
+        with self._lock:
+            return copy.deepcopy(self.methods)
+
+    def summary(self):
+        '''
+        Returns a table of the statistics, slowest methods first.
+        '''
+        methods = self.as_dict()
+        labels = ['<%gs' % (b,) for b in self.buckets] + ['>=%gs' % (self.buckets[-1],)]
+        s = ['%-32s %6s %6s %9s %8s %8s %11s %11s  %s' % ('method', 'calls',
+            'errors', 'seconds', 'mean', 'max', 'sent', 'received',
+            ' '.join(labels))]
+        for name, m in sorted(methods.items(), key=lambda x: -x[1]['seconds']):
+            s.append('%-32s %6d %6d %9.2f %8.3f %8.3f %11d %11d  %s' % (name,
+                m['calls'], m['errors'], m['seconds'],
+                m['seconds'] / m['calls'], m['max_seconds'],
+                m['bytes_sent'], m['bytes_received'],
+                ' '.join(['%*d' % (len(l), n) for l, n in zip(labels, m['histogram'])])))
+        return '\n'.join(s) + '\n'
+
+stats = CallStats()
+
+def idempotent(name):
+    '''
+    Returns whether the web service method "name" only reads, so calling
+    it twice is harmless.
+    '''
+    return name.startswith('get')
+
+def _call_key(v):
+    '''
+    Returns a hashable form of a web service call's argument.
+    '''
+    if isinstance(v, suds.sudsobject.Object):
+        return (v.__class__.__name__,
+                tuple([(k, _call_key(x)) for k, x in suds.sudsobject.items(v)]))
+    elif isinstance(v, (list, tuple)):
+        return tuple([_call_key(x) for x in v])
+    elif isinstance(v, dict):
+        return tuple(sorted([(k, _call_key(x)) for k, x in v.items()]))
+    return v
+
+class _PendingCall(object):
+    '''
+    A call in flight, whose result is shared by identical calls made in
+    the meantime.
+    '''
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._error = None
+
+    def finish(self, result=None, error=None):
+        self._result = result
+        self._error = error
+        self._done.set()
+
+    def result(self):
+        self._done.wait()
+        if self._error is not None:
+            raise self._error[0], self._error[1], self._error[2]
+        return self._result
+
+class RequestScheduler(object):
+    '''
+    Every web service call goes through ws.scheduler.  At most
+    max_in_flight calls are made at once (0 means no limit); the others
+    wait for a slot.  Waiting calls with the lowest priority number go
+    first, and calls of the same priority take turns between the reports
+    they're made for (see report()), so one big report can't starve the
+    others.  Identical calls of idempotent methods which are made while
+    the first is in flight share its result instead of asking again.
+
+    A suds client can't have more than one call in flight, so method is
+    expected to make the call on a client of its own, as
+    CoverityWebServiceClient does (see its _checkout()).
+    '''
+    # Lower numbers are served first.  Metadata and pages of defects hold
+    # up everything after them, while lookups made for each defect as it's
+    # rendered can wait.
+    priorities = {
+        'getProjects': 0,
+        'getStreams': 0,
+        'getUsers': 0,
+        'getAssignableUsers': 0,
+        'getSnapshotsForStream': 0,
+        'getSnapshotInformation': 0,
+        'getMergedDefectsForStreams': 1,
+        'notify': 1,
+        'getMergedDefectHistory': 2,
+        'getComponent': 2,
+        'getStreamDefects': 3,
+        'getCheckerProperties': 3,
+        'getComponentMaps': 3,
+        'getFileContents': 4,
+        }
+    default_priority = 2
+
+    # Share the results of identical idempotent calls in flight
+    coalesce = True
+
+    def __init__(self, max_in_flight=8):
+        self.max_in_flight = max_in_flight
+        self.priorities = dict(self.priorities)
+        self._setup()
+
+    def _setup(self):
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._waiting = 0
+        # For each priority with waiting calls, the queue of each report's
+        # calls, and the reports in the order they take turns
+        self._queues = {}
+        self._turns = {}
+        self._pending = {}
+        self.reset()
+
+    def reset(self):
+        self.queued = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.coalesced = 0
+        self.max_seen_in_flight = 0
+
+    def configure(self, options):
+        '''
+        Apply the "--ws-max-in-flight" and "--ws-priority" options.
+        '''
+        self.max_in_flight = options.ws_max_in_flight
+        for spec in [x for x in options.ws_priority.split(',') if x]:
+            name, priority = spec.split('=', 1)
+            self.priorities[name] = int(priority)
+
+    @contextmanager
+    def report(self, name):
+        '''
+        Make the calls in this thread for the duration of a "with" block on
+        behalf of the report "name", so they take turns with other reports.
+        '''
+        prev = getattr(_local, 'report', None)
+        _local.report = name
+        try:
+            yield
+        finally:
+            _local.report = prev
+
+    def _take(self):
+        # Called with the lock held
+        if not self.max_in_flight or (self._in_flight < self.max_in_flight
+                                      and not self._waiting):
+            self._in_flight += 1
+            self.max_seen_in_flight = max(self.max_seen_in_flight, self._in_flight)
+            return True
+        return False
+
+    def try_acquire(self):
+        '''
+        Take a slot for an extra request if one is free and nothing is
+        waiting, and return whether one was taken.  It must be given back
+        with release().
+        '''
+        with self._lock:
+            return self._take()
+
+    def _acquire(self, priority, report):
+        '''
+        Take a slot if one is free and nothing is waiting.  Otherwise,
+        returns an Event which is set when a slot is handed over.
+        '''
+        with self._lock:
+            if self._take():
+                return None
+            ready = threading.Event()
+            queues = self._queues.setdefault(priority, {})
+            if report not in queues:
+                queues[report] = collections.deque()
+                self._turns.setdefault(priority, collections.deque()).append(report)
+            queues[report].append(ready)
+            self._waiting += 1
+            self.queued += 1
+            return ready
+
+    def release(self):
+        '''
+        Hand the slot to the next waiting call, or free it.
+        '''
+        with self._lock:
+            if not self._waiting:
+                self._in_flight -= 1
+                return
+            priority = min(self._queues)
+            queues = self._queues[priority]
+            turns = self._turns[priority]
+            report = turns.popleft()
+            ready = queues[report].popleft()
+            if queues[report]:
+                # Back of the line for this report's next call
+                turns.append(report)
+            else:
+                del queues[report]
+            if not queues:
+                del self._queues[priority]
+                del self._turns[priority]
+            self._waiting -= 1
+        ready.set()
+
+    def call(self, service, name, method, *args, **kw):
+        '''
+        Call the web service method "name" of service, a
+        CoverityWebServiceClient, when a slot is free.  The call is
+        recorded in ws.stats.
+        '''
+        if os.getpid() != self._pid:
+            # A forked worker process doesn't have the other threads which
+            # held slots
+            self._setup()
+
+        key = None
+        if self.coalesce and idempotent(name):
+            try:
+                key = (service.wsdlFile, name, _call_key(args), _call_key(kw))
+                hash(key)
+            except TypeError:
+                key = None
+        if key is not None:
+            with self._lock:
+                pending = self._pending.get(key)
+                first = pending is None
+                if first:
+                    pending = self._pending[key] = _PendingCall()
+                else:
+                    self.coalesced += 1
+            if not first:
+                return pending.result()
+
+        try:
+            result = self._call(name, method, args, kw)
+        except Exception:
+            if key is not None:
+                self._finish(key, pending, error=sys.exc_info())
+            raise
+        if key is not None:
+            self._finish(key, pending, result=result)
+        return result
+
+    def _finish(self, key, pending, result=None, error=None):
+        with self._lock:
+            del self._pending[key]
+        pending.finish(result, error)
+
+    def _call(self, name, method, args, kw):
+        ready = self._acquire(self.priorities.get(name, self.default_priority),
+                              getattr(_local, 'report', None))
+        if ready is not None:
+            start = time.time()
+            with tracing.span('wait for slot', 'ws', method=name):
+                ready.wait()
+            waited = time.time() - start
+            with self._lock:
+                self.wait_seconds += waited
+                self.max_wait_seconds = max(self.max_wait_seconds, waited)
+        _local.slot_kept = False
+        try:
+            return stats.call(name, method, *args, **kw)
+        finally:
+            # A hedged call can return while its first attempt is still
+            # running, which then keeps the slot until it's done
+            if not _local.slot_kept:
+                self.release()
+
+    def summary(self):
+        return ('%d calls waited for a slot, %.2f seconds in all (at most %.2f), '
+                '%d shared the result of an identical call, at most %d in flight\n'
+                % (self.queued, self.wait_seconds, self.max_wait_seconds,
+                   self.coalesced, self.max_seen_in_flight))
+
+scheduler = RequestScheduler()
+
+class DeadlineExceeded(Exception):
+    '''
+    A web service call didn't return within its deadline.
+    '''
+
+class HedgedCalls(object):
+    '''
+    Control of the slowest calls of idempotent web service methods.  With a
+    percentile set, a call still running once it has taken longer than that
+    percentile of its method's recent latencies is sent again, and the
+    first reply is used.  The duplicate is only sent if ws.scheduler has a
+    free slot, so a busy server isn't loaded further.  With a deadline, a
+    call which hasn't returned in that many seconds raises
+    DeadlineExceeded.  The request isn't cancelled on the server, which is
+    why only idempotent methods get deadlines.
+
+    Each attempt holds a ws.scheduler slot until it has finished, even if
+    the call has returned without it, and uses a suds client of its own.
+    '''
+    # Latencies kept for each method, and how many are needed before its
+    # calls are hedged
+    window = 200
+    min_samples = 20
+
+    # Shortest wait before hedging, so fast methods aren't hedged because
+    # of noise
+    min_delay = 0.02
+
+    def __init__(self, percentile=0, deadline=0):
+        self.percentile = percentile
+        self.deadline = deadline
+        self._lock = threading.Lock()
+        self._latencies = {}
+        self.methods = {}
+
+    def configure(self, options):
+        '''
+        Apply the "--ws-hedge-percentile" and "--ws-deadline" options.
+        '''
+        self.percentile = options.ws_hedge_percentile
+        self.deadline = options.ws_deadline
+
+    def delay(self, name):
+        '''
+        Returns the seconds after which a call to method "name" is hedged,
+        or None if it isn't.
+        '''
+        if not self.percentile:
+            return None
+        with self._lock:
+            latencies = sorted(self._latencies.get(name, ()))
+        if len(latencies) < self.min_samples:
+            return None
+        i = min(len(latencies) - 1, int(len(latencies) * self.percentile / 100.0))
+        return max(self.min_delay, latencies[i])
+
+    def _count(self, name, what):
+        with self._lock:
+            try:
+                m = self.methods[name]
+            except KeyError:
+                m = self.methods[name] = {'calls': 0, 'hedged': 0, 'hedge_wins': 0,
+                                          'deadlines': 0}
+            m[what] += 1
+
+    def _sample(self, name, seconds):
+        with self._lock:
+            try:
+                latencies = self._latencies[name]
+            except KeyError:
+                latencies = self._latencies[name] = collections.deque(maxlen=self.window)
+            latencies.append(seconds)
+
+    def method(self, name, method):
+        '''
+        Returns method, the web service method "name", wrapped for hedging
+        and its deadline if they apply to it.
+        '''
+        if not idempotent(name) or not (self.percentile or self.deadline):
+            return method
+        def call(*args, **kw):
+            return self._call(name, method, args, kw)
+        return call
+
+    def _call(self, name, method, args, kw):
+        self._count(name, 'calls')
+        results = Queue.Queue()
+        # The attempts' messages are counted for this call
+        message_bytes = getattr(_local, 'message_bytes', None)
+        # Whether the first attempt has finished, and whether the caller has
+        # left it the slot it was called in to release when it finishes
+        lock = threading.Lock()
+        first = {'done': False, 'keeps_slot': False}
+        def attempt(hedge):
+            _local.message_bytes = message_bytes
+            start = time.time()
+            try:
+                result = method(*args, **kw)
+            except Exception:
+                results.put((hedge, False, sys.exc_info()))
+            else:
+                self._sample(name, time.time() - start)
+                results.put((hedge, True, result))
+            finally:
+                if hedge:
+                    scheduler.release()
+                else:
+                    with lock:
+                        first['done'] = True
+                        keeps_slot = first['keeps_slot']
+                    if keeps_slot:
+                        scheduler.release()
+        def leave():
+            # Called before returning.  A first attempt that's still running
+            # keeps the caller's slot (see RequestScheduler._call()).
+            with lock:
+                if not first['done']:
+                    first['keeps_slot'] = True
+                    _local.slot_kept = True
+        def start(hedge):
+            t = threading.Thread(target=attempt, args=(hedge,),
+                                 name='%s%s' % (name, hedge and '-hedge' or ''))
+            t.daemon = True
+            t.start()
+
+        begin = time.time()
+        delay = self.delay(name)
+        start(False)
+        attempts = 1
+        while True:
+            # Wait for a reply until it's time to hedge or the deadline
+            waits = [24*3600]
+            if delay is not None:
+                waits.append(begin + delay - time.time())
+            if self.deadline:
+                waits.append(begin + self.deadline - time.time())
+            try:
+                hedge, ok, value = results.get(True, max(0, min(waits)))
+            except Queue.Empty:
+                if self.deadline and time.time() - begin >= self.deadline:
+                    self._count(name, 'deadlines')
+                    leave()
+                    raise DeadlineExceeded('%s took more than %g seconds' % (name, self.deadline))
+                if delay is not None:
+                    delay = None
+                    if scheduler.try_acquire():
+                        self._count(name, 'hedged')
+                        tracing.instant('hedge', 'ws', method=name)
+                        start(True)
+                        attempts += 1
+                continue
+            attempts -= 1
+            if ok:
+                if hedge:
+                    self._count(name, 'hedge_wins')
+                leave()
+                return value
+            if not attempts:
+                leave()
+                raise value[0], value[1], value[2]
+
+    def summary(self):
+        '''
+        Returns a table of the hedged calls and missed deadlines by method.
+        '''
+        with self._lock:
+            methods = copy.deepcopy(self.methods)
+        s = ['%-32s %6s %6s %6s %6s %9s %9s' % ('method', 'calls', 'hedged', 'rate',
+             'wins', 'deadline', 'delay')]
+        for name, m in sorted(methods.items()):
+            delay = self.delay(name)
+            s.append('%-32s %6d %6d %5.1f%% %6d %9d %9s' % (name, m['calls'], m['hedged'],
+                100.0 * m['hedged'] / m['calls'], m['hedge_wins'], m['deadlines'],
+                delay is not None and '%.3f' % (delay,) or '-'))
+        return '\n'.join(s) + '\n'
+
+hedging = HedgedCalls()
+
+class _MessageSizes(MessagePlugin):
+    '''
+    Counts the bytes of the SOAP messages for the call in progress on
+    each thread.
+    '''
+    def sending(self, context):
+        try:
+            _local.message_bytes[0] += len(context.envelope)
+        except AttributeError:
+            pass
+
+    def received(self, context):
+        try:
+            _local.message_bytes[1] += len(context.reply)
+        except (AttributeError, TypeError):
+            pass
+
 # -----------------------------------------------------------------------------
 # Base class for all the web service clients
 class CoverityWebServiceClient(object):
@@ -85,15 +644,18 @@ class CoverityWebServiceClient(object):
             + 'service?wsdl'
             )
 
+        self.security = self.Security()
+        self.token = self.UsernameToken(user, password)
+        self.security.tokens.append(self.token)
+        self._options = options
         try:
-            self.client = self.Client(self.wsdlFile)
+            self.client = self._new_client()
         except:
             print self.wsdlFile
             raise
-        self.security = self.Security()
-        self.token = self.UsernameToken(user, password)
-        self.security.tokens.append(self.token)
-        self.client.set_options(wsse=self.security)
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._idle = [self.client]
 
         if webservice_type != 'configuration':
            self.pageSpecDO = self.getDO(
@@ -103,6 +665,35 @@ class CoverityWebServiceClient(object):
                startIndex = 0,
                )
 
+    def _new_client(self):
+        client = self.Client(self.wsdlFile, **cassette.client_options(self._options))
+        client.set_options(wsse=self.security, plugins=[_MessageSizes()])
+        return client
+
+    @contextmanager
+    def _checkout(self):
+        '''
+        Lend a suds client for the duration of a "with" block.  A suds
+        client can only make one call at a time: the replies to calls made
+        at once through the same client get mixed up.  So each call in
+        flight has a client of its own, taken from those which are idle or
+        created when they're all busy.
+        '''
+        if os.getpid() != self._pid:
+            # A forked worker process doesn't have the other threads which
+            # held the lock
+            self._pid = os.getpid()
+            self._lock = threading.Lock()
+        with self._lock:
+            client = self._idle and self._idle.pop() or None
+        if client is None:
+            client = self._new_client()
+        try:
+            yield client
+        finally:
+            with self._lock:
+                self._idle.append(client)
+
     def getwsdl(self):
         print(self.client)
 
@@ -140,11 +731,23 @@ class CoverityWebServiceClient(object):
 
     def __getattr__(self, name):
         '''
-        Simplify access to the WS methods
+        Simplify access to the WS methods.  Calls are made through
+        ws.scheduler, hedged according to ws.hedging, and recorded in
+        ws.stats.  Each call uses a suds client of its own (see _checkout()).
         '''
+        if name.startswith('_'):
+            raise AttributeError(name)
         if name == 'factory':
             return self.client.factory
-        return getattr(self.client.service, name)
+        # Fail now if the service has no such method
+        getattr(self.client.service, name)
+        def invoke(*args, **kw):
+            with self._checkout() as client:
+                return getattr(client.service, name)(*args, **kw)
+        method = hedging.method(name, invoke)
+        def call(*args, **kw):
+            return scheduler.call(self, name, method, *args, **kw)
+        return call
 
     def getDO(self, DO_type, **kw):
         '''
@@ -192,8 +795,109 @@ class CoverityServiceClient(object):
             self.admin = CoverityAdminServiceClient(*args, **kw)
         self.defect = CoverityDefectServiceClient(*args, **kw)
         self.config = CoverityConfigServiceClient(*args, **kw)
-    
-client = CoverityServiceClient()
+        self.url = self.config.url
+        self.name = self.url.split('://', 1)[1]
+
+class MultiServiceClient(object):
+    '''
+    Connects to several CIM/Connect instances at once.  Each instance is
+    given as "host[:port]", and otherwise uses the same connection options.
+    The clients are in self.clients, in the order given.
+    '''
+    def connect(self, instances, api_version=2, options=None):
+        def connect_one(instance):
+            o = copy.copy(options)
+            if ':' in instance:
+                o.host, o.port = instance.rsplit(':', 1)
+            else:
+                o.host = instance
+            c = CoverityServiceClient()
+            c.connect(api_version=api_version, options=o)
+            return c
+        self.clients = _concurrently(connect_one, instances)
+
+def _concurrently(func, items, workers=None):
+    '''
+    Call func on each of items in its own thread, and return the results
+    in order.  If workers is given, at most that many threads are used.
+    The threads use the same client as the caller, and make their calls
+    for the same report.  That's safe since each call in flight has a suds
+    client of its own (see CoverityWebServiceClient._checkout()).  If any
+    call fails, the first exception is raised once they have all finished.
+    '''
+    items = list(items)
+    results = [None] * len(items)
+    errors = []
+    pending = list(enumerate(items))
+    lock = threading.Lock()
+    c = getattr(_local, 'client', None)
+    report = getattr(_local, 'report', None)
+    def run():
+        with using(c), scheduler.report(report):
+            while True:
+                with lock:
+                    if not pending or errors:
+                        return
+                    i, item = pending.pop()
+                try:
+                    results[i] = func(item)
+                except Exception:
+                    with lock:
+                        errors.append(sys.exc_info())
+    threads = [threading.Thread(target=run)
+               for i in range(min(workers or len(items), len(items)))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return results
+
+_local = threading.local()
+
+@contextmanager
+def using(c):
+    '''
+    Make ws.client refer to the CoverityServiceClient c in this thread for
+    the duration of a "with" block.  Does nothing if c is None.
+    '''
+    prev = getattr(_local, 'client', None)
+    if c is not None:
+        _local.client = c
+    try:
+        yield
+    finally:
+        _local.client = prev
+
+def current_client():
+    '''
+    Returns the CoverityServiceClient in use by this thread.
+    '''
+    return getattr(_local, 'client', None) or client._default
+
+class CoverityClientProxy(object):
+    '''
+    The type of ws.client.  It refers to the client selected for the current
+    thread with using(), or to the one opened with connect() otherwise, so
+    the helper classes below work with whichever server is being reported.
+    '''
+    def __init__(self):
+        self._default = CoverityServiceClient()
+
+    def connect(self, *args, **kw):
+        self._default.connect(*args, **kw)
+
+    def set_default(self, c):
+        '''
+        Use c when the current thread hasn't selected a client.
+        '''
+        self._default = c
+
+    def __getattr__(self, name):
+        return getattr(current_client(), name)
+
+client = CoverityClientProxy()
 
 # common options to all the scripts
 class WSOpts:
@@ -217,7 +921,8 @@ class WSOpts:
        '''
        _required_opts = ('user', 'password', 'host', 'port')
        _unassigned_choices = ('none', 'include', 'only')
-       _snapshot_op_choices = ('new', 'fixed')
+       _snapshot_op_choices = ('new', 'fixed', 'persisting')
+       _owner_filter_choices = ('auto', 'server', 'local')
 
        def __init__(self, *a, **kw):
            OptionParser.__init__(self, *a, **kw)
@@ -269,6 +974,33 @@ class WSOpts:
           if options.snapshot_op not in self.parser._snapshot_op_choices:
             return ['Unknown "--snapshot-op" value ' + options.snapshot_op]
     self.parser.add_validator(validate_snapshot_op)
+    def validate_local_diff(options, args):
+          if options.snapshot_op == 'persisting' and not options.local_diff:
+            return ['"--snapshot-op persisting" requires "--local-diff"']
+          if options.base_snapshot and not options.local_diff:
+            return ['"--base-snapshot" requires "--local-diff"']
+    self.parser.add_validator(validate_local_diff)
+    def validate_owner_filter(options, args):
+          if options.owner_filter not in self.parser._owner_filter_choices:
+            return ['Unknown "--owner-filter" value ' + options.owner_filter]
+    self.parser.add_validator(validate_owner_filter)
+    def validate_cassette(options, args):
+          if options.record_ws and options.replay_ws:
+            return ['"--record-ws" and "--replay-ws" can\'t be used together']
+          if options.replay_ws and not os.path.isfile(options.replay_ws):
+            return ['"--replay-ws" file %s not found' % (options.replay_ws,)]
+    self.parser.add_validator(validate_cassette)
+    def validate_scheduler(options, args):
+          if options.ws_max_in_flight < 0:
+            return ['"--ws-max-in-flight" can\'t be negative']
+          for spec in [x for x in options.ws_priority.split(',') if x]:
+            if not re.match(r'^\w+=-?\d+$', spec):
+              return ['Invalid "--ws-priority" value ' + spec]
+          if not 0 <= options.ws_hedge_percentile < 100:
+            return ['"--ws-hedge-percentile" must be from 0 to 100']
+          if options.ws_deadline < 0:
+            return ['"--ws-deadline" can\'t be negative']
+    self.parser.add_validator(validate_scheduler)
  
    def response_file(self, option, opt_str, value, parser):
     rfile = file(value,'r').read().split()
@@ -298,6 +1030,8 @@ class WSOpts:
     self.parser.set_defaults(excludeComponents=False)
 
     self.parser.add_option("--host", dest="host", help="host of CIM")
+    self.parser.add_option("--instances", dest="instances", default='',
+        help="Report on all these CIM instances (comma-separated host[:port])")
     self.parser.add_option("--port",  dest="port", help="port of CIM")
     self.parser.add_option("--secure",  dest="secure",  action="store_true",
         help="specify for https/SSL server")
@@ -311,7 +1045,16 @@ class WSOpts:
     self.parser.add_option("--snapshot-op",  dest="snapshot_op",
         default='new', help='What to look for in snapshot ("%s")'%
                             '","'.join(self.parser._snapshot_op_choices))
-
+    self.parser.add_option("--local-diff", action='store_true', dest="local_diff",
+        default=False, help="Compare snapshots locally, using their cached CIDs")
+    self.parser.add_option("--base-snapshot", type=int, dest="base_snapshot",
+        help="With --local-diff, compare with this snapshot instead of the previous one")
+    self.parser.add_option("--cid-cache", dest="cid_cache", default=None,
+        help="With --local-diff, keep the CIDs of each snapshot in this directory")
+
+    self.parser.add_option("--owner-filter", dest="owner_filter", default='auto',
+        help='Filter owners on the server, or locally after fetching ("%s")'%
+                            '","'.join(self.parser._owner_filter_choices))
     self.parser.add_option("--unassigned", dest="unassigned",
         help='Include unassigned defects ("%s")'%
                             '","'.join(self.parser._unassigned_choices))
@@ -327,6 +1070,26 @@ class WSOpts:
         help='Components to include (comma-separated, or "all")')
     self.parser.add_option("--excludeComponents", action='store_true', dest="componentExclude",
         default=False, help='Exclude components listed in --component')
+    self.parser.add_option("--metadata-cache", dest="metadata_cache", default=None,
+        help="Keep users, projects, streams and snapshots in this file between runs")
+    self.parser.add_option("--metadata-ttl", dest="metadata_ttl", default='',
+        help="Seconds to keep cached metadata, as kind=seconds (comma-separated, e.g. users=3600)")
+    self.parser.add_option("--refresh-metadata", action='store_true', dest="refresh_metadata",
+        default=False, help="Fetch all metadata again instead of using the cache")
+    self.parser.add_option("--record-ws", dest="record_ws", default=None,
+        help="Record the web service traffic in this file (without credentials)")
+    self.parser.add_option("--replay-ws", dest="replay_ws", default=None,
+        help="Answer web service requests from a file made with --record-ws instead of the server")
+    self.parser.add_option("--replay-timing", dest="replay_timing", type=float, default=1.0,
+        help="With --replay-ws, scale the recorded response times by this (default 1, 0 for no delay)")
+    self.parser.add_option("--ws-max-in-flight", dest="ws_max_in_flight", type=int, default=8,
+        help="Most web service requests to have in flight at once (default 8, 0 for no limit)")
+    self.parser.add_option("--ws-priority", dest="ws_priority", default='',
+        help="Priorities of web service methods when requests wait, as method=n (comma-separated, lower goes first)")
+    self.parser.add_option("--ws-hedge-percentile", dest="ws_hedge_percentile", type=float, default=0,
+        help="Send a read request again if it's slower than this percentile of its method's latency, e.g. 95 (default 0==never)")
+    self.parser.add_option("--ws-deadline", dest="ws_deadline", type=float, default=0,
+        help="Fail read requests which take longer than this many seconds (default 0==no deadline)")
 
     return self.parser
 
@@ -341,6 +1104,12 @@ class DefectReporter(object):
     '''
     intro = 'The following defects were found'
 
+    # Number of CIDs to request at once when the scope has a CID list
+    cid_chunk = 1000
+
+    # Number of defects to request per page
+    page_size = 2500
+
     def __init__(self, client):
         self._client = client
 
@@ -348,37 +1117,56 @@ class DefectReporter(object):
         '''
         Get list of defects matching established filters from scope.  If
         there are lots of defects, make sure we properly handle
-        multiple pages of results from the server.
+        multiple pages of results from the server.  The result is saved in
+        scope.defectsPage, so several reporters sharing a scope only fetch
+        the defects once.
         '''
+        if scope.defectsPage is not None:
+            return scope.defectsPage
+
         streamIdDOs = scope.streamIdDOs
         kw = scope.filters
 
-        # Set up our filters
-        mergedDefectFilterDO = self._client.defect.getDO(
-            'mergedDefectFilterSpecDataObj',
-            **kw)
-        # Set up a page specifier
-        ps = self._client.defect.getDO('pageSpecDataObj',
-            pageSize = 2500,
-            sortAscending = False,
-            startIndex = 0)
+        # Set up our filters.  If the scope has already determined the CIDs
+        # (with "--local-diff"), only those are fetched, a chunk at a time.
+        if scope.cidList is None:
+            filterDOs = [self._client.defect.getDO(
+                'mergedDefectFilterSpecDataObj',
+                **kw)]
+        else:
+            filterDOs = [self._client.defect.getDO(
+                'mergedDefectFilterSpecDataObj',
+                cidList = list(scope.cidList[i:i+self.cid_chunk]),
+                **kw) for i in range(0, len(scope.cidList), self.cid_chunk)]
 
         # Walk over the results pages to collect a single list
         mergedDefectsPageDO = self._client.defect.getDO('mergedDefectsPageDataObj',
             totalNumberOfRecords = 0,
             mergedDefects = [])
-        while True:
-            # Get next page
-            ddo = self._client.defect.getMergedDefectsForStreams(
-                streamIdDOs,
-                mergedDefectFilterDO,
-                ps)
-            try:
-                mergedDefectsPageDO.totalNumberOfRecords += len(ddo.mergedDefects)
-                mergedDefectsPageDO.mergedDefects.extend(ddo.mergedDefects)
-                ps.startIndex += len(ddo.mergedDefects)
-            except AttributeError:
-                break
+        for mergedDefectFilterDO in filterDOs:
+            # Set up a page specifier
+            ps = self._client.defect.getDO('pageSpecDataObj',
+                pageSize = self.page_size,
+                sortAscending = False,
+                startIndex = 0)
+            while True:
+                # Get next page
+                ddo = self._client.defect.getMergedDefectsForStreams(
+                    streamIdDOs,
+                    mergedDefectFilterDO,
+                    ps)
+                try:
+                    mergedDefectsPageDO.totalNumberOfRecords += len(ddo.mergedDefects)
+                    mergedDefectsPageDO.mergedDefects.extend(ddo.mergedDefects)
+                    ps.startIndex += len(ddo.mergedDefects)
+                except AttributeError:
+                    break
+
+        # Apply the owner filter if the server didn't
+        if scope.ownerFilter is not None:
+            mergedDefectsPageDO.mergedDefects = [md for md in mergedDefectsPageDO.mergedDefects
+                                                 if md.owner in scope.ownerFilter]
+            mergedDefectsPageDO.totalNumberOfRecords = len(mergedDefectsPageDO.mergedDefects)
         
         # TODO: Consider calling self._client.defect.getStreamDefects()
         # for the defects, in batches of 100, so we don't need to pull 
@@ -386,6 +1174,7 @@ class DefectReporter(object):
         # fill in those fields on demand, but it would be faster if we
         # grabbed them in batches.
         
+        scope.defectsPage = mergedDefectsPageDO
         return mergedDefectsPageDO
             
     def recipients(self, md):
@@ -473,8 +1262,15 @@ class OptionsProcessor(object):
             return '%s: %s %s' % (
                 self.__class__.__name__, self._type, self._values)
 
+    # With "--owner-filter auto", owner lists longer than this are
+    # filtered locally
+    local_owner_threshold = 100
+
     def __init__(self, options, client):
         self._triage_scope = None
+        self.defectsPage = None
+        self.ownerFilter = None
+        self.cidList = None
         self.projectId = None
         self.projectDOs = None
         self.filters = {}
@@ -506,10 +1302,11 @@ class OptionsProcessor(object):
         # get the streams for relevant project or all streams if no project
         # given
         if self.options.stream:
-            sid = client.config.getStreams(
-                client.config.getDO('streamFilterSpecDataObj',
-                    namePattern=self.options.stream)
-                )
+            sid = metadata.get(client, 'streams', self.options.stream,
+                lambda: client.config.getStreams(
+                    client.config.getDO('streamFilterSpecDataObj',
+                        namePattern=self.options.stream)
+                    ))
             if not sid:
                 raise self.StreamNotFound(self.options.stream)
             else:
@@ -520,10 +1317,11 @@ class OptionsProcessor(object):
                 if len(p) != 1:
                     raise self.TooManyObjects('Projects', p)
                 projectName = [x.name for x in p][0]
-                self.projectDOs = client.config.getProjects(
-                    client.config.getDO('projectFilterSpecDataObj',
-                        namePattern=projectName)
-                    )
+                self.projectDOs = metadata.get(client, 'projects', projectName,
+                    lambda: client.config.getProjects(
+                        client.config.getDO('projectFilterSpecDataObj',
+                            namePattern=projectName)
+                        ))
                 if len(self.projectDOs) != 1:
                     raise TooManyObjects('Projects', self.projectDOs)
                 self.projectId = self.projectDOs[0].projectKey
@@ -531,7 +1329,8 @@ class OptionsProcessor(object):
             projectFilterSpecDO = client.config.getDO(
                 'projectFilterSpecDataObj',
                 namePattern = self.options.project)
-            self.projectDOs = client.config.getProjects(projectFilterSpecDO)
+            self.projectDOs = metadata.get(client, 'projects', self.options.project,
+                lambda: client.config.getProjects(projectFilterSpecDO))
             if len(self.projectDOs) == 1:
                 self.projectId = self.projectDOs[0].projectKey
             else:
@@ -556,49 +1355,64 @@ class OptionsProcessor(object):
             # Look for a specific snapshot
             ssid = client.config.getDO('snapshotIdDataObj',
                 id=long(self.options.snapshot))
-            ss = client.config.getSnapshotInformation([ssid])
+            ss = metadata.get(client, 'snapshots', ssid.id,
+                lambda: client.config.getSnapshotInformation([ssid]))
             if ss:
                 f = client.defect.getDO('streamSnapshotFilterSpecDataObj',
                     snapshotIdIncludeList=[ssid])
                 mf = client.defect.getDO('mergedDefectFilterSpecDataObj',
                     streamSnapshotFilterSpecIncludeList=f)
-                streams = []
-                p = client.defect.getDO('pageSpecDataObj',
-                    pageSize = 1, sortAscending = False, startIndex = 0)
-                # Walk through the streams to see which include this snapshot
+                # Find the stream which includes this snapshot
                 if self.streamIdDOs: lstr = self.streamIdDOs
-                else: lstr = [x.id for x in client.config.getStreams()]
-                for s in lstr:
-                    # Look for merged defects in this stream that come
-                    # from the desired snapshot
-                    f.streamId = s
-                    d = client.defect.getMergedDefectsForStreams([s], mf, p)
-                    if d.totalNumberOfRecords or len(lstr) == 1:
-                        streams.append(s)
+                else: lstr = [x.id for x in metadata.get(client, 'streams', None,
+                                                client.config.getStreams)]
+                streams = self.snapshot_streams(client, ssid, lstr)
                 if len(streams) != 1:
                     raise self.TooManyObjects('Streams', streams)
                 # Find the previous snapshot so we can determine what is new
-                prev_ss = client.config.getSnapshotsForStream(streams[0],
-                    client.config.getDO('snapshotFilterSpecDataObj',
-                        endDate=ss[0].dateCreated
-                            + datetime.timedelta(seconds=1))
-                    )
-                # If we're looking for new defects (snapshot_op=='new'),
-                # then include ssid and exclude the previous.
-                # If we're looking for fixed defects (=='fixed')
-                # then include the previous and exclude ssid
-                # If there is no previous, the just include ssid
-                if len(prev_ss) > 1:
-                  if self.options.snapshot_op == 'new':
-                    f.snapshotIdExcludeList = [prev_ss[-2]]
+                # The snapshots up to this one don't change, so they can be
+                # cached
+                prev_ss = metadata.get(client, 'snapshots', (streams[0].name, ssid.id),
+                    lambda: client.config.getSnapshotsForStream(streams[0],
+                        client.config.getDO('snapshotFilterSpecDataObj',
+                            endDate=ss[0].dateCreated
+                                + datetime.timedelta(seconds=1))
+                        ))
+                if self.options.local_diff:
+                  # Compare the CIDs of the snapshots here, and only fetch
+                  # the defects in the result
+                  if self.options.base_snapshot:
+                    base = client.config.getDO('snapshotIdDataObj',
+                        id=long(self.options.base_snapshot))
+                    base_streams = self.snapshot_streams(client, base, lstr)
+                    if len(base_streams) != 1:
+                        raise self.TooManyObjects('Streams', base_streams)
+                    base_stream = base_streams[0]
+                  elif len(prev_ss) > 1:
+                    base = prev_ss[-2]
+                    base_stream = streams[0]
                   else:
-                    f.snapshotIdIncludeList = [prev_ss[-2]]
-                    f.snapshotIdExcludeList = [ssid]
+                    base = base_stream = None
+                  self.cidList = self.snapshot_diff(client, streams[0], ssid,
+                                                    base_stream, base)
+                  self.streamIdDOs = streams
+                else:
+                  # If we're looking for new defects (snapshot_op=='new'),
+                  # then include ssid and exclude the previous.
+                  # If we're looking for fixed defects (=='fixed')
+                  # then include the previous and exclude ssid
+                  # If there is no previous, the just include ssid
+                  if len(prev_ss) > 1:
+                    if self.options.snapshot_op == 'new':
+                      f.snapshotIdExcludeList = [prev_ss[-2]]
+                    else:
+                      f.snapshotIdIncludeList = [prev_ss[-2]]
+                      f.snapshotIdExcludeList = [ssid]
                     
-                # Finally, set our global filter to use the right stream
-                f.streamId = streams
+                  # Finally, set our global filter to use the right stream
+                  f.streamId = streams
                 
-                self.filters['streamSnapshotFilterSpecIncludeList'] = f
+                  self.filters['streamSnapshotFilterSpecIncludeList'] = f
         elif self.options.days:
             # Look for defects detected in the past <x> days
             self.filters['firstDetectedStartDate'] = (
@@ -609,28 +1423,120 @@ class OptionsProcessor(object):
         # Set up the owner/user filters
         users = []
         if not self.options.unassigned == 'only':
-            ps = client.config.getDO('pageSpecDataObj',
-                pageSize=500,sortAscending=False,startIndex=0)
-            while True:
-              try:
-                userPageDO = client.admin.getAssignableUsers(ps)
-              except AttributeError:
-                # v4 WS API doesn't have an admin service
-                userPageDO = client.config.getUsers(
-                    client.config.getDO('userFilterSpecDataObj',
-                        assignable=True), ps)
-
-              try:
-                users.extend([u.username for u in userPageDO.users])
-              except AttributeError:
-                break
-              ps.startIndex += len(userPageDO.users)
+            users = self.assignable_users(client)
 
         if self.options.unassigned in ('include', 'only'):
             users = list(set(users + ['Unassigned']))
             
+        # Every page request carries the owner filter, so a long list of
+        # owners makes each request large and slow to process.  In that
+        # case, fetch the defects for any owner and filter them in
+        # DefectReporter.defects() instead.
         if users:
-            self.filters['ownerNameList'] = users
+            if (self.options.owner_filter == 'local' or
+                (self.options.owner_filter == 'auto'
+                 and len(users) > self.local_owner_threshold)):
+                self.ownerFilter = frozenset(users)
+            else:
+                self.filters['ownerNameList'] = users
+
+    # Number of streams to query at once when looking for a snapshot
+    snapshot_workers = 8
+
+    def snapshot_streams(self, client, ssid, streams):
+        '''
+        Returns the streams in "streams" which include the snapshot ssid.
+        The snapshot ids of each stream are kept in the metadata cache, so
+        usually this doesn't need to ask the server at all.  If the snapshot
+        isn't in any of the cached lists, they're fetched again.  As a last
+        resort, each stream is probed for defects from the snapshot.
+        '''
+        if len(streams) == 1:
+            return list(streams)
+
+        for refresh in (False, True):
+            def has_snapshot(s):
+                ids = metadata.get(client, 'snapshots', ('stream', s.name),
+                    lambda: [x.id for x in client.config.getSnapshotsForStream(s,
+                        client.config.getDO('snapshotFilterSpecDataObj')) or []],
+                    refresh=refresh)
+                return ssid.id in ids
+            found = _concurrently(has_snapshot, streams, self.snapshot_workers)
+            if True in found:
+                return [s for s, hit in zip(streams, found) if hit]
+
+        def probe(s):
+            # Look for merged defects in this stream that come from the
+            # desired snapshot
+            f = client.defect.getDO('streamSnapshotFilterSpecDataObj',
+                snapshotIdIncludeList=[ssid], streamId=s)
+            mf = client.defect.getDO('mergedDefectFilterSpecDataObj',
+                streamSnapshotFilterSpecIncludeList=f)
+            p = client.defect.getDO('pageSpecDataObj',
+                pageSize = 1, sortAscending = False, startIndex = 0)
+            return client.defect.getMergedDefectsForStreams([s], mf, p).totalNumberOfRecords
+        found = _concurrently(probe, streams, self.snapshot_workers)
+        return [s for s, n in zip(streams, found) if n]
+
+    def snapshot_diff(self, client, stream, ssid, base_stream, base):
+        '''
+        Returns a sorted array of the CIDs which are new in snapshot ssid
+        compared with snapshot base, fixed since base, or in both (persisting),
+        according to "--snapshot-op".  Without a base, every CID in ssid is
+        new, and none are fixed or persisting.
+        '''
+        cids = snapshot_cids.get(client, stream, ssid)
+        if base is None:
+            base_cids = array('l')
+        else:
+            base_cids = snapshot_cids.get(client, base_stream, base)
+        if self.options.snapshot_op == 'new':
+            result = set(cids).difference(base_cids)
+        elif self.options.snapshot_op == 'fixed':
+            result = set(base_cids).difference(cids)
+        else:
+            result = set(cids).intersection(base_cids)
+        return array('l', sorted(result))
+
+    _users_lock = threading.Lock()
+
+    def assignable_users(self, client):
+        '''
+        Returns a list of the assignable usernames.  The list is kept in the
+        metadata cache, so OptionsProcessors for several projects or streams
+        share a single enumeration.
+        '''
+        with self._users_lock:
+            return list(metadata.get(client, 'users', 'assignable',
+                lambda: self._fetch_assignable_users(client)))
+
+    def _fetch_assignable_users(self, client):
+        users = []
+        ps = client.config.getDO('pageSpecDataObj',
+            pageSize=500,sortAscending=False,startIndex=0)
+        while True:
+          try:
+            userPageDO = client.admin.getAssignableUsers(ps)
+          except AttributeError:
+            # v4 WS API doesn't have an admin service
+            userPageDO = client.config.getUsers(
+                client.config.getDO('userFilterSpecDataObj',
+                    assignable=True), ps)
+
+          try:
+            users.extend([u.username for u in userPageDO.users])
+          except AttributeError:
+            break
+          ps.startIndex += len(userPageDO.users)
+        return users
+
+    def defect_handler(self, mergedDefectDO):
+        '''
+        Returns a DefectHandler for mergedDefectDO, which was found with
+        this scope's filters.
+        '''
+        return DefectHandler(mergedDefectDO, projectId=self.projectId,
+            projectDOs=self.projectDOs, scope=self.triage_scope())
 
     def triage_scope(self):
         if not self._triage_scope:
@@ -644,8 +1550,384 @@ class OptionsProcessor(object):
             self._triage_scope = '/'.join([project, stream])
         return self._triage_scope
 
+class MultiScope(object):
+    '''
+    The same filters applied on several CIM instances.  Instances on which
+    the project or stream doesn't exist are skipped.  self.scopes holds a
+    (client, OptionsProcessor) tuple for each of the others.
+    '''
+    def __init__(self, options, clients):
+        self.options = options
+        self.defectsPage = None
+        self._merged = {}
+        def process(c):
+            with using(c):
+                try:
+                    scope = OptionsProcessor(options, client)
+                except OptionsProcessor.StreamNotFound:
+                    return None
+            if not scope.streamIdDOs:
+                return None
+            return (c, scope)
+        self.scopes = [x for x in _concurrently(process, clients) if x]
+        if not self.scopes:
+            raise OptionsProcessor.StreamNotFound(options.project or options.stream)
+        self._by_name = dict([(c.name, (c, s)) for c, s in self.scopes])
+
+    def instance_scope(self, record):
+        '''
+        Returns the (client, OptionsProcessor) for the instance a record
+        returned by MultiReporter.defects() came from.
+        '''
+        return self._by_name[record.instance]
+
+    def defect_handler(self, mergedDefectDO):
+        c, scope = self.instance_scope(mergedDefectDO)
+        with using(c):
+            return scope.defect_handler(mergedDefectDO)
+
+    def triage_scope(self):
+        return '*/*'
+
+class MultiReporter(object):
+    '''
+    Runs a reporter on each instance of a MultiScope, and merges the
+    results.  "reporters" maps instance names to their reporters.  Each
+    merged record gets an "instance" attribute with its instance's name,
+    since CIDs are only unique within an instance.
+    '''
+    def __init__(self, reporters):
+        self._reporters = reporters
+        self.intro = reporters.values()[0].intro
+
+    def defects(self, scope):
+        def fetch((c, s)):
+            with using(c):
+                return self._reporters[c.name].defects(s)
+        results = _concurrently(fetch, scope.scopes)
+        self._scope = scope
+
+        # Several jobs can share the scope, so return the same merged
+        # results for the same instance results.
+        key = tuple([id(r) for r in results])
+        try:
+            return scope._merged[key]
+        except KeyError:
+            pass
+
+        for (c, s), r in zip(scope.scopes, results):
+            for record in getattr(r, 'mergedDefects', r) or []:
+                record.instance = c.name
+        if hasattr(results[0], 'totalNumberOfRecords'):
+            with using(scope.scopes[0][0]):
+                merged = client.defect.getDO('mergedDefectsPageDataObj',
+                    totalNumberOfRecords = 0,
+                    mergedDefects = [])
+            for r in results:
+                merged.mergedDefects.extend(getattr(r, 'mergedDefects', []))
+            merged.totalNumberOfRecords = len(merged.mergedDefects)
+        else:
+            merged = []
+            for r in results:
+                merged.extend(r or [])
+        scope._merged[key] = merged
+        return merged
+
+    def recipients(self, md):
+        try:
+            instance = md.instance
+        except AttributeError:
+            return self._reporters.values()[0].recipients(md)
+        with using(self._scope.instance_scope(md)[0]):
+            return self._reporters[instance].recipients(md)
+
 _cache ={}
 
+def _cache_event(bucket, hit):
+    '''
+    Note a cache hit or miss in the trace.
+    '''
+    if hit:
+        tracing.instant('cache hit', 'cache', cache=bucket)
+    else:
+        tracing.instant('cache miss', 'cache', cache=bucket)
+
+class _FrozenObject(object):
+    '''
+    The picklable form of a suds object in the metadata cache file.
+    '''
+    def __init__(self, typename, items):
+        self.typename = typename
+        self.items = items
+
+def _freeze(v):
+    if isinstance(v, suds.sudsobject.Object):
+        return _FrozenObject(v.__class__.__name__,
+            [(k, _freeze(x)) for k, x in suds.sudsobject.items(v)])
+    elif isinstance(v, list):
+        return [_freeze(x) for x in v]
+    elif isinstance(v, unicode):
+        # Drop suds' unicode subclass
+        return unicode(v)
+    return v
+
+def _thaw(v, factory):
+    if isinstance(v, _FrozenObject):
+        try:
+            obj = factory.create(v.typename)
+        except suds.TypeNotFound:
+            obj = suds.sudsobject.Factory.object(v.typename)
+        for k, x in v.items:
+            setattr(obj, k, _thaw(x, factory))
+        return obj
+    elif isinstance(v, list):
+        return [_thaw(x, factory) for x in v]
+    return v
+
+class MetadataCache(object):
+    '''
+    A cache of server metadata which is expensive to enumerate but rarely
+    changes: users, projects, streams and snapshots.  Each kind of entry is
+    kept for the number of seconds in self.ttls, and entries are kept
+    separately for each server.  If a file is given with load(), the cache
+    is read from it, and save() writes it back.  Entries which have expired
+    are dropped when it's saved (see prune()).
+    '''
+    ttls = {
+        'users': 24*3600,
+        'projects': 3600,
+        'streams': 3600,
+        'snapshots': 24*3600,
+        }
+
+    # Most entries kept of each kind for one server.  Some kinds have an
+    # entry per defect or per snapshot seen (the project of each CID, say),
+    # so a long-running or frequently run report would otherwise keep
+    # adding to them.
+    max_entries = 20000
+
+    def __init__(self):
+        self.ttls = dict(self.ttls)
+        self._entries = {}
+        self._filename = None
+        self._lock = threading.Lock()
+
+    def configure(self, options):
+        '''
+        Apply the "--metadata-*" options.
+        '''
+        for spec in [x for x in options.metadata_ttl.split(',') if x]:
+            kind, seconds = spec.split('=', 1)
+            self.ttls[kind] = int(seconds)
+        if options.metadata_cache:
+            self.load(options.metadata_cache)
+        if options.refresh_metadata:
+            self.refresh()
+
+    def load(self, filename):
+        self._filename = filename
+        try:
+            f = open(filename, 'rb')
+            try:
+                entries = pickle.load(f)
+            finally:
+                f.close()
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return
+        with self._lock:
+            # Entries from the file are thawed when they're first used,
+            # since that needs the server's client
+            for key, (stamp, value) in entries.items():
+                self._entries.setdefault(key, [stamp, value, True])
+
+    def save(self):
+        '''
+        Write the cache to the file given to load(), if any.
+        '''
+        if not self._filename:
+            return
+        self.prune()
+        with self._lock:
+            entries = dict([(key, (stamp, frozen and value or _freeze(value)))
+                            for key, (stamp, value, frozen) in self._entries.items()])
+        tmp = self._filename + '.tmp'
+        f = open(tmp, 'wb')
+        try:
+            pickle.dump(entries, f, pickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        try:
+            os.rename(tmp, self._filename)
+        except OSError:
+            # Windows won't rename over an existing file
+            os.remove(self._filename)
+            os.rename(tmp, self._filename)
+
+    def prune(self):
+        '''
+        Forget the entries which have expired, and the oldest entries of
+        any kind which has more than max_entries for a server.
+        '''
+        now = time.time()
+        with self._lock:
+            kinds = {}
+            for key, entry in self._entries.items():
+                if now - entry[0] >= self.ttls.get(key[1], 0):
+                    del self._entries[key]
+                else:
+                    kinds.setdefault(key[:2], []).append((entry[0], key))
+            for entries in kinds.values():
+                if len(entries) > self.max_entries:
+                    entries.sort()
+                    for stamp, key in entries[:-self.max_entries]:
+                        del self._entries[key]
+
+    def refresh(self, kinds=None):
+        '''
+        Forget the entries of the given kinds, or all entries.
+        '''
+        with self._lock:
+            for key in self._entries.keys():
+                if kinds is None or key[1] in kinds:
+                    del self._entries[key]
+
+    def get(self, client, kind, key, fetch, refresh=False):
+        '''
+        Returns the cached value for kind and key on client's server.  If
+        there isn't one, it has expired, or refresh is set, calls fetch() to
+        get the value.
+        '''
+        k = (client.config.url, kind, key)
+        with self._lock:
+            entry = self._entries.get(k)
+            if entry and not refresh and time.time() - entry[0] < self.ttls.get(kind, 0):
+                _cache_event(kind, True)
+                if entry[2]:
+                    entry[1] = _thaw(entry[1], client.config.factory)
+                    entry[2] = False
+                return entry[1]
+        _cache_event(kind, False)
+        value = fetch()
+        with self._lock:
+            self._entries[k] = [time.time(), value, False]
+        return value
+
+    def keys(self, client, kind):
+        '''
+        Returns the keys of the unexpired entries of the given kind on
+        client's server.
+        '''
+        url = client.config.url
+        now = time.time()
+        with self._lock:
+            return [key for (u, k, key), entry in self._entries.items()
+                    if u == url and k == kind and now - entry[0] < self.ttls.get(kind, 0)]
+
+metadata = MetadataCache()
+
+class SnapshotCIDCache(object):
+    '''
+    The CIDs of the defects in each snapshot, as sorted arrays of integers.
+    A snapshot's defects never change, so these don't expire, but only the
+    max_snapshots most recently used are kept in memory.  If a directory is
+    given with open(), each snapshot's CIDs are also kept in a file there,
+    to be reused by later runs.
+    '''
+    max_snapshots = 32
+
+    def __init__(self):
+        self._cids = collections.OrderedDict()
+        self._dir = None
+        self._lock = threading.Lock()
+
+    def configure(self, options):
+        '''
+        Apply the "--cid-cache" option.
+        '''
+        if options.cid_cache:
+            self.open(options.cid_cache)
+
+    def open(self, directory):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._dir = directory
+
+    def _filename(self, client, ssid):
+        return os.path.join(self._dir, '%s-%d.cids' % (
+            re.sub(r'[^\w.-]', '_', client.config.url.split('://', 1)[-1]), ssid.id))
+
+    def get(self, client, stream, ssid):
+        '''
+        Returns the sorted array of CIDs in snapshot ssid of stream.
+        '''
+        key = (client.config.url, ssid.id)
+        with self._lock:
+            try:
+                # Most recently used last
+                cids = self._cids[key] = self._cids.pop(key)
+                return cids
+            except KeyError:
+                pass
+
+        cids = None
+        if self._dir:
+            cids = self._load(self._filename(client, ssid))
+        if cids is None:
+            cids = self._fetch(client, stream, ssid)
+            if self._dir:
+                self._save(self._filename(client, ssid), cids)
+        with self._lock:
+            self._cids[key] = cids
+            while len(self._cids) > self.max_snapshots:
+                self._cids.popitem(last=False)
+        return cids
+
+    def _load(self, filename):
+        try:
+            f = open(filename, 'rb')
+        except IOError:
+            return None
+        try:
+            cids = array('l')
+            cids.fromstring(f.read())
+            return cids
+        finally:
+            f.close()
+
+    def _save(self, filename, cids):
+        tmp = filename + '.tmp'
+        f = open(tmp, 'wb')
+        try:
+            cids.tofile(f)
+        finally:
+            f.close()
+        try:
+            os.rename(tmp, filename)
+        except OSError:
+            # Windows won't rename over an existing file
+            os.remove(filename)
+            os.rename(tmp, filename)
+
+    def _fetch(self, client, stream, ssid):
+        f = client.defect.getDO('streamSnapshotFilterSpecDataObj',
+            snapshotIdIncludeList=[ssid], streamId=stream)
+        mf = client.defect.getDO('mergedDefectFilterSpecDataObj',
+            statusNameList = ['New','Triaged','Fixed','Dismissed'],
+            streamSnapshotFilterSpecIncludeList=f)
+        ps = client.defect.getDO('pageSpecDataObj',
+            pageSize = 2500, sortAscending = False, startIndex = 0)
+        cids = []
+        while True:
+            ddo = client.defect.getMergedDefectsForStreams([stream], mf, ps)
+            try:
+                cids.extend([md.cid for md in ddo.mergedDefects])
+                ps.startIndex += len(ddo.mergedDefects)
+            except AttributeError:
+                break
+        return array('l', sorted(set(cids)))
+
+snapshot_cids = SnapshotCIDCache()
+
 class CachedCoverityObject(object):
     def _cache_key(self, v):
         return v
@@ -653,7 +1935,9 @@ class CachedCoverityObject(object):
     def __init__(self, v):
         if self._cache_class not in _cache.keys():
             _cache[self._cache_class] = {}
-        key = self._cache_key(v)
+        # Each server has its own objects
+        key = (client.url, self._cache_key(v))
+        _cache_event(self._cache_class, key in _cache[self._cache_class])
         if key not in _cache[self._cache_class]:
             _cache[self._cache_class][key] = self._get_object(v)
         self._props = _cache[self._cache_class][key]
@@ -704,8 +1988,10 @@ class DefectHandler(object):
                  scope = None
         ):
         '''
-        We wrap around a mergedDefectDataObject
+        We wrap around a mergedDefectDataObject.  The defect is bound to
+        the client in use when it's created.
         '''
+        self._client = current_client()
         self.defectDO = mergedDefectDO
         if projectId:
             self._projId = str(projectId)
@@ -749,7 +2035,7 @@ class DefectHandler(object):
             # If that's not set, just use the global scope
             if scope is None:
                 scope = '*/*'
-            f = client.defect.getDO('streamDefectFilterSpecDataObj',
+            f = self._client.defect.getDO('streamDefectFilterSpecDataObj',
                 includeDefectInstances = True,
                 includeHistory = True,
                 scopePattern = scope)
@@ -758,16 +2044,22 @@ class DefectHandler(object):
                 # Fixed defects will normally have no defectInstances
                 # In that case, insert an empty list to avoid an AttributeException
                 # when defectInstances is enumerated.
-                streamDefectDO = client.defect.getStreamDefects([self.cid], f)[0]
+                streamDefectDO = self._client.defect.getStreamDefects([self.cid], f)[0]
                 try: streamDefectDO.defectInstances
                 except: streamDefectDO.defectInstances = []
             else:
-                streamDefectDO = client.defect.getStreamDefects([self.cid], f)[0]
+                streamDefectDO = self._client.defect.getStreamDefects([self.cid], f)[0]
 
         # Now merge the streamDefectFields onto self
         for f in self._streamDefectFields:
             setattr(self, f, getattr(streamDefectDO, f))
         
+    # Add a "client" attribute with the CoverityServiceClient for this
+    # defect's server
+    @property
+    def client(self):
+        return self._client
+
     # Add a "scope" attribute that identifies the function if available
     @property
     def scope(self):
@@ -783,7 +2075,7 @@ class DefectHandler(object):
     # Add a "url" attribute that will pull up the defect in CIM
     @property
     def url(self):
-        return client.defect.create_url(self.cid, self.projId)
+        return self._client.defect.create_url(self.cid, self.projId)
 
     # Add a "projId" attribute with the containing CIM project id
     @property
@@ -793,37 +2085,42 @@ class DefectHandler(object):
             # We do this to avoid querying the server when possible.
             return self._projId
         except AttributeError:
-            # Look through all projects for this CID
-            for proj in self._projectDOs:
-                # Skip any projects that have no streams
-                try:
-                    streams = proj.streams
-                except AttributeError:
-                    continue
+            pass
+        self._projId = metadata.get(self._client, 'projects', ('cid', self.defectDO.cid),
+            self._find_projId)
+        return self._projId
+
+    def _find_projId(self):
+        # Look through all projects for this CID
+        for proj in self._projectDOs:
+            # Skip any projects that have no streams
+            try:
+                streams = proj.streams
+            except AttributeError:
+                continue
 
-                try:
-                    # before v4, the stream id had a "type" attribute
-                    streamIdDOs = [s.id for s in streams
-                                    if s.id.type != 'SOURCE']
-                except AttributeError:
-                    # v4 and later don't have "type", but we also don't need
-                    # to filter on it.  Just grab all the stream ids.
-                    streamIdDOs = [s.id for s in streams]
-                except:
-                    # skip these streams if there are any other exceptions
-                    continue
-                mergedDefectFilterDO = client.defect.getDO(
-                    'mergedDefectFilterSpecDataObj',
-                    cidList = [self.defectDO.cid],
-                    statusNameList = ['New','Triaged','Fixed','Dismissed'])
-                client.defect.pageSpecDO.startIndex = 0
-                mDOs = client.defect.getMergedDefectsForStreams(
-                    streamIdDOs,
-                    mergedDefectFilterDO,
-                    client.defect.pageSpecDO)
-                if mDOs.totalNumberOfRecords > 0:
-                    self._projId = proj.projectKey
-                    return self._projId
+            try:
+                # before v4, the stream id had a "type" attribute
+                streamIdDOs = [s.id for s in streams
+                                if s.id.type != 'SOURCE']
+            except AttributeError:
+                # v4 and later don't have "type", but we also don't need
+                # to filter on it.  Just grab all the stream ids.
+                streamIdDOs = [s.id for s in streams]
+            except:
+                # skip these streams if there are any other exceptions
+                continue
+            mergedDefectFilterDO = self._client.defect.getDO(
+                'mergedDefectFilterSpecDataObj',
+                cidList = [self.defectDO.cid],
+                statusNameList = ['New','Triaged','Fixed','Dismissed'])
+            self._client.defect.pageSpecDO.startIndex = 0
+            mDOs = self._client.defect.getMergedDefectsForStreams(
+                streamIdDOs,
+                mergedDefectFilterDO,
+                self._client.defect.pageSpecDO)
+            if mDOs.totalNumberOfRecords > 0:
+                return proj.projectKey
 
 _cache['checkers'] = {}
     
@@ -832,11 +2129,12 @@ class CheckerDescription(object):
     Helper class for a checker description
     '''
     def _cache_key(self, checker):
-        return '??'.join([checker.checkerName, checker.domain,
+        return '??'.join([client.url, checker.checkerName, checker.domain,
                         checker.subcategory])
         
     def __init__(self, checker):
         key = self._cache_key(checker)
+        _cache_event('checkers', key in _cache['checkers'])
         if key not in _cache['checkers']:
             filter = client.config.getDO('checkerPropertyFilterSpecDataObj',
                 checkerNameList=[checker.checkerName], 
@@ -870,10 +2168,11 @@ class SourceFile(object):
             self.text = text
 
     def _cache_key(self, stream, file):
-        return '??'.join([file.contentsMD5,file.filePathname])
+        return '??'.join([client.url, file.contentsMD5,file.filePathname])
         
     def __init__(self, stream, file):
         key = self._cache_key(stream, file)
+        _cache_event('files', key in _cache['files'])
         if key not in _cache['files']:
             src = client.defect.getFileContents(stream, file)
             text = zlib.decompress(standard_b64decode(src.contents))
@@ -0,0 +1,301 @@
+'''
+Recording and replaying the web service traffic of a run.
+
+With "--record-ws FILE", every document fetched (the WSDLs) and every SOAP
+request and response is saved in FILE, a "cassette", at the end of the
+run.  A daemon saves each run's calls over the previous run's.  With "--replay-ws FILE", the requests are answered from the
+cassette instead of a server, after the recorded response time scaled by
+"--replay-timing".  So a run against a real server can be repeated, and
+timed, without it.
+
+Requests are matched to the recorded ones by URL and their SOAP body.  If
+a request isn't in the cassette exactly (a filter with the current date,
+say), the next unused recording of the same operation is used instead.
+
+The WS-Security header, which holds the user's password, is removed from
+the requests before they're saved, and no HTTP headers are saved.  The
+cassette is gzip-compressed JSON, one record per line, with each distinct
+message stored once.
+'''
+
+import re
+import time
+import gzip
+import json
+import atexit
+import hashlib
+import datetime
+import threading
+from cStringIO import StringIO
+
+from suds.cache import NoCache
+from suds.transport import Transport, TransportError, Reply
+from suds.transport.https import HttpAuthenticated
+
+# The WS-Security header added by suds.wsse
+_security = re.compile(r'<(?P<ns>[\w.-]+:|)Security\b.*?</(?P=ns)Security>', re.S)
+
+# The first element in the SOAP body names the operation
+_operation = re.compile(r'<(?:[\w.-]+:)?Body\b[^>]*>\s*<(?:[\w.-]+:)?([\w.-]+)')
+
+def strip_security(message):
+    '''
+    Returns the SOAP message without its WS-Security header.
+    '''
+    return _security.sub('', message)
+
+def operation(message):
+    m = _operation.search(message)
+    return m and m.group(1) or None
+
+class CassetteError(Exception): pass
+
+class Cassette(object):
+    '''
+    The recorded exchanges: documents fetched with "open", and SOAP calls
+    with "send".
+    '''
+    version = 1
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._bodies = []
+        self._body_ids = {}
+        self._calls = []
+        self._start = time.time()
+        # Whether calls are being recorded rather than replayed, and
+        # whether there are any which haven't been saved
+        self.recording = False
+        self.unsaved = True
+
+    def _body(self, text):
+        if text is None:
+            return None
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        digest = hashlib.sha1(text).digest()
+        try:
+            return self._body_ids[digest]
+        except KeyError:
+            self._bodies.append(text)
+            n = self._body_ids[digest] = len(self._bodies) - 1
+            return n
+
+    def add(self, kind, url, request, status, response, elapsed):
+        '''
+        Record an exchange.  status is the HTTP status, or None if there
+        was no reply.
+        '''
+        if request is not None:
+            request = strip_security(request)
+        with self._lock:
+            self.unsaved = True
+            self._calls.append({'kind': kind, 'url': url,
+                                'operation': request and operation(request),
+                                'request': self._body(request),
+                                'status': status,
+                                'response': self._body(response),
+                                'start': round(time.time() - elapsed - self._start, 6),
+                                'elapsed': round(elapsed, 6)})
+
+    def save(self):
+        with self._lock:
+            f = gzip.open(self.filename, 'wb')
+            try:
+                f.write(json.dumps({'cassette': self.version,
+                                    'created': datetime.datetime.now().isoformat(),
+                                    'calls': len(self._calls)}) + '\n')
+                for n, text in enumerate(self._bodies):
+                    f.write(json.dumps({'body': n, 'text': text.decode('utf-8')}) + '\n')
+                for call in self._calls:
+                    f.write(json.dumps(call) + '\n')
+            finally:
+                f.close()
+            self.unsaved = False
+
+    def restart(self):
+        '''
+        Forget the SOAP calls recorded, to record afresh.  The documents
+        are kept, since the clients already have them and won't fetch them
+        again.
+        '''
+        with self._lock:
+            calls = [call for call in self._calls if call['kind'] == 'open']
+            bodies = self._bodies
+            self._bodies = []
+            self._body_ids = {}
+            for call in calls:
+                for k in ('request', 'response'):
+                    if call[k] is not None:
+                        call[k] = self._body(bodies[call[k]])
+            self._calls = calls
+
+    def load(self):
+        f = gzip.open(self.filename, 'rb')
+        try:
+            header = json.loads(f.readline())
+            if header.get('cassette') != self.version:
+                raise CassetteError('%s is not a version %d cassette'
+                                    % (self.filename, self.version))
+            for line in f:
+                record = json.loads(line)
+                if 'body' in record:
+                    self._bodies.append(record['text'].encode('utf-8'))
+                else:
+                    self._calls.append(record)
+        finally:
+            f.close()
+
+        # Index the calls for find()
+        self._exact = {}
+        self._by_operation = {}
+        for i, call in enumerate(self._calls):
+            self._exact.setdefault(self._key(call), []).append(i)
+            self._by_operation.setdefault((call['url'], call['operation']), []).append(i)
+        self._used = set()
+
+    def _key(self, call):
+        return (call['kind'], call['url'], call['request'] is not None
+                and hashlib.sha1(self._bodies[call['request']]).digest())
+
+    def find(self, kind, url, request=None):
+        '''
+        Returns the recorded exchange for a request, as a dict like those
+        passed to add(), with the bodies filled in.  Each recording is used
+        once if possible; when they've all been used, the last one matching
+        exactly is used again.
+        '''
+        if request is not None:
+            request = strip_security(request)
+            if isinstance(request, unicode):
+                request = request.encode('utf-8')
+        key = (kind, url, request is not None and hashlib.sha1(request).digest())
+        with self._lock:
+            exact = self._exact.get(key, [])
+            similar = []
+            if kind == 'send':
+                similar = self._by_operation.get((url, operation(request)), [])
+            for candidates in (exact, similar):
+                for i in candidates:
+                    if i not in self._used:
+                        self._used.add(i)
+                        return self._filled(self._calls[i])
+            if exact:
+                return self._filled(self._calls[exact[-1]])
+        raise TransportError('No recorded response for %s %s' % (url,
+            request is not None and operation(request) or ''), 404, StringIO(''))
+
+    def _filled(self, call):
+        call = dict(call)
+        if call['response'] is not None:
+            call['response'] = self._bodies[call['response']]
+        return call
+
+class CassetteTransport(Transport):
+    '''
+    A suds transport which records the exchanges of another transport in a
+    cassette, or replays them from the cassette.
+    '''
+    def __init__(self, cassette, replay=False, timing=1.0, transport=None):
+        Transport.__init__(self)
+        self._cassette = cassette
+        self._replay = replay
+        self._timing = timing
+        self._transport = transport or HttpAuthenticated()
+
+    def _wait(self, call):
+        if self._timing:
+            time.sleep(call['elapsed'] * self._timing)
+
+    def open(self, request):
+        if self._replay:
+            call = self._cassette.find('open', request.url)
+            self._wait(call)
+            if call['status'] != 200:
+                raise TransportError('HTTP Error %s' % (call['status'],), call['status'],
+                                     StringIO(call['response'] or ''))
+            return StringIO(call['response'])
+
+        start = time.time()
+        try:
+            text = self._transport.open(request).read()
+        except TransportError, e:
+            body = e.fp and e.fp.read() or ''
+            self._cassette.add('open', request.url, None, e.httpcode, body, time.time() - start)
+            raise TransportError(str(e), e.httpcode, StringIO(body))
+        self._cassette.add('open', request.url, None, 200, text, time.time() - start)
+        return StringIO(text)
+
+    def send(self, request):
+        if self._replay:
+            call = self._cassette.find('send', request.url, request.message)
+            self._wait(call)
+            if call['status'] is None:
+                return None
+            if call['status'] != 200:
+                raise TransportError('HTTP Error %s' % (call['status'],), call['status'],
+                                     StringIO(call['response'] or ''))
+            return Reply(200, {'content-type': 'text/xml; charset=utf-8'}, call['response'])
+
+        start = time.time()
+        try:
+            reply = self._transport.send(request)
+        except TransportError, e:
+            body = e.fp and e.fp.read() or ''
+            self._cassette.add('send', request.url, request.message, e.httpcode, body,
+                               time.time() - start)
+            raise TransportError(str(e), e.httpcode, StringIO(body))
+        self._cassette.add('send', request.url, request.message,
+                           reply is not None and reply.code or None,
+                           reply is not None and reply.message or None,
+                           time.time() - start)
+        return reply
+
+# The cassettes in use, by filename, so all the clients share them
+_cassettes = {}
+_cassettes_lock = threading.Lock()
+
+def _cassette(filename, replay):
+    with _cassettes_lock:
+        try:
+            return _cassettes[filename]
+        except KeyError:
+            pass
+        c = _cassettes[filename] = Cassette(filename)
+        if replay:
+            c.load()
+        else:
+            c.recording = True
+            atexit.register(_save_at_exit, c)
+        return c
+
+def _save_at_exit(c):
+    if c.unsaved:
+        c.save()
+
+def flush():
+    '''
+    Save the cassettes being recorded, and restart them, so each holds the
+    last run when a daemon runs the reports repeatedly.
+    '''
+    with _cassettes_lock:
+        cassettes = [c for c in _cassettes.values() if c.recording]
+    for c in cassettes:
+        c.save()
+        c.restart()
+
+def client_options(options):
+    '''
+    Returns the keyword arguments for a suds Client to record or replay its
+    traffic according to options.  The WSDL cache is turned off, so the
+    WSDLs are always recorded.
+    '''
+    if getattr(options, 'replay_ws', None):
+        return {'transport': CassetteTransport(_cassette(options.replay_ws, True),
+                    replay=True, timing=options.replay_timing),
+                'cache': NoCache()}
+    if getattr(options, 'record_ws', None):
+        return {'transport': CassetteTransport(_cassette(options.record_ws, False)),
+                'cache': NoCache()}
+    return {}
@@ -0,0 +1,104 @@
+'''
+What the tests share: the synthetic CIM of benchmarks/fakecim.py, served
+over HTTP in-process or called directly through its LocalClient, and
+helpers to parse command lines and reset the state kept in coverity.ws.
+
+The tests need suds, like the package itself.  Run them from the top of
+the source tree with::
+
+    python -m unittest discover -s tests
+'''
+import os
+import sys
+import shutil
+import optparse
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+sys.path.insert(0, ROOT)
+
+import fakecim
+
+from coverity import ws
+
+def dataset(defects=200, **kw):
+    return fakecim.Dataset(defects=defects, **kw)
+
+def start_server(data=None, **kw):
+    '''
+    Returns a fakecim.FakeCIM serving data (by default, a dataset of 200
+    defects) on a free port, on a background thread.  Stop it with
+    shutdown().
+    '''
+    return fakecim.FakeCIM(data or dataset(), **kw).start()
+
+def ws_options(*args):
+    '''
+    Returns the options for the common command-line arguments args,
+    validated like a script's.
+    '''
+    p = ws.WSOpts().get_common_opts()
+    options, rest = optparse.OptionParser.parse_args(p, list(args))
+    p.validate_args(options, rest)
+    return options
+
+def email_parser(*args):
+    '''
+    Returns a coverity.email.MyOptionParser which has parsed and validated
+    the command-line arguments args.
+    '''
+    from coverity import email
+    parser = email.MyOptionParser({'subscribers': email.SubscriberReporter,
+                                   'owners': email.OwnerReporter,
+                                   'console': email.ConsoleReporter})
+    parser.options, parser.args = optparse.OptionParser.parse_args(parser._p, list(args))
+    parser._p.validate_args(parser.options, parser.args)
+    return parser
+
+def server_args(server):
+    return ['--host', 'localhost', '--port', str(server.port),
+            '--user', 'admin', '--password', 'x']
+
+def connect(server, *args):
+    '''
+    Returns a ws.CoverityServiceClient connected to server, with the
+    common options in args.
+    '''
+    c = ws.CoverityServiceClient()
+    c.connect(api_version=4, options=ws_options(*(server_args(server) + list(args))))
+    return c
+
+def local_defects(data=None, projectId=1):
+    '''
+    Returns a fakecim.LocalClient for data (by default, a dataset of 200
+    defects) and a ws.DefectHandler for each of its defects.
+    '''
+    client = fakecim.LocalClient(data or dataset())
+    with ws.using(client):
+        defects = [ws.DefectHandler(fakecim.to_suds(d, 'mergedDefectDataObj'), projectId=projectId)
+                   for d in client.handlers.data.defects]
+    return client, defects
+
+def reset_ws():
+    '''
+    Forget what coverity.ws has cached and counted, and its settings.
+    '''
+    for bucket in ws._cache.values():
+        bucket.clear()
+    ws.metadata.__init__()
+    ws.snapshot_cids.__init__()
+    ws.stats.reset()
+    ws.scheduler.__init__()
+    ws.hedging.__init__()
+
+class TempDir(object):
+    '''
+    A temporary directory for the duration of a "with" block.
+    '''
+    def __enter__(self):
+        self.path = tempfile.mkdtemp(prefix='coverity-test-')
+        return self.path
+
+    def __exit__(self, *exc):
+        shutil.rmtree(self.path, ignore_errors=True)
@@ -0,0 +1,121 @@
+import optparse
+import unittest
+
+import support
+
+from coverity import ws
+from coverity import templates
+from coverity.templates import cim_charts
+
+class CachedFragmentTest(unittest.TestCase):
+    def setUp(self):
+        support.reset_ws()
+        self.client, self.defects = support.local_defects(support.dataset(10))
+        self.template = templates.available_formats['details']
+        self.template._cache['fragments'].clear()
+        cim_charts.budget.start(3600)
+
+    def tearDown(self):
+        cim_charts.budget.start(0)
+
+    def render(self):
+        with ws.using(self.client):
+            return self.template(options=optparse.Values({}), defects=self.defects, intro='Found')
+
+    def test_cache_hits_count_against_the_remaining_fragments(self):
+        cim_charts.budget.expect(2 * len(self.defects))
+        self.assertEqual(self.render(), self.render())
+        self.assertEqual(cim_charts.budget._remaining, 0)
+        total, n = cim_charts.budget._costs[cim_charts.FULL_DETAIL]
+        self.assertEqual(n, 2 * len(self.defects))
+
+    def test_cache_hits_are_not_counted_as_truncated(self):
+        cim_charts.budget.expect(2 * len(self.defects))
+        cim_charts.budget._costs[cim_charts.FULL_DETAIL] = (1e6, 1)
+        self.render()
+        self.render()
+        self.assertEqual(cim_charts.budget.truncated, {cim_charts.NO_SOURCE: len(self.defects)})
+
+class TimeBudgetTest(unittest.TestCase):
+    def setUp(self):
+        self.budget = cim_charts.TimeBudget()
+
+    def test_no_budget_renders_everything(self):
+        self.budget.expect(1000)
+        self.budget.rendered(cim_charts.FULL_DETAIL, 60.0)
+        self.assertEqual(self.budget.detail(), cim_charts.FULL_DETAIL)
+        self.assertEqual(self.budget.summary(), None)
+
+    def test_detail_drops_as_the_budget_runs_out(self):
+        b = self.budget
+        b.start(10)
+        b.expect(100)
+        self.assertEqual(b.detail(), cim_charts.FULL_DETAIL)
+        # 99 more at 1s each won't fit, so try them without the source
+        b.rendered(cim_charts.FULL_DETAIL, 1.0)
+        self.assertEqual(b.detail(), cim_charts.NO_SOURCE)
+        # Which is cheap enough
+        b.rendered(cim_charts.NO_SOURCE, 0.01)
+        self.assertEqual(b.detail(), cim_charts.NO_SOURCE)
+        # Until it isn't
+        b.rendered(cim_charts.NO_SOURCE, 2.0)
+        self.assertEqual(b.detail(), cim_charts.NO_DESCRIPTIONS)
+        b.rendered(cim_charts.NO_DESCRIPTIONS, 0.001)
+        self.assertEqual(b.truncated, {cim_charts.NO_SOURCE: 2, cim_charts.NO_DESCRIPTIONS: 1})
+        self.assertEqual(b.summary(), '3 defects were rendered without source snippets, '
+                         '1 of them also without checker descriptions, to keep to the time budget\n')
+
+    def test_full_detail_again_if_it_fits(self):
+        b = self.budget
+        b.start(10)
+        b.expect(5)
+        b.rendered(cim_charts.FULL_DETAIL, 0.1)
+        self.assertEqual(b.detail(), cim_charts.FULL_DETAIL)
+
+    def test_overrun_renders_the_least_detail(self):
+        b = self.budget
+        b.start(10)
+        b._start -= 10
+        b.expect(5)
+        self.assertEqual(b.detail(), cim_charts.NO_DESCRIPTIONS)
+
+class DegradedRenderTest(unittest.TestCase):
+    def setUp(self):
+        support.reset_ws()
+        self.client, self.defects = support.local_defects(support.dataset(10))
+        self.defects = [d for d in self.defects if d.status != 'Fixed']
+        templates.available_formats['details']._cache['fragments'].clear()
+        cim_charts.budget.start(3600)
+
+    def tearDown(self):
+        cim_charts.budget.start(0)
+
+    def render(self, detail):
+        # Pretend every detail above "detail" costs too much
+        for d in range(detail):
+            cim_charts.budget._costs[d] = (1e6, 1)
+        cim_charts.budget.expect(len(self.defects))
+        with ws.using(self.client):
+            return templates.available_formats['details'](options=optparse.Values({}),
+                defects=self.defects, intro='Found')
+
+    def test_fragments_leave_out_what_the_budget_cant_afford(self):
+        cid = 'CID %d: ' % (self.defects[0].cid,)
+        text = self.render(cim_charts.NO_SOURCE)
+        self.assertTrue('Source snippets left out to send this report on time' in text)
+        self.assertTrue(cid in text)
+        templates.available_formats['details']._cache['fragments'].clear()
+        text = self.render(cim_charts.NO_DESCRIPTIONS)
+        self.assertTrue('Source snippets left out to send this report on time' in text)
+        self.assertFalse(cid in text)
+        self.assertEqual(cim_charts.budget.truncated,
+                         {cim_charts.NO_SOURCE: len(self.defects),
+                          cim_charts.NO_DESCRIPTIONS: len(self.defects)})
+
+    def test_fragments_with_more_detail_are_reused(self):
+        full = self.render(cim_charts.FULL_DETAIL)
+        self.assertEqual(self.render(cim_charts.NO_DESCRIPTIONS), full)
+        self.assertEqual(cim_charts.budget.truncated, {})
+
+if __name__ == '__main__':
+    unittest.main()
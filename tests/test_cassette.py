@@ -0,0 +1,84 @@
+import os
+import unittest
+
+import support
+
+from coverity import ws
+from coverity.ws import cassette
+
+class StripSecurityTest(unittest.TestCase):
+    def test_prefixed_and_unprefixed_headers(self):
+        for header in ('<wsse:Security xmlns:wsse="x"><wsse:Password>pw</wsse:Password></wsse:Security>',
+                       '<Security xmlns="x"><Password>pw</Password></Security>'):
+            message = '<Header>%s</Header><Body><getProjects/></Body>' % (header,)
+            self.assertEqual(cassette.strip_security(message),
+                             '<Header></Header><Body><getProjects/></Body>')
+
+class CassetteTest(unittest.TestCase):
+    def setUp(self):
+        support.reset_ws()
+        self.dir = support.TempDir()
+        self.filename = os.path.join(self.dir.__enter__(), 'ws.cassette')
+        self.data = support.dataset(20)
+        self.server = support.start_server(self.data)
+
+    def tearDown(self):
+        c = cassette._cassettes.pop(self.filename, None)
+        if c:
+            c.unsaved = False
+        self.server.shutdown()
+        self.server.server_close()
+        self.dir.__exit__()
+
+    def recorded(self):
+        '''
+        Returns the operations in the saved cassette, and the number of
+        documents.
+        '''
+        c = cassette.Cassette(self.filename)
+        c.load()
+        return ([call['operation'] for call in c._calls if call['kind'] == 'send'],
+                len([call for call in c._calls if call['kind'] == 'open']))
+
+    def test_flush_saves_each_run_over_the_last(self):
+        client = support.connect(self.server, '--record-ws', self.filename)
+        config = client.config
+        config.getProjects(config.getDO('projectFilterSpecDataObj', namePattern='*'))
+        cassette.flush()
+        sends, opens = self.recorded()
+        self.assertEqual(sends, ['getProjects'])
+        self.assertTrue(opens)
+
+        config.getStreams(config.getDO('streamFilterSpecDataObj', namePattern='*'))
+        config.getStreams(config.getDO('streamFilterSpecDataObj', namePattern='project0*'))
+        cassette.flush()
+        self.assertEqual(self.recorded(), (['getStreams', 'getStreams'], opens))
+        self.assertFalse(cassette._cassettes[self.filename].unsaved)
+
+    def calls(self, client):
+        '''
+        Returns the replies to a few calls, as (cid, status) and names.
+        '''
+        config = client.config
+        projects = config.getProjects(config.getDO('projectFilterSpecDataObj', namePattern='*'))
+        defect = client.defect
+        spec = defect.getDO('streamDefectFilterSpecDataObj', includeDefectInstances=True,
+                            includeHistory=False, scopePattern='*/*')
+        cids = [d['cid'] for d in self.data.defects[:5]]
+        replies = [(d.cid, d.status) for d in defect.getStreamDefects(cids, spec)]
+        return [p.id.name for p in projects], replies
+
+    def test_replay_answers_what_was_recorded(self):
+        recorded = self.calls(support.connect(self.server, '--record-ws', self.filename))
+        cassette.flush()
+
+        # Replay without the server
+        self.server.shutdown()
+        self.server.server_close()
+        cassette._cassettes.pop(self.filename)
+        support.reset_ws()
+        client = support.connect(self.server, '--replay-ws', self.filename, '--replay-timing', '0')
+        self.assertEqual(self.calls(client), recorded)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+import unittest
+from array import array
+from datetime import datetime
+from cStringIO import StringIO
+
+import support
+
+from coverity import ws
+from coverity.email import daemon
+
+CronSchedule = daemon.CronSchedule
+
+class CronScheduleTest(unittest.TestCase):
+    def test_fields(self):
+        s = CronSchedule('*/15 8-18/2 * * 1-5')
+        # Monday
+        self.assertTrue(s.matches(datetime(2026, 10, 19, 8, 45)))
+        self.assertFalse(s.matches(datetime(2026, 10, 19, 9, 45)))
+        self.assertFalse(s.matches(datetime(2026, 10, 19, 8, 40)))
+        self.assertFalse(s.matches(datetime(2026, 10, 19, 20, 0)))
+        # Sunday
+        self.assertFalse(s.matches(datetime(2026, 10, 18, 8, 45)))
+
+    def test_either_day_field_matches_when_both_are_restricted(self):
+        s = CronSchedule('0 0 1,15 * 0')
+        self.assertTrue(s.matches(datetime(2026, 10, 1)))
+        self.assertTrue(s.matches(datetime(2026, 10, 18)))
+        self.assertFalse(s.matches(datetime(2026, 10, 19)))
+
+    def test_sunday_is_0_or_7(self):
+        for spec in ('0 9 * * 7', '0 9 * * 0', '0 9 * * 6-7'):
+            s = CronSchedule(spec)
+            self.assertTrue(s.matches(datetime(2026, 10, 18, 9, 0)), spec)
+            self.assertFalse(s.matches(datetime(2026, 10, 19, 9, 0)), spec)
+        self.assertRaises(ValueError, CronSchedule, '0 9 * * 8')
+
+    def test_stepped_day_fields_are_not_restricted(self):
+        # Odd days of the month which are also Mondays
+        s = CronSchedule('0 9 */2 * 1')
+        self.assertTrue(s.matches(datetime(2026, 10, 19, 9, 0)))
+        self.assertFalse(s.matches(datetime(2026, 10, 26, 9, 0)))
+        self.assertFalse(s.matches(datetime(2026, 10, 21, 9, 0)))
+
+    def test_next_after(self):
+        s = CronSchedule('30 7 * * 1-5')
+        self.assertEqual(s.next_after(datetime(2026, 10, 19, 7, 29, 59)), datetime(2026, 10, 19, 7, 30))
+        self.assertEqual(s.next_after(datetime(2026, 10, 19, 7, 30)), datetime(2026, 10, 20, 7, 30))
+        # Friday evening to Monday
+        self.assertEqual(s.next_after(datetime(2026, 10, 23, 18, 0)), datetime(2026, 10, 26, 7, 30))
+        self.assertEqual(CronSchedule('* * * * *').next_after(datetime(2026, 12, 31, 23, 59, 30)),
+                         datetime(2027, 1, 1, 0, 0))
+
+    def test_leap_day(self):
+        s = CronSchedule('0 12 29 2 *')
+        self.assertEqual(s.next_after(datetime(2026, 10, 19)), datetime(2028, 2, 29, 12, 0))
+        # 2100 isn't a leap year
+        self.assertEqual(s.next_after(datetime(2096, 3, 1)), datetime(2104, 2, 29, 12, 0))
+
+    def test_invalid_schedules(self):
+        for spec in ('* * * *', '60 * * * *', '* 5-2 * * *', '*/0 * * * *', 'x * * * *'):
+            self.assertRaises(ValueError, CronSchedule, spec)
+        self.assertRaises(CronSchedule.ParseError,
+                          CronSchedule('0 0 30 2 *').next_after, datetime(2026, 10, 19))
+
+    def test_impossible_schedule_is_rejected_at_startup(self):
+        args = ['--host', 'localhost', '--port', '8080', '--user', 'admin', '--password', 'x',
+                '--daemon', '--schedule']
+        self.assertRaises(ws.WSOpts.ValidationError, support.email_parser, *(args + ['0 0 30 2 *']))
+        support.email_parser(*(args + ['0 0 29 2 *']))
+
+class ReportDaemonTest(unittest.TestCase):
+    def setUp(self):
+        support.reset_ws()
+
+    def tearDown(self):
+        support.reset_ws()
+
+    def test_caches_are_trimmed_after_each_run(self):
+        def run():
+            ws._cache['fragments']['x'] = 'fragment'
+            ws._cache['files']['x'] = ('text', [])
+            ws._cache['checkers']['x'] = 'checker'
+            ws.metadata._entries[('http://cim:8080', 'projects', ('cid', 1))] = [0, 1, False]
+            ws.metadata._entries[('http://cim:8080', 'users', None)] = [9e99, [], False]
+        d = daemon.ReportDaemon(run, log=StringIO())
+        d._call()
+        self.assertEqual(ws._cache['fragments'], {})
+        self.assertEqual(ws._cache['files'], {})
+        self.assertEqual(ws._cache['checkers'], {'x': 'checker'})
+        self.assertEqual(ws.metadata._entries.keys(), [('http://cim:8080', 'users', None)])
+
+    def test_caches_are_trimmed_after_a_failed_run(self):
+        def run():
+            ws._cache['files']['x'] = ('text', [])
+            raise ValueError('failed')
+        log = StringIO()
+        daemon.ReportDaemon(run, log=log)._call()
+        self.assertEqual(ws._cache['files'], {})
+        self.assertTrue('ValueError: failed' in log.getvalue())
+
+class SnapshotCIDCacheTest(unittest.TestCase):
+    def test_keeps_the_most_recently_used_snapshots(self):
+        client, defects = support.local_defects(support.dataset(20))
+        cache = ws.SnapshotCIDCache()
+        cache.max_snapshots = 3
+        fetched = []
+        def fetch(client, stream, ssid):
+            fetched.append(ssid.id)
+            return array('l', [ssid.id])
+        cache._fetch = fetch
+        ids = [client.config.getDO('snapshotIdDataObj', id=i) for i in range(5)]
+        for ssid in ids[:3] + ids[:1] + ids[3:] + ids[:1]:
+            self.assertEqual(list(cache.get(client, None, ssid)), [ssid.id])
+        self.assertEqual(fetched, [0, 1, 2, 3, 4])
+        self.assertEqual([key[1] for key in cache._cids], [3, 4, 0])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import time
+import socket
+import threading
+import unittest
+
+import support
+
+from coverity import templates
+from coverity.email import delivery
+
+class SMTPDeliveryTest(unittest.TestCase):
+    def message(self, format, body):
+        send = delivery.SMTPDelivery('cov@example.com', domain='example.com',
+                                     subtype=templates.available_formats[format].mime_subtype)
+        return send.message('user1', 'Report', body)
+
+    def test_subtype_comes_from_the_format(self):
+        self.assertEqual(self.message('xml', '<?xml version="1.0"?><defects/>').get_content_type(),
+                         'text/xml')
+        for name in ('table', 'list', 'details_html', 'defects_bar_chart'):
+            self.assertEqual(self.message(name, 'Found').get_content_type(), 'text/html', name)
+        self.assertEqual(self.message('details', '<none>').get_content_type(), 'text/plain')
+
+    def test_users_are_addressed_in_the_domain(self):
+        self.assertEqual(self.message('details', 'x')['To'], 'user1@example.com')
+
+class NotificationDispatcherTest(unittest.TestCase):
+    def test_workers_send_at_once(self):
+        lock = threading.Lock()
+        sent = []
+        state = {'in flight': 0, 'most': 0}
+        def send(user, subject, body):
+            with lock:
+                state['in flight'] += 1
+                state['most'] = max(state['most'], state['in flight'])
+            time.sleep(0.05)
+            with lock:
+                state['in flight'] -= 1
+                sent.append((user, body))
+
+        d = delivery.NotificationDispatcher(send, max_in_flight=4, backoff=0)
+        for i in range(12):
+            d.submit('user%d' % (i,), 'Report', 'body%d' % (i,))
+        d.close()
+        self.assertEqual(sorted(sent), sorted([('user%d' % (i,), 'body%d' % (i,))
+                                               for i in range(12)]))
+        self.assertEqual(state['most'], 4)
+        self.assertEqual(len(d.latencies), 12)
+        self.assertEqual(d.failures, [])
+
+    def test_transient_errors_are_retried(self):
+        attempts = {}
+        lock = threading.Lock()
+        def send(user, subject, body):
+            with lock:
+                attempts[user] = attempts.get(user, 0) + 1
+                n = attempts[user]
+            if user == 'flaky' and n < 3:
+                raise socket.error('connection reset')
+            if user == 'down':
+                raise socket.error('connection refused')
+            if user == 'unknown':
+                raise ValueError('no such user')
+
+        d = delivery.NotificationDispatcher(send, max_in_flight=2, retries=2, backoff=0)
+        for user in ('flaky', 'down', 'unknown', 'ok'):
+            d.submit(user, 'Report', 'body')
+        d.close()
+        self.assertEqual(attempts, {'flaky': 3, 'down': 3, 'unknown': 1, 'ok': 1})
+        self.assertEqual(d.retried, 4)
+        self.assertEqual(sorted([user for user, error in d.failures]), ['down', 'unknown'])
+        self.assertEqual(len(d.latencies), 2)
+        self.assertTrue('2 notifications sent' in d.summary())
+        self.assertTrue('failed to notify down: connection refused' in d.summary())
+
+if __name__ == '__main__':
+    unittest.main()
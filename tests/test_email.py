@@ -0,0 +1,168 @@
+import os
+import threading
+import unittest
+from array import array
+
+import support
+
+from coverity import ws
+from coverity import email
+from coverity import templates
+from coverity.templates import cim_charts
+
+ARGS = ['--host', 'localhost', '--port', '8080', '--user', 'admin', '--password', 'x']
+
+class OptionsTest(unittest.TestCase):
+    def assertInvalid(self, *args):
+        self.assertRaises(ws.WSOpts.ValidationError, support.email_parser, *(ARGS + list(args)))
+
+    def test_render_workers_need_scopes_run_one_at_a_time(self):
+        self.assertInvalid('--projects', 'a,b', '--render-workers', '2')
+        support.email_parser(*(ARGS + ['--projects', 'a,b', '--render-workers', '2',
+                                       '--parallel', '1']))
+        support.email_parser(*(ARGS + ['--projects', 'a', '--render-workers', '2']))
+
+    def test_smtp_delivery_needs_a_domain(self):
+        self.assertInvalid('--projects', 'a', '--delivery', 'smtp', '--smtp-from', 'cov@example.com')
+        support.email_parser(*(ARGS + ['--projects', 'a', '--delivery', 'smtp',
+                                       '--smtp-from', 'cov@example.com',
+                                       '--smtp-domain', 'example.com']))
+
+class Record(object):
+    def __init__(self, cid, status='New', owner='user1'):
+        self.cid = cid
+        self.status = status
+        self.owner = owner
+
+class ReportStateTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = support.TempDir()
+        self.filename = os.path.join(self.dir.__enter__(), 'state')
+
+    def tearDown(self):
+        self.dir.__exit__()
+
+    def test_scopes_share_one_state_saved_once(self):
+        state = email.ReportState(self.filename)
+        def record(key):
+            scope = state.scope(key)
+            for i in range(100):
+                scope.record_all({'user%d' % (i,): [Record(i), Record(i + 1)]})
+        threads = [threading.Thread(target=record, args=('scope%d' % (n,),)) for n in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertFalse(os.path.exists(self.filename))
+        state.save()
+        self.assertEqual(os.listdir(os.path.dirname(self.filename)), ['state'])
+
+        state = email.ReportState(self.filename)
+        for n in range(4):
+            scope = state.scope('scope%d' % (n,))
+            self.assertFalse(scope.changed('user7', [Record(7), Record(8)]))
+            self.assertTrue(scope.changed('user7', [Record(7)]))
+
+    def test_scope_key_includes_the_filters(self):
+        def key(*args):
+            return email.ReportState.scope_key(support.email_parser(*(ARGS + list(args))).options)
+        base = key('--project', 'p')
+        self.assertEqual(key('--project', 'p', '--send-workers', '4'), base)
+        self.assertNotEqual(key('--project', 'q'), base)
+        for args in (['--status', 'New'], ['--severity', 'Major'], ['--classification', 'Bug'],
+                     ['--days', '7'], ['--component', 'Default.comp1'],
+                     ['--component', 'Default.comp1', '--excludeComponents'],
+                     ['--unassigned', 'include'], ['--unassigned-to', 'admin']):
+            self.assertNotEqual(key('--project', 'p', *args), base, args)
+        self.assertNotEqual(key('--project', 'p', '--component', 'Default.comp1'),
+                            key('--project', 'p', '--component', 'Default.comp1', '--excludeComponents'))
+
+    def test_delta(self):
+        state = email.ReportState(self.filename)
+        scope = state.scope('scope')
+        reports = {'user1': [Record(1), Record(2), Record(3)], 'user2': [Record(4)]}
+        self.assertTrue(scope.changed('user1', reports['user1']))
+        self.assertEqual(scope.delta('user1', reports['user1']), reports['user1'])
+        scope.record_all(reports)
+        state.save()
+
+        scope = email.ReportState(self.filename).scope('scope')
+        self.assertFalse(scope.changed('user1', reports['user1']))
+        self.assertEqual(scope.delta('user1', reports['user1']), [])
+        # Changed and new defects are in the delta
+        triaged, new = Record(2, status='Triaged'), Record(5)
+        defects = [Record(1), triaged, Record(3), new]
+        self.assertTrue(scope.changed('user1', defects))
+        self.assertEqual(scope.delta('user1', defects), [triaged, new])
+        # A removed defect changes the report, with nothing new to send
+        self.assertTrue(scope.changed('user1', reports['user1'][:2]))
+        self.assertEqual(scope.delta('user1', reports['user1'][:2]), [])
+        # Recipients no longer reported are forgotten
+        scope.retain(['user1'])
+        self.assertTrue(scope.changed('user2', reports['user2']))
+        self.assertFalse(scope.changed('user1', reports['user1']))
+
+    def test_scopes_are_separate(self):
+        state = email.ReportState(self.filename)
+        state.scope('a').record_all({'user1': [Record(1)]})
+        self.assertFalse(state.scope('a').changed('user1', [Record(1)]))
+        self.assertTrue(state.scope('b').changed('user1', [Record(1)]))
+
+class RenderReportsTest(unittest.TestCase):
+    def setUp(self):
+        support.reset_ws()
+        self.client, defects = support.local_defects(support.dataset(20))
+        self.table = email.DefectTable(defects, lambda d: d)
+        self.email_cid = {'user1': array('l', range(0, 12)),
+                          'user2': array('l', range(8, 20)),
+                          'user3': array('l', [3])}
+
+    def tearDown(self):
+        templates.budget.start(0)
+
+    def render(self, workers, *args):
+        options = support.email_parser(*(ARGS + ['--dest', 'owners',
+                                                 '--render-workers', str(workers)] +
+                                         list(args))).options
+        with ws.using(self.client):
+            return email.render_reports(sorted(self.email_cid), self.email_cid, self.table,
+                                        options, email.OwnerReporter(self.client))
+
+    def test_workers_render_the_same_reports_in_order(self):
+        reports = self.render(0)
+        self.assertEqual(len(reports), 3)
+        self.assertEqual(self.render(2), reports)
+
+    def test_workers_render_each_fragment_once_for_this_process(self):
+        reports = self.render(0, '--format', 'details')
+        support.reset_ws()
+        self.assertTrue(self.render(2, '--format', 'details') == reports)
+        self.assertEqual(len(ws._cache['fragments']), len(self.table))
+        # The fragments are cached here for the next report, which
+        # doesn't render any
+        template = templates.available_formats['details']
+        fragment, template._fragment = template._fragment, None
+        try:
+            self.assertTrue(self.render(0, '--format', 'details') == reports)
+        finally:
+            template._fragment = fragment
+
+    def degraded(self, workers):
+        # Each fragment is too expensive to render with source snippets
+        support.reset_ws()
+        templates.budget.start(3600)
+        templates.budget.expect(sum([len(rows) for rows in self.email_cid.values()]))
+        templates.budget._costs[cim_charts.FULL_DETAIL] = (1e6, 1)
+        reports = self.render(workers, '--format', 'details')
+        return reports, templates.budget.summary()
+
+    def test_workers_count_against_the_budget(self):
+        reports, summary = self.degraded(0)
+        self.assertTrue(summary.startswith('%d defects were rendered without source snippets'
+                                           % (len(self.table),)))
+        workers_reports, workers_summary = self.degraded(2)
+        self.assertEqual(workers_summary, summary)
+        self.assertTrue(workers_reports == reports)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+import unittest
+from cStringIO import StringIO
+
+import support
+
+from coverity import ws
+from coverity import email
+from coverity.email import estimate
+
+class EstimateTest(unittest.TestCase):
+    def setUp(self):
+        support.reset_ws()
+        self.server = support.start_server(support.dataset(50))
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def estimate(self, *args):
+        parser = support.email_parser(*(support.server_args(self.server) +
+                                        ['--projects', 'project0', '--test'] + list(args)))
+        reporters = {'owners': email.OwnerReporter, 'console': email.ConsoleReporter}
+        out = StringIO()
+        with ws.using(support.connect(self.server)):
+            self.assertEqual(estimate.run(parser, parser.scopes(), reporters, out), 0)
+        # The method of each row, and its mark
+        return dict([(l[23:55].strip() or 'total', l[56:58].strip())
+                     for l in out.getvalue().splitlines()[2:] if l[2:22].strip()])
+
+    def test_files_are_estimated_not_bounded(self):
+        rows = self.estimate('--job', 'owners:details')
+        self.assertEqual(rows['getFileContents'], '~')
+        self.assertEqual(rows['getCheckerProperties'], '<=')
+        self.assertEqual(rows['getStreamDefects'], '')
+        self.assertEqual(rows['total'], '~')
+
+    def test_exact_counts_are_not_marked(self):
+        rows = self.estimate('--job', 'owners:table')
+        self.assertEqual(rows['getMergedDefectHistory'], '')
+        self.assertEqual(rows['total'], '')
+
+if __name__ == '__main__':
+    unittest.main()
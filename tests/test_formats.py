@@ -0,0 +1,111 @@
+import json
+import optparse
+import threading
+import unittest
+from cStringIO import StringIO
+
+import support
+import fakecim
+
+from coverity import ws
+from coverity import templates
+
+class JSONFormatTest(unittest.TestCase):
+    def setUp(self):
+        support.reset_ws()
+        self.client, self.defects = support.local_defects(support.dataset(30))
+
+    def render(self, name, raw=False):
+        with ws.using(self.client):
+            return templates.available_formats[name](options=optparse.Values({'raw': raw}),
+                                                     defects=self.defects, intro='Found')
+
+    def test_json_document(self):
+        doc = json.loads(self.render('json'))
+        self.assertEqual(doc['intro'], 'Found')
+        self.assertEqual([d['cid'] for d in doc['defects']], [d.cid for d in self.defects])
+        first = doc['defects'][0]
+        self.assertEqual(first['checker'], self.defects[0].checkerName)
+        self.assertEqual(first['first_detected'],
+                         self.defects[0].firstDetected.strftime('%Y-%m-%d'))
+        self.assertFalse('defectInstances' in first)
+
+    def test_raw_json_is_an_array(self):
+        doc = json.loads(self.render('json', raw=True))
+        self.assertEqual(len(doc), len(self.defects))
+
+    def test_ndjson_has_one_defect_per_line(self):
+        lines = self.render('ndjson').splitlines()
+        self.assertEqual([json.loads(l)['cid'] for l in lines], [d.cid for d in self.defects])
+
+    def test_instances(self):
+        doc = json.loads(self.render('json_instances'))
+        for d, rec in zip(self.defects, doc['defects']):
+            if d.status == 'Fixed':
+                self.assertEqual(rec['defectInstances'], [])
+            else:
+                events = rec['defectInstances'][0]['events']
+                self.assertTrue(events)
+                self.assertEqual(events[-1]['main'], True)
+
+    def test_stream_writes_the_same_output_in_batches(self):
+        template = templates.available_formats['json']
+        template._batch_size = 4
+        try:
+            out = StringIO()
+            with ws.using(self.client):
+                template.stream(out, options=optparse.Values({'raw': False}),
+                                defects=self.defects, intro='Found')
+        finally:
+            del template._batch_size
+        self.assertEqual(out.getvalue(), self.render('json'))
+
+class FragmentCacheTest(unittest.TestCase):
+    def setUp(self):
+        support.reset_ws()
+        self.data = support.dataset(5)
+
+    def render(self, name, projectId):
+        client, defects = support.local_defects(self.data, projectId=projectId)
+        with ws.using(client):
+            return templates.available_formats[name](options=optparse.Values({}),
+                                                     defects=defects[:1], intro='Found')
+
+    def test_fragments_are_not_shared_between_projects(self):
+        for name in ('table', 'list', 'details', 'details_html'):
+            self.assertTrue('projectId=1&' in self.render(name, 1))
+            self.assertTrue('projectId=2&' in self.render(name, 2), name)
+
+    def test_details_are_not_shared_between_streams(self):
+        template = templates.available_formats['details']
+        client, defects = support.local_defects(self.data)
+        defect = defects[0]
+        with ws.using(client):
+            key = template.fragment_key(defect)
+            defect.streamId = fakecim.to_suds({'name': 'other'}, 'streamIdDataObj')
+            self.assertNotEqual(template.fragment_key(defect), key)
+
+class ConcurrentRenderTest(unittest.TestCase):
+    def test_renders_run_at_once(self):
+        # The first render waits in the template for the second
+        template = templates.Template('${wait(name)}$${name}$')
+        started = threading.Event()
+        done = threading.Event()
+        def wait(name):
+            if name == 'first':
+                started.set()
+                out['woken'] = done.wait(2)
+            else:
+                done.set()
+        out = {}
+        def render(name):
+            out[name] = template(wait=wait, name=name)
+        first = threading.Thread(target=render, args=('first',))
+        first.start()
+        started.wait(5)
+        render('second')
+        first.join()
+        self.assertEqual(out, {'first': 'first', 'second': 'second', 'woken': True})
+
+if __name__ == '__main__':
+    unittest.main()
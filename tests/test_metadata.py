@@ -0,0 +1,62 @@
+import os
+import unittest
+
+import support
+
+from coverity import ws
+
+class Config(object):
+    def __init__(self, url):
+        self.url = url
+        self.factory = None
+
+class Client(object):
+    def __init__(self, url='http://cim:8080'):
+        self.config = Config(url)
+
+class MetadataCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = ws.MetadataCache()
+        self.client = Client()
+
+    def put(self, kind, key, value, age=0, client=None):
+        self.cache.get(client or self.client, kind, key, lambda: value)
+        if age:
+            self.cache._entries[((client or self.client).config.url, kind, key)][0] -= age
+
+    def test_prune_drops_expired_entries(self):
+        self.put('projects', ('cid', 1), 1, age=3601)
+        self.put('projects', ('cid', 2), 1, age=3599)
+        self.put('users', None, ['user1'], age=3601)
+        self.cache.prune()
+        self.assertEqual(sorted(self.cache._entries),
+                         [('http://cim:8080', 'projects', ('cid', 2)),
+                          ('http://cim:8080', 'users', None)])
+
+    def test_prune_keeps_the_newest_entries_of_each_kind(self):
+        self.cache.max_entries = 10
+        other = Client('http://other:8080')
+        for cid in range(25):
+            self.put('projects', ('cid', cid), 1, age=100 - cid)
+            self.put('projects', ('cid', cid), 1, client=other)
+        self.put('users', None, [])
+        self.cache.prune()
+        self.assertEqual(sorted(self.cache.keys(self.client, 'projects')),
+                         [('cid', cid) for cid in range(15, 25)])
+        self.assertEqual(len(self.cache.keys(other, 'projects')), 10)
+        self.assertEqual(self.cache.keys(self.client, 'users'), [None])
+
+    def test_save_leaves_out_expired_entries(self):
+        with support.TempDir() as d:
+            filename = os.path.join(d, 'metadata')
+            self.cache.load(filename)
+            self.put('projects', ('cid', 1), 1, age=3601)
+            self.put('projects', ('cid', 2), 2)
+            self.cache.save()
+            cache = ws.MetadataCache()
+            cache.load(filename)
+            self.assertEqual(cache._entries.keys(), [('http://cim:8080', 'projects', ('cid', 2))])
+            self.assertEqual(cache.get(self.client, 'projects', ('cid', 2), None), 2)
+
+if __name__ == '__main__':
+    unittest.main()
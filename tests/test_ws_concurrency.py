@@ -0,0 +1,114 @@
+import threading
+import unittest
+
+import support
+
+from coverity import ws
+
+class ConcurrentCallTest(unittest.TestCase):
+    '''
+    Calls made at the same time through one CoverityWebServiceClient must
+    each get their own reply.
+    '''
+    threads = 16
+
+    def setUp(self):
+        support.reset_ws()
+        ws.scheduler.max_in_flight = 0
+        self.data = support.dataset(100)
+        self.server = support.start_server(self.data, latency=0.01)
+        self.client = support.connect(self.server)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        support.reset_ws()
+
+    def stream_defects(self, cids):
+        service = self.client.defect
+        spec = service.getDO('streamDefectFilterSpecDataObj', includeDefectInstances=True,
+                             includeHistory=False, scopePattern='*/*')
+        replies = []
+        errors = []
+        def run(cids):
+            try:
+                for cid in cids:
+                    replies.append((cid, service.getStreamDefects([cid], spec)[0]))
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=run, args=(cids[i::self.threads],))
+                   for i in range(self.threads)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        return replies
+
+    def test_each_call_gets_its_own_reply(self):
+        cids = [d['cid'] for d in self.data.defects]
+        replies = self.stream_defects(cids)
+        self.assertEqual(sorted([cid for cid, reply in replies]), sorted(cids))
+        for cid, reply in replies:
+            self.assertEqual(reply.cid, cid)
+
+class SchedulerTest(ConcurrentCallTest):
+    '''
+    The same calls, with fewer slots than threads.
+    '''
+    def setUp(self):
+        ConcurrentCallTest.setUp(self)
+        ws.scheduler.max_in_flight = 4
+
+    def test_each_call_gets_its_own_reply(self):
+        ConcurrentCallTest.test_each_call_gets_its_own_reply(self)
+        self.assertEqual(ws.scheduler.max_seen_in_flight, 4)
+        self.assertTrue(ws.scheduler.queued)
+        self.assertEqual(ws.scheduler._in_flight, 0)
+
+    def test_identical_calls_share_a_reply(self):
+        cids = [d['cid'] for d in self.data.defects][:4] * 8
+        replies = self.stream_defects(cids)
+        self.assertEqual(len(replies), len(cids))
+        for cid, reply in replies:
+            self.assertEqual(reply.cid, cid)
+        self.assertEqual(ws.stats.methods['getStreamDefects']['calls'] + ws.scheduler.coalesced,
+                         len(cids))
+
+class SnapshotStreamsTest(unittest.TestCase):
+    '''
+    OptionsProcessor.snapshot_streams() looks at the streams concurrently.
+    '''
+    def setUp(self):
+        support.reset_ws()
+        self.data = support.dataset(100, projects=1, streams=16, snapshots=3)
+        self.server = support.start_server(self.data, latency=0.01)
+        self.client = support.connect(self.server)
+        with ws.using(self.client):
+            self.scope = ws.OptionsProcessor(support.ws_options(*(support.server_args(self.server)
+                                                                  + ['--project', 'project0'])),
+                                             self.client)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        support.reset_ws()
+
+    def snapshot_streams(self, snapshot):
+        ssid = self.client.config.getDO('snapshotIdDataObj', id=snapshot)
+        return [s.name for s in self.scope.snapshot_streams(self.client, ssid,
+                                                            self.scope.streamIdDOs)]
+
+    def test_finds_the_stream_of_each_snapshot(self):
+        self.assertEqual(len(self.scope.streamIdDOs), 16)
+        for name, stream in sorted(self.data.streams.items()):
+            # Fetch every stream's snapshots again
+            ws.metadata.__init__()
+            self.assertEqual(self.snapshot_streams(stream['snapshots'][-1]), [name])
+
+    def test_probes_each_stream_for_an_unknown_snapshot(self):
+        self.assertEqual(self.snapshot_streams(1), [])
+        self.assertEqual(self.server.calls['getMergedDefectsForStreams'], 16)
+
+if __name__ == '__main__':
+    unittest.main()
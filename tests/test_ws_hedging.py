@@ -0,0 +1,112 @@
+import time
+import threading
+import unittest
+
+import support
+
+from coverity import ws
+
+def wait_for_slots(timeout=5):
+    '''
+    Wait for the attempts still running to release their scheduler slots.
+    Returns whether they have.
+    '''
+    end = time.time() + timeout
+    while ws.scheduler._in_flight and time.time() < end:
+        time.sleep(0.01)
+    return not ws.scheduler._in_flight
+
+class Service(object):
+    wsdlFile = 'http://localhost/ws/v4/defectservice?wsdl'
+
+class HedgedCallTest(unittest.TestCase):
+    def setUp(self):
+        support.reset_ws()
+        ws.scheduler.max_in_flight = 2
+        self.first_running = threading.Event()
+        self.finish_first = threading.Event()
+        self.calls = 0
+
+    def tearDown(self):
+        self.finish_first.set()
+        support.reset_ws()
+
+    def method(self, x):
+        self.calls += 1
+        if self.calls == 1:
+            self.first_running.set()
+            self.finish_first.wait(5)
+            return 'first'
+        return 'hedge'
+
+    def call(self):
+        return ws.scheduler.call(Service(), 'getX', ws.hedging.method('getX', self.method), 1)
+
+    def assertReleased(self):
+        self.assertTrue(wait_for_slots(), '%d slots still in flight' % (ws.scheduler._in_flight,))
+
+    def test_first_attempt_keeps_its_slot_when_the_hedge_wins(self):
+        ws.hedging.percentile = 50
+        for i in range(ws.hedging.min_samples):
+            ws.hedging._sample('getX', 0.001)
+        self.assertEqual(self.call(), 'hedge')
+        self.assertEqual(ws.hedging.methods['getX']['hedge_wins'], 1)
+        self.assertEqual(ws.scheduler._in_flight, 1)
+        self.finish_first.set()
+        self.assertReleased()
+
+    def test_attempt_keeps_its_slot_past_the_deadline(self):
+        ws.hedging.deadline = 0.05
+        self.assertRaises(ws.DeadlineExceeded, self.call)
+        self.assertTrue(self.first_running.is_set())
+        self.assertEqual(ws.scheduler._in_flight, 1)
+        self.finish_first.set()
+        self.assertReleased()
+
+    def test_slot_is_released_when_the_first_attempt_wins(self):
+        ws.hedging.deadline = 1
+        self.finish_first.set()
+        self.assertEqual(self.call(), 'first')
+        self.assertEqual(ws.scheduler._in_flight, 0)
+
+class HedgedServerCallTest(unittest.TestCase):
+    '''
+    Hedged calls made at the same time through one client each get their
+    own reply.
+    '''
+    def setUp(self):
+        support.reset_ws()
+        ws.scheduler.max_in_flight = 0
+        ws.hedging.percentile = 1
+        for i in range(ws.hedging.min_samples):
+            ws.hedging._sample('getStreamDefects', 0.001)
+        self.data = support.dataset(60)
+        self.server = support.start_server(self.data, latency=0.03)
+        self.client = support.connect(self.server)
+
+    def tearDown(self):
+        # Let the attempts the calls didn't wait for finish first
+        wait_for_slots()
+        self.server.shutdown()
+        self.server.server_close()
+        support.reset_ws()
+
+    def test_each_attempt_gets_its_own_reply(self):
+        service = self.client.defect
+        spec = service.getDO('streamDefectFilterSpecDataObj', includeDefectInstances=False,
+                             includeHistory=False, scopePattern='*/*')
+        cids = [d['cid'] for d in self.data.defects]
+        replies = {}
+        def run(cids):
+            for cid in cids:
+                replies[cid] = service.getStreamDefects([cid], spec)[0].cid
+        threads = [threading.Thread(target=run, args=(cids[i::8],)) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(replies, dict([(cid, cid) for cid in cids]))
+        self.assertTrue(ws.hedging.methods['getStreamDefects']['hedged'])
+
+if __name__ == '__main__':
+    unittest.main()